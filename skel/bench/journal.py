@@ -0,0 +1,130 @@
+"""
+Benchmark for the journal of the Marketplace:
+
+    orders   consumer threads fill one-unit carts and order them, without a
+             journal, with one and with one made with sync_orders, where an
+             order waits until its records are on disk and the orders placed
+             at the same time share one sync (group commit)
+    restore  a checkpoint of a Marketplace with millions of queued units and
+             many full carts is written, then a Marketplace is restored from it
+
+The overhead of the journal on the other methods is measured by bench.micro
+with --journal.
+
+Usage (from the skel directory): python3 -m bench.journal [options]
+"""
+
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+from threading import Thread
+
+from tema.journal import CHECKPOINT_NAME, Journal, MarketState
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+
+def run_orders(args, journal=None):
+    """
+    Places args.orders orders from every consumer thread and returns the
+    number of orders per second.
+    """
+    tea = Tea(name='Tea', price=1, type='Black')
+    orders = args.consumers * args.orders
+    marketplace = Marketplace(orders, journal=journal)
+    producer_id = marketplace.register_producer()
+    marketplace.publish_many(producer_id, tea, orders)
+
+    def consume():
+        for _ in range(args.orders):
+            cart_id = marketplace.new_cart()
+            marketplace.add_many_to_cart(cart_id, tea, 1)
+            marketplace.place_order_lines(cart_id)
+
+    threads = [Thread(target=consume) for _ in range(args.consumers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return orders / (time.perf_counter() - start)
+
+
+def checkpoint_state(args):
+    """
+    Returns a MarketState in which every producer has args.units units of
+    every product in stock and there are args.carts carts with one unit each.
+    """
+    state = MarketState()
+    state.products = [['Tea', f'Tea {i}', i % 10 + 1, 'Black'] for i in range(args.products)]
+    state.queues = [args.units * args.products + args.carts // args.producers + 1
+                    for _ in range(args.producers)]
+    state.stock = {product_id: dict.fromkeys(range(args.producers), args.units)
+                   for product_id in range(args.products)}
+    state.cart_slots = args.carts
+    state.carts = {cart_id: {cart_id % args.products: {cart_id % args.producers: 1}}
+                   for cart_id in range(args.carts)}
+    return state
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Marketplace journal benchmark")
+    parser.add_argument('--directory', default='.',
+                        help="where the journals are written (a temporary directory "
+                             "is made in it); use a real disk, not a tmpfs")
+    parser.add_argument('--consumers', type=int, default=8)
+    parser.add_argument('--orders', type=int, default=2000, help="orders per consumer")
+    parser.add_argument('--producers', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--units', type=int, default=5,
+                        help="units of every product in the stock of every producer")
+    parser.add_argument('--carts', type=int, default=100000)
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the order and the restore benchmarks and prints their results.
+    """
+    args = parse_args()
+    logging.disable(logging.INFO)
+    directory = tempfile.mkdtemp(dir=args.directory)
+
+    try:
+        print(f'orders/sec {"without a journal":28}: {run_orders(args):.0f}')
+        for sync_orders in (False, True):
+            shutil.rmtree(directory)
+            journal = Journal(directory, sync_orders=sync_orders)
+            orders_per_sec = run_orders(args, journal)
+            journal.close()
+            label = 'with a journal (sync_orders)' if sync_orders else 'with a journal'
+            print(f'orders/sec {label:28}: {orders_per_sec:.0f} '
+                  f'({args.consumers * args.orders / journal.files.syncs:.1f} orders per sync)')
+
+        shutil.rmtree(directory)
+        journal = Journal(directory)
+        journal.close()
+        state = checkpoint_state(args)
+        state.segment = journal.files.segment
+        state.save(f'{directory}/{CHECKPOINT_NAME}')
+
+        start = time.perf_counter()
+        journal = Journal(directory)
+        Marketplace(1, journal=journal)
+        elapsed = time.perf_counter() - start
+        journal.close()
+        entries = sum(len(producers) for producers in state.stock.values())
+        print(f'restored {entries * args.units} queued units ({entries} stock entries) '
+              f'and {len(state.carts)} carts in {elapsed:.3f}s')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Microbenchmark for the Marketplace core: drives the Marketplace directly from
+producer and consumer threads, without any sleeps, and reports the throughput
+and the per-call latency of every workload:
+
+    publish  producers publish, consumers buy one unit for every four published
+    add      consumers fill their carts from a stocked marketplace
+    remove   consumers empty carts filled before the run
+    mixed    producers publish while consumers add two units and remove one
+
+The results can be saved as JSON and compared against a baseline saved by an
+earlier run, e.g.:
+
+    python3 -m bench.micro --save baseline.json
+    (change marketplace.py)
+    python3 -m bench.micro --baseline baseline.json
+
+With --journal, every Marketplace records its changes in a new journal in the
+given directory, so comparing against a baseline run without it measures the
+overhead of the journal. With --readers, that many threads read an inventory
+snapshot every --read-interval seconds while the workload runs, to measure
+their effect on the other methods. E.g. with 5000 products, 2 readers and
+--snapshot-interval 0, add and mixed run about 40% slower than without
+snapshots: the folds take no lock, but they compete for the GIL.
+
+Usage (from the skel directory): python3 -m bench.micro [options]
+"""
+
+import argparse
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from threading import Barrier, Event, Thread
+
+from tema.journal import Journal
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+WORKLOADS = ['publish', 'add', 'remove', 'mixed']
+
+
+def percentile(latencies, fraction):
+    """
+    Returns the percentile of a sorted list of latencies.
+    """
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+class Workload:
+    """
+    Class that runs a workload on a new Marketplace and collects the latency
+    of every call, per method.
+    """
+
+    def __init__(self, name, args):
+        """
+        Constructor
+
+        :type name: String
+        :param name: one of WORKLOADS
+
+        :type args: Namespace
+        :param args: the parsed command line arguments
+        """
+        self.name = name
+        self.args = args
+        self.products = [Tea(name=f'Tea {i}', price=i % 10 + 1, type='Black')
+                         for i in range(args.products)]
+        # large enough for everything the producers publish
+        queue_size = args.queue_size or args.ops * (args.consumers + 1)
+        self.journal = None
+        if args.journal:
+            self.journal = Journal(tempfile.mkdtemp(dir=args.journal))
+        self.marketplace = Marketplace(queue_size, journal=self.journal,
+                                       snapshot_interval=args.snapshot_interval)
+        self.snapshots_read = 0
+        self.producer_ids = [self.marketplace.register_producer()
+                             for _ in range(args.producers)]
+        self.cart_ids = [self.marketplace.new_cart() for _ in range(args.consumers)]
+        self.latencies = {}
+
+    def product(self, i):
+        """
+        Returns the i-th product of the workload.
+        """
+        return self.products[i % len(self.products)]
+
+    def stock(self, units):
+        """
+        Publishes units of every product, spread over the producers.
+        """
+        for i in range(units * len(self.products)):
+            producer_id = self.producer_ids[i % len(self.producer_ids)]
+            self.marketplace.publish(producer_id, self.product(i))
+
+    def timed_calls(self, calls):
+        """
+        Makes the (method name, args) calls and returns their latencies per method.
+        """
+        latencies = {}
+        for method, call_args in calls:
+            function = getattr(self.marketplace, method)
+            start = time.perf_counter_ns()
+            function(*call_args)
+            latencies.setdefault(method, []).append(time.perf_counter_ns() - start)
+        return latencies
+
+    def producer_calls(self, index):
+        """
+        Returns the calls made by a producer thread.
+        """
+        producer_id = self.producer_ids[index]
+        if self.name in ('publish', 'mixed'):
+            return [('publish', (producer_id, self.product(index + i)))
+                    for i in range(self.args.ops)]
+        return []
+
+    def consumer_calls(self, index):
+        """
+        Returns the calls made by a consumer thread.
+        """
+        cart_id = self.cart_ids[index]
+        ops = self.args.ops
+        if self.name == 'publish':
+            return [('add_to_cart', (cart_id, self.product(index + i))) for i in range(ops // 4)]
+        if self.name == 'add':
+            return [('add_to_cart', (cart_id, self.product(index + i))) for i in range(ops)]
+        if self.name == 'remove':
+            return [('remove_from_cart', (cart_id, self.product(index + i)))
+                    for i in range(ops)]
+
+        calls = []
+        for i in range(0, ops - 2, 3):
+            calls.append(('add_to_cart', (cart_id, self.product(index + i))))
+            calls.append(('add_to_cart', (cart_id, self.product(index + i + 1))))
+            calls.append(('remove_from_cart', (cart_id, self.product(index + i))))
+        return calls
+
+    def prepare(self):
+        """
+        Stocks the marketplace (and fills the carts) the workload needs.
+        """
+        ops, consumers = self.args.ops, self.args.consumers
+        if self.name in ('add', 'remove'):
+            self.stock(ops * consumers // len(self.products) + 1)
+        if self.name == 'remove':
+            # put in every cart the units its consumer will remove
+            for index in range(consumers):
+                for _, call_args in self.consumer_calls(index):
+                    self.marketplace.add_to_cart(*call_args)
+
+    def read_snapshots(self, done):
+        """
+        Reads an inventory snapshot every read_interval seconds until done is set.
+        """
+        while not done.wait(self.args.read_interval):
+            self.marketplace.inventory_snapshot()
+            self.snapshots_read += 1
+
+    def run(self):
+        """
+        Runs the workload and returns its results.
+        """
+        self.prepare()
+        calls = [self.producer_calls(i) for i in range(self.args.producers)]
+        calls += [self.consumer_calls(i) for i in range(self.args.consumers)]
+        calls = [thread_calls for thread_calls in calls if thread_calls]
+        barrier = Barrier(len(calls) + 1)
+        results = [None] * len(calls)
+
+        def work(index):
+            barrier.wait()
+            results[index] = self.timed_calls(calls[index])
+
+        threads = [Thread(target=work, args=(i,)) for i in range(len(calls))]
+        done = Event()
+        readers = [Thread(target=self.read_snapshots, args=(done,))
+                   for _ in range(self.args.readers)]
+        for thread in threads + readers:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        for reader in readers:
+            reader.join()
+
+        if self.journal is not None:
+            self.journal.close()
+            shutil.rmtree(self.journal.files.directory)
+
+        for thread_latencies in results:
+            for method, latencies in thread_latencies.items():
+                self.latencies.setdefault(method, []).extend(latencies)
+
+        return self.summary(elapsed)
+
+    def summary(self, elapsed):
+        """
+        Returns the throughput and the p50/p99 latencies, overall and per method.
+        """
+        def stats(latencies):
+            latencies = sorted(latencies)
+            return {'calls': len(latencies),
+                    'p50_ns': percentile(latencies, 0.5),
+                    'p99_ns': percentile(latencies, 0.99)}
+
+        every_call = [latency for latencies in self.latencies.values() for latency in latencies]
+        result = stats(every_call)
+        result['ops_per_sec'] = round(len(every_call) / elapsed)
+        result['methods'] = {method: stats(latencies)
+                             for method, latencies in sorted(self.latencies.items())}
+        if self.args.readers:
+            result['snapshots_read'] = self.snapshots_read
+        return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every workload against the baseline and returns the
+    names of the workloads whose throughput dropped by more than threshold percent.
+    """
+    regressions = []
+    print(f'\n{"workload":10}{"baseline":>14}{"current":>14}{"change":>10}  (ops/sec)')
+    for name, result in results['workloads'].items():
+        if name not in baseline['workloads']:
+            continue
+        before = baseline['workloads'][name]['ops_per_sec']
+        change = 100 * (result['ops_per_sec'] - before) / before
+        print(f'{name:10}{before:14d}{result["ops_per_sec"]:14d}{change:+9.1f}%')
+        if change < -threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Marketplace microbenchmarks")
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--consumers', type=int, default=4)
+    parser.add_argument('--products', type=int, default=16)
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="queue_size_per_producer (large enough for every unit by default)")
+    parser.add_argument('--ops', type=int, default=20000, help="calls per thread")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="run every workload this many times and keep the median run")
+    parser.add_argument('--save', metavar='FILE', help="write the results to FILE as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare the results against the ones saved in FILE")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="the throughput drop (in percent) reported as a regression")
+    parser.add_argument('--journal', metavar='DIR',
+                        help="journal the Marketplaces in (new directories in) DIR")
+    parser.add_argument('--readers', type=int, default=0,
+                        help="threads that read inventory snapshots during the workloads")
+    parser.add_argument('--snapshot-interval', type=float, default=None,
+                        help="the snapshot_interval of the Marketplaces (no snapshots by default)")
+    parser.add_argument('--read-interval', type=float, default=0.001,
+                        help="the seconds every reader waits between two snapshots")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the selected workloads, prints their results and compares them
+    against the baseline. Exits with 1 if any of them regressed.
+    """
+    args = parse_args()
+    logging.disable(logging.INFO)
+
+    results = {'config': {'producers': args.producers, 'consumers': args.consumers,
+                          'products': args.products, 'queue_size': args.queue_size,
+                          'ops': args.ops, 'repeat': args.repeat,
+                          'journal': bool(args.journal), 'readers': args.readers,
+                          'snapshot_interval': args.snapshot_interval,
+                          'read_interval': args.read_interval},
+               'workloads': {}}
+
+    print(f'{"workload":10}{"ops/sec":>12}{"p50 (us)":>10}{"p99 (us)":>10}')
+    for name in args.workloads:
+        # the thread scheduling makes single runs noisy
+        runs = sorted((Workload(name, args).run() for _ in range(args.repeat)),
+                      key=lambda run: run['ops_per_sec'])
+        result = results['workloads'][name] = runs[len(runs) // 2]
+        print(f'{name:10}{result["ops_per_sec"]:12d}'
+              f'{result["p50_ns"] / 1000:10.1f}{result["p99_ns"] / 1000:10.1f}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as results_file:
+            json.dump(results, results_file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            print(f'regressions: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
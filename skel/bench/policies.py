@@ -0,0 +1,153 @@
+"""
+Benchmark for the producer selection policies of add_to_cart: runs the bundled
+scenarios with the sim engine under every policy and reports, averaged over a
+few seeds:
+
+    time     the simulated duration of the run, in seconds
+    units/s  the units bought per simulated second
+    idle     the share of the producers' time spent waiting after a failed
+             publish, i.e. for a free slot in their full queue
+
+A run that stalls (its consumers wait for products whose producers can't
+publish) or doesn't end within --max-time simulated seconds is reported as
+stalled.
+
+Totals over the bundled tests (python3 -m bench.policies --seeds 10):
+
+    policy         time (s)   units/s    idle  stalled
+    most-recent       72.38      56.1   13.8%    0/100
+    oldest-unit       72.25      56.2   12.7%    0/100
+    fullest-queue     73.94      54.9   12.0%    1/100
+    round-robin       71.31      56.9   12.3%    0/100
+
+Taking the units of the producers waiting for a free slot first can still
+stall a run: a freed slot lets its producer publish more of the product it
+was stuck on. Over 100 seeds of tests/08.in and of tests/10.in, most-recent
+stalled in 1, oldest-unit in 8, fullest-queue in 14 and round-robin in none
+of the 200 runs.
+
+Usage (from the skel directory): python3 -m bench.policies [options] [tests]
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+from collections import Counter
+
+from tema.policy import POLICIES
+from tema.scenario import Scenario
+from tema.scripts import market_entities, producer_script
+from tema.sim_marketplace import Stalled, run_market
+
+
+def idle_producers(idle):
+    """
+    Returns a make_producer for run_market whose producers add to idle[name]
+    the time they wait after a publish that failed.
+
+    :type idle: Counter
+    :param idle: producer name -> simulated seconds spent idle
+    """
+    def make_producer(**config):
+        script = producer_script(**config)
+        failed = False
+        value = None
+        while True:
+            step = script.send(value)
+            if isinstance(step, tuple):
+                value = yield step
+                failed = step[0] == 'publish_many' and not value
+            else:
+                if failed:
+                    idle[config['name']] += step
+                value = yield step
+
+    return make_producer
+
+
+def run(market_config, policy, seed, max_time):
+    """
+    Simulates a scenario and returns its duration, the units bought, the time
+    the producers spent idle and whether it stalled.
+    """
+    market_config['marketplace']['selection_policy'] = policy
+    idle = Counter()
+    bought = [0]
+
+    def output(_, lines):
+        bought[0] += sum(count for _, count in lines)
+
+    try:
+        duration = run_market(market_config['marketplace'], market_entities(market_config),
+                              seed, output, max_time, make_producer=idle_producers(idle))
+        stalled = duration >= max_time
+    except Stalled as error:
+        duration, stalled = error.time, True
+    # the last wait of a producer may go past the end of the run
+    idle_time = sum(min(wait, duration) for wait in idle.values())
+    return duration, bought[0], idle_time, stalled
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Producer selection policy benchmark")
+    parser.add_argument('tests', nargs='*', help="the input files (tests/*.in by default)")
+    parser.add_argument('--policies', nargs='+', choices=list(POLICIES), default=list(POLICIES))
+    parser.add_argument('--seeds', type=int, default=3, help="the runs per scenario and policy")
+    parser.add_argument('--max-time', type=float, default=3600,
+                        help="the simulated seconds after which a run counts as stalled")
+    parser.add_argument('--save', metavar='FILE', help="write the results to FILE as JSON")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs every scenario under every policy and prints the results.
+    """
+    args = parse_args()
+    logging.disable(logging.INFO)
+    tests = args.tests or sorted(glob.glob(os.path.join('tests', '*.in')))
+    results = {}
+    # duration, units, idle time, producer time and stalled runs, over all the tests
+    totals = {policy: [0, 0, 0, 0, 0] for policy in args.policies}
+
+    print(f'{"test":8}{"policy":>15}{"time (s)":>10}{"units/s":>10}{"idle":>8}')
+    for test in tests:
+        name = os.path.splitext(os.path.basename(test))[0]
+        market_config = Scenario(test).load()
+        producers = len(market_config['producers'])
+
+        for policy in args.policies:
+            runs = [run(market_config, policy, seed, args.max_time)
+                    for seed in range(args.seeds)]
+            duration = sum(run[0] for run in runs) / len(runs)
+            bought = sum(run[1] for run in runs) / len(runs)
+            idle = sum(run[2] for run in runs) / len(runs) / (producers * duration or 1)
+            stalled = sum(run[3] for run in runs)
+
+            results.setdefault(name, {})[policy] = {'duration': duration, 'units': bought,
+                                                    'idle': idle, 'stalled': stalled}
+            total = totals[policy]
+            for i, value in enumerate((duration, bought, idle * producers * duration,
+                                       producers * duration, stalled)):
+                total[i] += value
+            print(f'{name:8}{policy:>15}{duration:10.2f}{bought / (duration or 1):10.1f}'
+                  f'{idle:8.1%}' + (f'  stalled {stalled}/{len(runs)}' if stalled else ''))
+
+    print(f'\n{"policy":15}{"time (s)":>10}{"units/s":>10}{"idle":>8}{"stalled":>9}')
+    for policy, (duration, bought, idle, producer_time, stalled) in totals.items():
+        print(f'{policy:15}{duration:10.2f}{bought / (duration or 1):10.1f}'
+              f'{idle / (producer_time or 1):8.1%}{stalled:5d}/{len(tests) * args.seeds}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as results_file:
+            json.dump(results, results_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark for the multi-process engine: runs a synthetic market without any
+waits and reports the orders per second for an increasing number of worker
+processes, with the stock split across as many shard processes.
+
+Usage (from the skel directory): python3 -m bench.processes [consumers]
+"""
+
+import logging
+import multiprocessing
+import sys
+import time
+
+from tema.mp_marketplace import run_market
+from tema.product import Tea
+
+PRODUCTS = 20
+PRODUCERS = 16
+CARTS_PER_CONSUMER = 2
+
+
+def build_market(consumers):
+    """
+    Returns a market configuration with no wait times.
+    """
+    products = [Tea(name=f'Tea {i}', price=i % 10 + 1, type='Black') for i in range(PRODUCTS)]
+
+    return {
+        'marketplace': {'queue_size_per_producer': 1000},
+        'producers': [{'name': f'prod{i}', 'products': [(p, 50, 0) for p in products],
+                       'republish_wait_time': 0} for i in range(PRODUCERS)],
+        'consumers': [{'name': f'cons{i}', 'retry_wait_time': 0.005,
+                       'carts': [[{'type': 'add', 'product': products[(i + j + k) % PRODUCTS],
+                                   'quantity': 2} for k in range(3)]
+                                 for j in range(CARTS_PER_CONSUMER)]}
+                      for i in range(consumers)],
+    }
+
+
+def main():
+    """
+    Runs the market with 1, 2, 4, ... worker (and shard) processes and prints the
+    throughput.
+    """
+    consumers = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    logging.disable(logging.INFO)
+
+    workers = 1
+    print('workers shards   orders/sec')
+    while workers <= max(8, multiprocessing.cpu_count()):
+        market_config = build_market(consumers)
+        start = time.perf_counter()
+        run_market(market_config, workers, output=lambda name, lines: None, shards=workers)
+        elapsed = time.perf_counter() - start
+
+        print(f'{workers:7d} {workers:6d} {consumers * CARTS_PER_CONSUMER / elapsed:12.0f}')
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Throughput benchmark for the Marketplace server: a server process serves a
+stocked Marketplace on localhost and a client adds units to a cart and removes
+them again, one call at a time or pipelined:
+
+    sequential  a single thread waits for every response before the next call
+    pipelined   a single thread sends the calls in batches with submit()
+    threads     many threads make blocking calls over a pool of connections
+
+Usage (from the skel directory): python3 -m bench.rpc [options]
+"""
+
+import argparse
+import logging
+import multiprocessing
+import time
+from threading import Thread
+
+from tema.marketplace import Marketplace
+from tema.product import Tea
+from tema.rpc import MarketplaceClient, MarketplaceServer
+
+MODES = ['sequential', 'pipelined', 'threads']
+TEA = Tea(name='Tea', price=1, type='Black')
+
+
+def serve(addresses, units):
+    """
+    Serves a Marketplace with units of TEA in stock, in the server process.
+    """
+    logging.disable(logging.INFO)
+    marketplace = Marketplace(units)
+    marketplace.publish_many(marketplace.register_producer(), TEA, units)
+    server = MarketplaceServer(marketplace)
+    addresses.put(server.server_address)
+    server.serve_forever()
+
+
+def calls(cart_id, count):
+    """
+    Returns count calls that add a unit to the cart and remove it, in turns.
+    """
+    return [('add_many_to_cart', cart_id, TEA, 1) if i % 2 == 0
+            else ('remove_many_from_cart', cart_id, TEA, 1) for i in range(count)]
+
+
+def run(mode, address, args):
+    """
+    Makes args.calls calls in the given mode and returns the calls per second.
+    """
+    client = MarketplaceClient(address, 1 if mode != 'threads' else args.connections)
+    threads = args.threads if mode == 'threads' else 1
+    cart_ids = [client.new_cart() for _ in range(threads)]
+    client.product_id(TEA)
+
+    def work(cart_id):
+        thread_calls = calls(cart_id, args.calls // threads)
+        if mode == 'pipelined':
+            for i in range(0, len(thread_calls), args.batch):
+                for future in client.submit(thread_calls[i:i + args.batch]):
+                    future.result()
+        else:
+            for call in thread_calls:
+                client.call(*call)
+
+    workers = [Thread(target=work, args=(cart_id,)) for cart_id in cart_ids]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    client.close()
+    return args.calls // threads * threads / elapsed
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Marketplace server benchmark")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=100,
+                        help="calls sent at once in the pipelined mode")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--connections', type=int, default=4,
+                        help="connections shared by the threads in the threads mode")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Starts the server and runs the selected modes against it.
+    """
+    args = parse_args()
+    addresses = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(addresses, args.threads + 1),
+                                     daemon=True)
+    server.start()
+    address = addresses.get()
+
+    print(f'{"mode":12}{"calls/sec":>12}')
+    for mode in args.modes:
+        print(f'{mode:12}{run(mode, address, args):12.0f}')
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
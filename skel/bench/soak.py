@@ -0,0 +1,58 @@
+"""
+Soak benchmark for the cart lifecycle: places millions of orders on a single
+Marketplace, abandoning one cart out of every hundred, and reports the peak
+memory and the number of cart slots as it goes. Both should stay flat: the
+ordered carts are freed, their ids are recycled and the abandoned carts are
+expired.
+
+Usage (from the skel directory): python3 -m bench.soak [orders]
+"""
+
+import logging
+import resource
+import sys
+import time
+
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+PRODUCTS = 20
+REPORT_INTERVAL = 200000
+ABANDON_INTERVAL = 100
+# the abandoned carts expire quickly, so that the soak doesn't have to wait for them
+MAX_IDLE = 0.05
+
+
+def main():
+    """
+    Places the orders and prints the memory and cart statistics.
+    """
+    orders = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    logging.disable(logging.INFO)
+
+    marketplace = Marketplace(10)
+    producer_id = marketplace.register_producer()
+    products = [Tea(name=f'Tea {i}', price=i, type='Black') for i in range(PRODUCTS)]
+
+    print(f'{"orders":>10}{"orders/sec":>12}{"max rss (MB)":>14}{"cart slots":>12}{"expired":>9}')
+    start = time.perf_counter()
+    expired = 0
+    for i in range(1, orders + 1):
+        product = products[i % PRODUCTS]
+        cart_id = marketplace.new_cart()
+        marketplace.publish_many(producer_id, product, 2)
+        marketplace.add_many_to_cart(cart_id, product, 2)
+
+        if i % ABANDON_INTERVAL:
+            marketplace.place_order_lines(cart_id)
+
+        if i % REPORT_INTERVAL == 0:
+            time.sleep(MAX_IDLE)
+            expired += marketplace.expire_carts(MAX_IDLE)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+            print(f'{i:10d}{i / (time.perf_counter() - start):12.0f}{rss:14d}'
+                  f'{len(marketplace.carts):12d}{expired:9d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Stress benchmark for the Marketplace locking: every thread publishes and buys
+its own products and the add/publish throughput is reported for an increasing
+number of threads, with a single lock and with lock striping.
+
+Usage (from the skel directory): python3 -m bench.stress [ops_per_thread]
+"""
+
+import logging
+import sys
+import time
+from threading import Thread
+
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+THREAD_COUNTS = [1, 2, 4, 8, 16]
+STRIPE_COUNTS = [1, 16]
+PRODUCTS_PER_THREAD = 4
+
+
+def worker(marketplace, index, ops):
+    """
+    Publishes and buys ops units of the thread's own products.
+    """
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+    products = [Tea(name=f'Tea {index}-{i}', price=i, type='Black')
+                for i in range(PRODUCTS_PER_THREAD)]
+
+    for i in range(ops):
+        product = products[i % PRODUCTS_PER_THREAD]
+        marketplace.publish(producer_id, product, block=True)
+        marketplace.add_to_cart(cart_id, product)
+
+
+def run(threads, stripes, ops):
+    """
+    Returns the number of add/publish calls per second for the given configuration.
+    """
+    marketplace = Marketplace(PRODUCTS_PER_THREAD, lock_stripes=stripes)
+    workers = [Thread(target=worker, args=(marketplace, i, ops)) for i in range(threads)]
+
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return 2 * threads * ops / elapsed
+
+
+def main():
+    """
+    Runs every configuration and prints a throughput table.
+    """
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logging.disable(logging.INFO)
+
+    print('threads ' + ''.join(f'{f"stripes={s}":>16}' for s in STRIPE_COUNTS) + '  (ops/sec)')
+    for threads in THREAD_COUNTS:
+        row = ''.join(f'{run(threads, stripes, ops):16.0f}' for stripes in STRIPE_COUNTS)
+        print(f'{threads:7d} {row}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,109 @@
 """
 This module checks that the homework's solution output is correct
 
+The output and the reference are read as streams and compared as multisets of
+(consumer, product) pairs, so the memory used depends only on the number of
+distinct pairs, not on the number of units bought. The reference can be either
+the sorted output (one 'consumer bought product' line for every unit) or the
+aggregated format, with one 'consumer, product, count' line for every pair.
+
+Usage: check_test.py testname output_filepath ref_filepath
+       check_test.py --aggregate ref_filepath (prints the aggregated reference)
+
 Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-import subprocess
 import sys
+from collections import Counter
+
+
+def count_output(lines):
+    """
+    Returns a Counter with the number of units of each (consumer, product) pair.
+
+    :type lines: Iterable
+    :param lines: 'consumer bought product' lines
+    """
+    counts = Counter()
+    for line in lines:
+        line = line.strip()
+        if line:
+            consumer, _, product = line.partition(' bought ')
+            counts[consumer, product] += 1
+    return counts
+
+
+def count_reference(lines):
+    """
+    Returns a Counter with the number of units of each (consumer, product) pair.
+
+    :type lines: Iterable
+    :param lines: 'consumer bought product' or 'consumer, product, count' lines
+    """
+    counts = Counter()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if ' bought ' in line:
+            consumer, _, product = line.partition(' bought ')
+            counts[consumer, product] += 1
+        else:
+            consumer, rest = line.split(', ', 1)
+            product, count = rest.rsplit(', ', 1)
+            counts[consumer, product] += int(count)
+    return counts
+
+
+def format_reference(counts):
+    """
+    Yields the aggregated reference lines of a Counter, sorted.
+    """
+    for (consumer, product), count in sorted(counts.items()):
+        yield f"{consumer}, {product}, {count}"
+
+
+def check_output(output, ref):
+    """
+    Returns True if the output of a test has the same units as the reference.
+
+    :type output: String
+    :param output: the output of the test
+
+    :type ref: String
+    :param ref: the reference, in either format
+    """
+    return count_output(output.splitlines()) == count_reference(ref.splitlines())
 
 
 def main():
+    """
+    Compares the output of a test with its reference, or prints the aggregated
+    reference with --aggregate.
+    """
+    if len(sys.argv) == 3 and sys.argv[1] == "--aggregate":
+        with open(sys.argv[2], encoding='utf-8') as ref_file:
+            for line in format_reference(count_reference(ref_file)):
+                print(line)
+        return
+
     if len(sys.argv) != 4:
-        print("Invalid number of arguments\nUsage: check_test.py testname output_filepath ref_filepath")
+        print("Invalid number of arguments\n"
+              "Usage: check_test.py testname output_filepath ref_filepath")
         return
 
     testname = sys.argv[1]
     output_filename = sys.argv[2]
     ref_filename = sys.argv[3]
-    # load the lines from the output file and sort them
-    with open(output_filename) as output_file:
-        output_lines = output_file.read()
-
-    output_lines = output_lines.split(")")  # sometimes there is no new line between consumer outputs
-    output_lines = [line.strip() + ")" for line in output_lines if len(line.strip()) > 0]
-
-    output_lines.sort()
-
-    sorted_output_filename = output_filename + ".sorted"
 
-    # write to input file (tests/{test_name}.in)
-    with open(sorted_output_filename, 'w') as sorted_output_file:
-        for line in output_lines:
-            print(line, file=sorted_output_file)
+    with open(output_filename, encoding='utf-8') as output_file:
+        output_counts = count_output(output_file)
 
-    command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
-    out, err = command.communicate()
+    with open(ref_filename, encoding='utf-8') as ref_file:
+        ref_counts = count_reference(ref_file)
 
-    if len(out) == 0:
+    if output_counts == ref_counts:
         print(f"Test {testname}" + ":\t\t" + "PASSED")
     else:
         print(f"Test {testname}" + ":\t\t" + "FAILED")
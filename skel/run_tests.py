@@ -0,0 +1,96 @@
+"""
+This module runs the test scenarios concurrently and checks their output
+
+Every test runs test.py in its own process, with the same timeouts as
+run_tests.sh, and its output is checked in memory. The processes are started
+by a pool of threads, which only wait for them. The results are printed in the
+format expected by parse.awk, followed by the wall-clock time of each test.
+
+Usage: python3 run_tests.py [--engine ENGINE] [--jobs N] [test numbers]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from check_test import check_output
+
+TESTS = 'tests'
+TEST_COUNT = 10
+
+
+def timeout(test):
+    """
+    Returns the maximum number of seconds the test is allowed to run.
+    """
+    return 60 if test > 8 else 30
+
+
+def run_test(test, engine):
+    """
+    Runs a test and checks its output.
+
+    :returns a (passed, timed out, elapsed seconds) tuple
+    """
+    prefix = f'{TESTS}/{test:02d}'
+    with tempfile.TemporaryDirectory() as log_dir:
+        # the tests that run at the same time must not share the log file
+        command = [sys.executable, 'test.py', '--engine', engine,
+                   '--log-file', os.path.join(log_dir, 'marketplace.log'), f'{prefix}.in']
+        start = time.perf_counter()
+        try:
+            output = subprocess.run(command, stdout=subprocess.PIPE, text=True,
+                                    timeout=timeout(test), check=False).stdout
+        except subprocess.TimeoutExpired:
+            return False, True, time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+
+    with open(f'{prefix}.ref.out', encoding='utf-8') as ref_file:
+        return check_output(output, ref_file.read()), False, elapsed
+
+
+def parse_input():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tests', nargs='*', type=int, default=range(1, TEST_COUNT + 1),
+                        help="the numbers of the tests to run (all by default)")
+    parser.add_argument('--engine', default='threads',
+                        help="the engine passed to test.py")
+    parser.add_argument('--jobs', type=int, default=TEST_COUNT,
+                        help="the number of tests run at the same time")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+        Run the tests and print their results in order
+    """
+    args = parse_input()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(args.jobs) as executor:
+        results = [(test, executor.submit(run_test, test, args.engine)) for test in args.tests]
+
+        for test, result in results:
+            passed, timed_out, elapsed = result.result()
+            if timed_out:
+                print(f"TIMEOUT. Test {test} exceeded maximum allowed time of {timeout(test)}")
+            print(f"Test {test}:\t\t{'PASSED' if passed else 'FAILED'}\t({elapsed:.2f}s)",
+                  flush=True)
+
+    print(f"\nTotal time: {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
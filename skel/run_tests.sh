@@ -4,6 +4,8 @@ SRC=tema
 TESTS=tests
 OUT=out
 PYTHON_CMD=python3
+# threads, asyncio, processes, sim or pool
+ENGINE=threads
 
 for i in {1..8}
 do
@@ -24,7 +26,7 @@ do
     rm -f "${TESTS}/$prefix".out
     echo "Starting test $i"
 
-    timeout ${TIMEOUT_VALS[i]} ${PYTHON_CMD} test.py "${TESTS}/$prefix.in" > "${TESTS}/$prefix.out"
+    timeout ${TIMEOUT_VALS[i]} ${PYTHON_CMD} test.py --engine ${ENGINE} "${TESTS}/$prefix.in" > "${TESTS}/$prefix.out"
     if [ ! $? -eq 0 ]
     then
         echo "TIMEOUT. Test $i exceeded maximum allowed time of ${TIMEOUT_VALS[i]}"
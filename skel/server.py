@@ -0,0 +1,59 @@
+"""
+This module serves a Marketplace over TCP, for producers and consumers that use
+a tema.rpc.MarketplaceClient instead of a Marketplace
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import logging
+
+from tema.marketplace import Marketplace
+from tema.marketplace_log import DEFAULT_LOG_PATH, setup_logging
+from tema.policy import DEFAULT_POLICY, POLICIES
+from tema.rpc import MarketplaceServer
+
+
+def parse_input():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('queue_size_per_producer', type=int,
+                        help="the maximum size of the queue of every producer")
+    parser.add_argument('--host', default='127.0.0.1', help="the address to listen on")
+    parser.add_argument('--port', type=int, default=7000, help="the port to listen on")
+    parser.add_argument('--lock-stripes', type=int, default=16,
+                        help="the number of locks the products and the carts are split into")
+    parser.add_argument('--policy', choices=list(POLICIES), default=DEFAULT_POLICY,
+                        help="how add_to_cart chooses the producer to take a product from "
+                             "when several have it")
+    parser.add_argument('--log-file', default=DEFAULT_LOG_PATH,
+                        help="the file the marketplace logs are written to")
+    parser.add_argument('--log-level', default='INFO',
+                        help="the level of the marketplace logs (e.g. INFO, WARNING)")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+        Serve a new Marketplace until interrupted
+    """
+    args = parse_input()
+    setup_logging(args.log_file, logging.getLevelName(args.log_level.upper()))
+
+    marketplace = Marketplace(args.queue_size_per_producer, args.lock_stripes,
+                              selection_policy=args.policy)
+    with MarketplaceServer(marketplace, (args.host, args.port)) as server:
+        print(f'serving on {server.server_address[0]}:{server.server_address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
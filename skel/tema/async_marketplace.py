@@ -0,0 +1,269 @@
+"""
+This module represents the asyncio engine of the Marketplace: an async facade
+over the Marketplace and coroutine based producers and consumers.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import asyncio
+import inspect
+import io
+import unittest
+from collections import deque
+from contextlib import redirect_stdout
+
+from tema.cart import CartExpired
+from tema.product import Tea
+from tema.scripts import (check_sample_orders, consumer_script, drive, execute,
+                          market_entities, print_order, producer_script, sample_market)
+from tema.timed_marketplace import create_marketplace
+
+
+class AsyncMarketplace:
+    """
+    Class that exposes the Marketplace to coroutines. Instead of blocking the
+    thread, a coroutine that finds a product out of stock (or its queue full)
+    awaits a future that is resolved as soon as the product is published
+    (or a slot is freed). All the coroutines must run on the same event loop.
+    """
+
+    def __init__(self, marketplace):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace that holds the products and the carts
+        """
+        self.marketplace = marketplace
+        # consumers waiting for a product, in FIFO order
+        self.product_waiters = {}
+        # producers waiting for a free slot in their queue
+        self.space_waiters = {}
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        return self.marketplace.register_producer()
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer and returns its id.
+        """
+        return self.marketplace.new_cart()
+
+    async def publish_many(self, producer_id, product, quantity):
+        """
+        Publishes as many units of the product as fit in the producer's queue,
+        waiting for a free slot if the queue is full.
+
+        :returns the number of units published (at least 1)
+        """
+        while True:
+            count = self.marketplace.publish_many(producer_id, product, quantity)
+            if count > 0:
+                self._wake_consumers(product, count)
+                return count
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.space_waiters[producer_id] = waiter
+            await waiter
+
+    async def add_many_to_cart(self, cart_id, product, quantity):
+        """
+        Adds as many units of the product as are available to the cart,
+        waiting for the product to be published if it is out of stock.
+
+        :returns the number of units added (at least 1)
+        """
+        while True:
+            count = self.marketplace.add_many_to_cart(cart_id, product, quantity)
+            if count > 0:
+                self._wake_producers()
+                return count
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.product_waiters.setdefault(product, deque()).append(waiter)
+            await waiter
+
+    def remove_many_from_cart(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of the product from the cart.
+
+        :returns the number of units removed
+        """
+        count = self.marketplace.remove_many_from_cart(cart_id, product, quantity)
+        self._wake_consumers(product, count)
+        return count
+
+    def place_order_lines(self, cart_id):
+        """
+        Returns a list of (product, count) pairs, one for every product in the cart.
+        """
+        return self.marketplace.place_order_lines(cart_id)
+
+    def _wake_consumers(self, product, count):
+        """
+        Wakes up (in FIFO order) at most count consumers waiting for the product.
+        """
+        waiters = self.product_waiters.get(product)
+        while waiters and count > 0:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                count -= 1
+
+        if waiters is not None and not waiters:
+            del self.product_waiters[product]
+
+    def _wake_producers(self):
+        """
+        Wakes up the producers waiting for a slot that is now free.
+        """
+        capacity = self.marketplace.queue_size_per_producer
+        for producer_id, waiter in list(self.space_waiters.items()):
+            if self.marketplace.inventory.queue_size(producer_id) < capacity:
+                del self.space_waiters[producer_id]
+                if not waiter.done():
+                    waiter.set_result(None)
+
+
+async def run_script(marketplace, script, output=print_order):
+    """
+    Runs a producer or consumer script (see tema.scripts) as a coroutine.
+
+    The calls go to the async marketplace, whose add_many_to_cart and
+    publish_many wait for the product (or the free slot) instead of returning
+    0, so the scripts never need to poll.
+
+    :type marketplace: AsyncMarketplace
+    :param marketplace: a reference to the async marketplace
+
+    :type script: Generator
+    :param script: the script
+
+    :type output: Function
+    :param output: the function that prints an order
+    """
+    def call(step):
+        # all the scripts share the thread, so the orders can't get tangled
+        value = execute(marketplace, step, output)
+        if inspect.isawaitable(value):
+            value = yield value
+        return value
+
+    steps = drive(script, call)
+    value = None
+    while True:
+        try:
+            step = steps.send(value)
+        except StopIteration:
+            return
+
+        value = None
+        if inspect.isawaitable(step):
+            try:
+                value = await step
+            except CartExpired:
+                # like execute(), so the script starts the cart over
+                pass
+        else:
+            await asyncio.sleep(step)
+
+
+async def run_market(marketplace_config, entities, output=print_order):
+    """
+    Runs producers and consumers until all the consumers are done.
+
+    :type marketplace_config: Dict
+    :param marketplace_config: the arguments of the Marketplace
+
+    :type entities: Iterable
+    :param entities: ('producers', configuration) and ('consumers', configuration)
+    pairs, like the ones streamed by Scenario.stream(); every script is started
+    as soon as it is read
+
+    :type output: Function
+    :param output: the function that prints an order
+    """
+    marketplace = AsyncMarketplace(create_marketplace(**marketplace_config))
+
+    producer_tasks = []
+    consumer_tasks = []
+    try:
+        for key, config in entities:
+            if key == 'producers':
+                producer_tasks.append(asyncio.create_task(
+                    run_script(marketplace, producer_script(**config))))
+            else:
+                consumer_tasks.append(asyncio.create_task(
+                    run_script(marketplace, consumer_script(**config), output)))
+            # run the new script up to its first wait before reading the next one
+            await asyncio.sleep(0)
+
+        await asyncio.gather(*consumer_tasks)
+    finally:
+        for task in producer_tasks:
+            task.cancel()
+        await asyncio.gather(*producer_tasks, return_exceptions=True)
+
+
+class TestAsyncMarketplace(unittest.TestCase):
+    """
+    Class for testing the asyncio engine
+    """
+
+    def test_run_market(self):
+        market_config = sample_market()
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            asyncio.run(run_market(market_config['marketplace'], market_entities(market_config)))
+
+        check_sample_orders(self, market_config, output.getvalue())
+
+    def test_wait_for_stock(self):
+        marketplace = AsyncMarketplace(create_marketplace(5))
+        tea = Tea(name='Test', price=12, type='test type')
+
+        async def buy():
+            producer_id = marketplace.register_producer()
+            cart_id = marketplace.new_cart()
+            add = asyncio.create_task(marketplace.add_many_to_cart(cart_id, tea, 2))
+
+            # the consumer waits on a future, without polling the marketplace
+            await asyncio.sleep(0)
+            self.assertFalse(add.done())
+            self.assertEqual(len(marketplace.product_waiters[tea]), 1)
+
+            # the publish wakes it up with the units available
+            self.assertEqual(await marketplace.publish_many(producer_id, tea, 1), 1)
+            self.assertEqual(await add, 1)
+            self.assertNotIn(tea, marketplace.product_waiters)
+            return marketplace.place_order_lines(cart_id)
+
+        self.assertEqual(asyncio.run(buy()), [(tea, 1)])
+
+    def test_many_consumers(self):
+        tea = Tea(name='Test', price=12, type='test type')
+        consumers = 70000
+        market_config = {
+            'marketplace': {'queue_size_per_producer': 1000},
+            'producers': [{'products': [(tea, 1000, 0)], 'republish_wait_time': 0}],
+            'consumers': [{'name': f'cons{i}', 'retry_wait_time': 0,
+                           'carts': [[{'type': 'add', 'product': tea, 'quantity': 1}]]}
+                          for i in range(consumers)],
+        }
+        orders = []
+
+        # most of the consumers wait for the tea at once, each with a cart open
+        asyncio.run(run_market(market_config['marketplace'], market_entities(market_config),
+                               lambda name, lines: orders.append(lines)))
+        self.assertEqual(len(orders), consumers)
+        self.assertTrue(all(lines == [(tea, 1)] for lines in orders))
+
+
+if __name__ == '__main__':
+    unittest.main()
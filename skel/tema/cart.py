@@ -0,0 +1,271 @@
+"""
+This module represents the Cart used by the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import time
+import unittest
+from collections import OrderedDict
+
+# a cart id packs the slot of the cart in Marketplace.carts (the low bits) with
+# the number of times the slot was reused (the high bits), so the id of an
+# ordered (or expired) cart doesn't reach the cart that gets the slot next; the
+# ids fit the 64 bit ints of the journal and the RPC calls, so the generations
+# wrap around, but only after a slot is reused 2**31 times
+CART_SLOT_BITS = 32
+CART_SLOT_MASK = (1 << CART_SLOT_BITS) - 1
+CART_GENERATIONS = 1 << (63 - CART_SLOT_BITS)
+
+
+def take_units(producers, quantity, choose):
+    """
+    Removes up to quantity units from a dict with the number of units of each
+    producer, one producer at a time.
+
+    :type producers: Dict
+    :param producers: the number of units of each producer, updated in place
+
+    :type quantity: Int
+    :param quantity: the maximum number of units to remove
+
+    :type choose: Function
+    :param choose: called with producers, returns the producer to remove units from next
+
+    :returns a list of (producer_id, count) pairs with the units removed from
+    each producer
+    """
+    taken = []
+    while producers and quantity > 0:
+        producer_id = choose(producers)
+        count = min(quantity, producers[producer_id])
+        if producers[producer_id] == count:
+            del producers[producer_id]
+        else:
+            producers[producer_id] -= count
+
+        taken.append((producer_id, count))
+        quantity -= count
+    return taken
+
+
+class CartExpired(KeyError):
+    """
+    Raised for the id of a cart that has been ordered or has expired.
+    """
+
+
+def next_cart_id(cart_id):
+    """
+    Returns the id of the next cart that gets the slot of the given one.
+
+    :type cart_id: Int
+    :param cart_id: the id of a freed cart
+    """
+    generation = ((cart_id >> CART_SLOT_BITS) + 1) % CART_GENERATIONS
+    return generation << CART_SLOT_BITS | cart_id & CART_SLOT_MASK
+
+
+class Cart:
+    """
+    Class that represents a consumer's cart as a multiset: for every product it
+    keeps the number of units taken from each producer, so adding and removing
+    units doesn't depend on the size of the cart.
+    """
+
+    def __init__(self, cart_id=0):
+        """
+        Constructor
+
+        :type cart_id: Int
+        :param cart_id: the id of the cart
+        """
+        self.cart_id = cart_id
+        self.units = {}
+        self.size = 0
+        # when units were last added or removed, used to expire abandoned carts
+        self.last_used = time.monotonic()
+
+    def add(self, product_id, producer_id, count=1):
+        """
+        Adds units of the product taken from the producer.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type producer_id: Int
+        :param producer_id: the producer the units were taken from
+
+        :type count: Int
+        :param count: the number of units
+        """
+        producers = self.units.get(product_id)
+        if producers is None:
+            producers = self.units[product_id] = {}
+
+        producers[producer_id] = producers.get(producer_id, 0) + count
+        self.size += count
+        self.last_used = time.monotonic()
+
+    def remove(self, product_id, quantity=1):
+        """
+        Removes up to quantity units of the product, the most recently added first.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type quantity: Int
+        :param quantity: the maximum number of units to remove
+
+        :returns a list of (producer_id, count) pairs with the units removed
+        for each producer, empty if the product is not in the cart
+        """
+        producers = self.units.get(product_id)
+        self.last_used = time.monotonic()
+        if producers is None:
+            return []
+
+        removed = take_units(producers, quantity, lambda units: next(reversed(units)))
+        self.size -= sum(count for _, count in removed)
+        if not producers:
+            del self.units[product_id]
+
+        return removed
+
+    def clear(self):
+        """
+        Removes all the units from the cart.
+
+        :returns a list of (product_id, producer_id, count) tuples with the units removed
+        """
+        removed = [(product_id, producer_id, count)
+                   for product_id, producers in self.units.items()
+                   for producer_id, count in producers.items()]
+        self.units = {}
+        self.size = 0
+        return removed
+
+    def lines(self):
+        """
+        Returns a list of (product_id, count) pairs, one for every product in the cart.
+        """
+        return [(product_id, sum(producers.values()))
+                for product_id, producers in self.units.items()]
+
+    def __len__(self):
+        return self.size
+
+
+class CartStripe:
+    """
+    Class that represents the carts that share a lock. It keeps the ones in
+    use least recently used first, so the abandoned carts are found without
+    looking at the others.
+    """
+
+    def __init__(self, lock):
+        """
+        Constructor
+
+        :type lock: Lock
+        :param lock: the lock that guards the carts
+        """
+        self.lock = lock
+        # cart_id -> Cart, in the order the carts were last used
+        self.active = OrderedDict()
+
+    def add(self, cart):
+        """
+        Starts keeping track of a new cart.
+        """
+        self.active[cart.cart_id] = cart
+
+    def touch(self, cart):
+        """
+        Marks the cart as the most recently used.
+        """
+        self.active.move_to_end(cart.cart_id)
+
+    def discard(self, cart):
+        """
+        Stops keeping track of an ordered (or expired) cart.
+        """
+        del self.active[cart.cart_id]
+
+    def idle(self, deadline):
+        """
+        Returns the carts last used before the deadline.
+
+        :type deadline: Float
+        :param deadline: a time.monotonic() value
+        """
+        idle = []
+        for cart in self.active.values():
+            if cart.last_used > deadline:
+                break
+            idle.append(cart)
+        return idle
+
+
+class TestCart(unittest.TestCase):
+    """
+    Class for testing the Cart module
+    """
+
+    def test_add(self):
+        cart = Cart()
+        cart.add(0, 1)
+        cart.add(0, 2, 3)
+        cart.add(1, 1)
+
+        self.assertEqual(len(cart), 5)
+        self.assertEqual(cart.lines(), [(0, 4), (1, 1)])
+
+    def test_remove(self):
+        cart = Cart()
+        self.assertEqual(cart.remove(0), [])
+
+        cart.add(0, 1, 2)
+        cart.add(0, 2, 3)
+        self.assertEqual(cart.remove(0, 4), [(2, 3), (1, 1)])
+        self.assertEqual(cart.remove(0, 4), [(1, 1)])
+        self.assertEqual(cart.remove(0), [])
+        self.assertEqual(len(cart), 0)
+        self.assertEqual(cart.lines(), [])
+
+    def test_clear(self):
+        cart = Cart()
+        cart.add(0, 1, 2)
+        cart.add(1, 2)
+
+        self.assertEqual(cart.clear(), [(0, 1, 2), (1, 2, 1)])
+        self.assertEqual(len(cart), 0)
+        self.assertEqual(cart.clear(), [])
+
+    def test_next_cart_id(self):
+        cart_id = next_cart_id(5)
+        self.assertEqual(cart_id & CART_SLOT_MASK, 5)
+        self.assertNotEqual(cart_id, 5)
+
+        # the generations wrap around, the ids stay positive 64 bit ints
+        cart_id = (CART_GENERATIONS - 1) << CART_SLOT_BITS | 5
+        self.assertLess(cart_id, 1 << 63)
+        self.assertEqual(next_cart_id(cart_id), 5)
+
+    def test_cart_stripe(self):
+        stripe = CartStripe(None)
+        carts = [Cart(cart_id) for cart_id in range(3)]
+        for cart in carts:
+            stripe.add(cart)
+
+        carts[0].last_used = carts[2].last_used + 1
+        stripe.touch(carts[0])
+        stripe.discard(carts[1])
+        self.assertEqual(stripe.idle(carts[2].last_used), [carts[2]])
+        self.assertEqual(stripe.idle(carts[0].last_used), [carts[2], carts[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+This module represents the product catalog of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import unittest
+from threading import Lock
+
+from tema.product import Coffee, Tea
+
+
+class ProductCatalog:
+    """
+    Class that interns every distinct product once and gives it a compact integer
+    id, so that the Marketplace can store and compare ids instead of products.
+    """
+
+    def __init__(self, on_intern=None):
+        """
+        Constructor
+
+        :type on_intern: Function
+        :param on_intern: if given, called with the id and the product every time
+        a new product is registered (with the lock held, so in id order)
+        """
+        self.ids = {}
+        self.products = []
+        self.lock = Lock()
+        self.on_intern = on_intern
+
+    def intern(self, product):
+        """
+        Returns the id of the product, registering it on first use.
+
+        :type product: Product
+        :param product: the product
+        """
+        product_id = self.ids.get(product)
+        if product_id is None:
+            with self.lock:
+                # another thread might have registered it in the meanwhile
+                product_id = self.ids.get(product)
+                if product_id is None:
+                    product_id = len(self.products)
+                    self.products.append(product)
+                    self.ids[product] = product_id
+                    if self.on_intern is not None:
+                        self.on_intern(product_id, product)
+
+        return product_id
+
+    def product(self, product_id):
+        """
+        Returns the (interned) product with the given id.
+
+        :type product_id: Int
+        :param product_id: product id
+        """
+        return self.products[product_id]
+
+    def __len__(self):
+        return len(self.products)
+
+
+class TestProductCatalog(unittest.TestCase):
+    """
+    Class for testing the ProductCatalog module
+    """
+
+    def test_intern(self):
+        catalog = ProductCatalog()
+        tea = Tea(name='Test', price=12, type='test type')
+        coffee = Coffee(name='Test', price=12, acidity='test type', roast_level='MEDIUM')
+
+        self.assertEqual(catalog.intern(tea), 0)
+        self.assertEqual(catalog.intern(coffee), 1)
+        self.assertEqual(catalog.intern(Tea(name='Test', price=12, type='test type')), 0)
+        self.assertIs(catalog.product(0), tea)
+        self.assertEqual(len(catalog), 2)
+
+    def test_on_intern(self):
+        interned = []
+        catalog = ProductCatalog(lambda *args: interned.append(args))
+        tea = Tea(name='Test', price=12, type='test type')
+
+        catalog.intern(tea)
+        catalog.intern(tea)
+        self.assertEqual(interned, [(0, tea)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,35 @@ March 2021
 """
 
 from threading import Thread
-from time import sleep
+from time import perf_counter_ns
+
+from tema.cart import CartExpired
+
+
+def format_order(name, lines):
+    """
+    Returns the text printed for an order, one line for every unit bought.
+
+    :type name: String
+    :param name: the consumer's name
+
+    :type lines: List
+    :param lines: a list of (product, count) pairs
+    """
+    return ''.join(f'{name} bought {product}\n' * count for product, count in lines)
+
+
+def print_order(name, lines):
+    """
+    Prints what the consumer bought.
+
+    :type name: String
+    :param name: the consumer's name
+
+    :type lines: List
+    :param lines: a list of (product, count) pairs
+    """
+    print(format_order(name, lines), end='')
 
 
 class Consumer(Thread):
@@ -15,7 +43,8 @@ class Consumer(Thread):
     Class that represents a consumer.
     """
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, output=None, metrics=None,
+                 **kwargs):
         """
         Constructor.
 
@@ -26,8 +55,17 @@ class Consumer(Thread):
         :param marketplace: a reference to the marketplace
 
         :type retry_wait_time: Time
-        :param retry_wait_time: the number of seconds that a producer must wait
-        until the Marketplace becomes available
+        :param retry_wait_time: the maximum number of seconds that a consumer waits
+        for a product to be published before retrying
+
+        :type output: Function
+        :param output: the function that writes an order, called with the
+        consumer's name and the (product, count) lines; by default the order is
+        printed under the marketplace's print_lock
+
+        :type metrics: Metrics
+        :param metrics: if given, the retries and the time to fill every add
+        operation are recorded in it
 
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
@@ -37,29 +75,65 @@ class Consumer(Thread):
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
-        self.cart_ids = []
+        self.output = output
+        self.metrics = metrics
 
-		# generate an id for each existing cart
-        for _ in carts:
-            self.cart_ids.append(marketplace.new_cart())
+    def fill_cart(self, cart):
+        """
+        Executes the operations of a cart in a new cart and places the order.
 
-    def run(self):
-        for (cart_id, cart) in zip(self.cart_ids, self.carts):
+        :type cart: List
+        :param cart: a list of add and remove operations
+
+        :returns the (product, count) lines of the order, or None if the cart
+        expired before it was ordered (its units went back to the producers)
+        """
+        # the cart is created when the consumer gets to it and freed by
+        # place_order, so a consumer holds a single cart at a time
+        cart_id = self.marketplace.new_cart()
+        try:
             for action in cart:
-				# add or remove the product for <quantity> times
-                for _ in range(action['quantity']):
-                    if action['type'] == 'add':
-						# try untill the product becomes available
-                        while not self.marketplace.add_to_cart(cart_id, action['product']):
-                            sleep(self.retry_wait_time)
-                    if action['type'] == 'remove':
-                        self.marketplace.remove_from_cart(cart_id, action['product'])
+                if action['type'] == 'add':
+                    # add the <quantity> units in as few calls as possible,
+                    # waiting untill the rest of them become available
+                    remaining = action['quantity']
+                    start = perf_counter_ns()
+                    while remaining > 0:
+                        added = self.marketplace.add_many_to_cart(
+                            cart_id, action['product'], remaining,
+                            block=True, timeout=self.retry_wait_time)
+                        remaining -= added
+                        if added == 0 and self.metrics is not None:
+                            self.metrics.incr(f'consumer.{self.name}.retries')
+
+                    if self.metrics is not None:
+                        self.metrics.observe('consumer.time_to_fill', perf_counter_ns() - start)
+                if action['type'] == 'remove':
+                    self.marketplace.remove_many_from_cart(cart_id, action['product'],
+                                                           action['quantity'])
+
+            return self.marketplace.place_order_lines(cart_id)
+        except CartExpired:
+            return None
+
+    def run(self):
+        for cart in self.carts:
+            lines = self.fill_cart(cart)
+            while lines is None:
+                # the cart expired while the consumer waited for a product,
+                # start it over in a new one
+                if self.metrics is not None:
+                    self.metrics.incr(f'consumer.{self.name}.expired')
+                lines = self.fill_cart(cart)
+
+            if self.output is not None:
+                self.output(self.name, lines)
+                continue
 
 			# take the products and the print_lock to print what
 			# the customer bought without tangling the messages
-            products = self.marketplace.place_order(cart_id)
+            order = format_order(self.name, lines)
             print_lock = self.marketplace.get_print_lock()
 
             with print_lock:
-                for product in products:
-                    print(self.name + ' bought', product)
+                print(order, end='')
@@ -0,0 +1,242 @@
+"""
+This module represents the attribute index of the products in stock.
+
+The index keeps, for the products that are in stock, the ids of every product
+type, the ids of every value of the searchable fields (Tea.type,
+Coffee.acidity and Coffee.roast_level) and the ids sorted by price. It is
+updated by the Stripes when a product comes in stock or runs out, so a query
+only looks at the products of its narrowest field or price range instead of
+scanning the whole stock.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import unittest
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock
+
+from tema.catalog import ProductCatalog
+from tema.product import Coffee, Tea
+
+# the fields indexed for every product type
+INDEXED_FIELDS = {'Tea': ('type',), 'Coffee': ('acidity', 'roast_level')}
+
+
+class ProductQuery:
+    """
+    Class that describes the products a buyer accepts, e.g. any Coffee with
+    roast_level 'DARK' that costs at most 5.
+    """
+
+    def __init__(self, product_type=None, min_price=None, max_price=None, predicate=None,
+                 **fields):
+        """
+        Constructor
+
+        :type product_type: Type or String
+        :param product_type: the class (or the class name) of the products
+
+        :type min_price: Int
+        :param min_price: the lowest price accepted
+
+        :type max_price: Int
+        :param max_price: the highest price accepted
+
+        :type predicate: Function
+        :param predicate: if given, only the products for which it returns True match
+
+        :type fields: Dict
+        :param fields: the values the fields of the products must have
+        """
+        if isinstance(product_type, type):
+            product_type = product_type.__name__
+        self.product_type = product_type
+        self.min_price = min_price
+        self.max_price = max_price
+        self.predicate = predicate
+        self.fields = fields
+
+    def matches(self, product):
+        """
+        Returns True if the product is one of the products described by the query.
+        """
+        if self.product_type is not None and type(product).__name__ != self.product_type:
+            return False
+        if self.min_price is not None and product.price < self.min_price:
+            return False
+        if self.max_price is not None and product.price > self.max_price:
+            return False
+        if any(getattr(product, field, None) != value for field, value in self.fields.items()):
+            return False
+        return self.predicate is None or self.predicate(product)
+
+
+class ProductIndex:
+    """
+    Class that indexes the products in stock by type, by the values of their
+    searchable fields and by price.
+    """
+
+    def __init__(self, catalog):
+        """
+        Constructor
+
+        :type catalog: ProductCatalog
+        :param catalog: the catalog that gives the products their ids
+        """
+        self.catalog = catalog
+        self.lock = Lock()
+        # product type -> the ids of the products in stock
+        self.types = {}
+        # (product type, field, value) -> the ids of the products in stock
+        self.fields = {}
+        # (price, product_id) of the products in stock, sorted
+        self.prices = []
+
+    def add(self, product_id):
+        """
+        Indexes a product that came in stock.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+        """
+        product = self.catalog.product(product_id)
+        product_type = type(product).__name__
+
+        with self.lock:
+            in_stock = self.types.setdefault(product_type, set())
+            if product_id in in_stock:
+                return
+
+            in_stock.add(product_id)
+            for field in INDEXED_FIELDS.get(product_type, ()):
+                key = (product_type, field, getattr(product, field))
+                self.fields.setdefault(key, set()).add(product_id)
+            insort(self.prices, (product.price, product_id))
+
+    def discard(self, product_id):
+        """
+        Drops a product that ran out of stock from the index.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+        """
+        product = self.catalog.product(product_id)
+        product_type = type(product).__name__
+
+        with self.lock:
+            in_stock = self.types.get(product_type)
+            if not in_stock or product_id not in in_stock:
+                return
+
+            in_stock.discard(product_id)
+            for field in INDEXED_FIELDS.get(product_type, ()):
+                key = (product_type, field, getattr(product, field))
+                self.fields[key].discard(product_id)
+                if not self.fields[key]:
+                    del self.fields[key]
+            del self.prices[bisect_left(self.prices, (product.price, product_id))]
+
+    def candidates(self, query):
+        """
+        Returns the ids of the products in stock that may match the query: the
+        products of its narrowest indexed constraint.
+        """
+        with self.lock:
+            product_types = ([query.product_type] if query.product_type is not None
+                             else list(self.types))
+            narrowest = None
+            if query.product_type is not None:
+                narrowest = self.types.get(query.product_type, set())
+
+            for field, value in query.fields.items():
+                indexed = [product_type for product_type in product_types
+                           if field in INDEXED_FIELDS.get(product_type, ())]
+                # the field can only be looked up if every type has it indexed
+                if len(indexed) != len(product_types):
+                    continue
+                ids = set().union(*(self.fields.get((product_type, field, value), ())
+                                    for product_type in indexed))
+                if narrowest is None or len(ids) < len(narrowest):
+                    narrowest = ids
+
+            low, high = 0, len(self.prices)
+            if query.min_price is not None:
+                low = bisect_left(self.prices, (query.min_price,))
+            if query.max_price is not None:
+                high = bisect_right(self.prices, (query.max_price, float('inf')))
+            if narrowest is None or high - low < len(narrowest):
+                return [product_id for _, product_id in self.prices[low:high]]
+            return list(narrowest)
+
+    def find(self, query):
+        """
+        Returns the ids of the products in stock that match the query, cheapest first.
+
+        :type query: ProductQuery
+        :param query: the products wanted
+        """
+        products = [(self.catalog.product(product_id), product_id)
+                    for product_id in self.candidates(query)]
+        return [product_id for product, product_id
+                in sorted(products, key=lambda pair: (pair[0].price, pair[1]))
+                if query.matches(product)]
+
+
+class TestProductIndex(unittest.TestCase):
+    """
+    Class for testing the product index
+    """
+
+    def setUp(self):
+        self.catalog = ProductCatalog()
+        self.index = ProductIndex(self.catalog)
+        self.products = [Tea(name='Green', price=4, type='Green'),
+                         Tea(name='Oolong', price=7, type='Oolong'),
+                         Tea(name='Oolong 2', price=3, type='Oolong'),
+                         Coffee(name='Dark', price=5, acidity='5.05', roast_level='DARK'),
+                         Coffee(name='Dark 2', price=9, acidity='5.05', roast_level='DARK')]
+        for product in self.products:
+            self.index.add(self.catalog.intern(product))
+
+    def find(self, *args, **kwargs):
+        """
+        Returns the products in stock that match ProductQuery(*args, **kwargs).
+        """
+        return [self.catalog.product(product_id)
+                for product_id in self.index.find(ProductQuery(*args, **kwargs))]
+
+    def test_find(self):
+        tea, oolong, oolong2, dark, dark2 = self.products
+
+        self.assertEqual(self.find(Tea, type='Oolong'), [oolong2, oolong])
+        self.assertEqual(self.find(Coffee, max_price=5, roast_level='DARK'), [dark])
+        self.assertEqual(self.find(min_price=4, max_price=7), [tea, dark, oolong])
+        self.assertEqual(self.find('Coffee', acidity='5.05', name='Dark 2'), [dark2])
+        self.assertEqual(self.find(roast_level='DARK'), [dark, dark2])
+        self.assertEqual(self.find(Tea, predicate=lambda product: 'Green' in product.name),
+                         [tea])
+        self.assertEqual(self.find(Coffee, roast_level='LIGHT'), [])
+
+    def test_candidates(self):
+        # only the products of the narrowest constraint are looked at
+        query = ProductQuery(Tea, max_price=3)
+        self.assertEqual(self.index.candidates(query), [self.catalog.intern(self.products[2])])
+        query = ProductQuery(Coffee, roast_level='DARK', min_price=0)
+        self.assertEqual(len(self.index.candidates(query)), 2)
+
+    def test_discard(self):
+        oolong2 = self.products[2]
+        self.index.discard(self.catalog.intern(oolong2))
+        self.index.discard(self.catalog.intern(oolong2))
+        self.assertEqual(self.find(Tea, type='Oolong'), [self.products[1]])
+        self.assertEqual(len(self.index.prices), 4)
+
+        self.index.add(self.catalog.intern(self.products[0]))
+        self.assertEqual(len(self.index.prices), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
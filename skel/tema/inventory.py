@@ -0,0 +1,476 @@
+"""
+This module represents the Inventory index used by the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import time
+import unittest
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Condition, Lock, Thread
+
+from tema.cart import take_units
+from tema.catalog import ProductCatalog
+from tema.index import ProductIndex, ProductQuery
+from tema.policy import DEFAULT_POLICY, create_policy
+from tema.product import Tea
+from tema.snapshot import MAX_PENDING_DELTAS
+
+
+@dataclass
+class Demand:
+    """
+    Class that represents the units of a product wanted by a blocked add_to_cart.
+    """
+    # the number of units still wanted
+    wanted: int
+    # notified (with the lock of the stripe that holds the product) when units come
+    filled: Condition
+    # (producer_id, count) pairs handed over by the producers
+    units: list = field(default_factory=list)
+
+
+class Stripe:
+    """
+    Class that holds the stock of a subset of the products, guarded by its own lock.
+    For every product it keeps the producers that have it in stock together with
+    the number of units, and the FIFO list of the unmet demand: the published units
+    go to the waiting carts first, so a product is only in stock if nobody waits
+    for it. All the methods must be called with the lock held.
+    """
+
+    def __init__(self, lock_factory=Lock, index=None, snapshots=None, policy=None):
+        """
+        Constructor
+
+        :type lock_factory: Function
+        :param lock_factory: creates the lock of the stripe
+
+        :type index: ProductIndex
+        :param index: if given, told when a product comes in stock or runs out
+
+        :type snapshots: SnapshotPublisher
+        :param snapshots: if given, every change of the stock is recorded in it
+
+        :type policy: SelectionPolicy
+        :param policy: chooses the producer whose units are taken (the default
+        policy, without the queues, if not given)
+        """
+        self.lock = lock_factory()
+        self.index = index
+        self.snapshots = snapshots
+        self.policy = policy if policy is not None else create_policy(DEFAULT_POLICY, {})
+        # the pending changes of the snapshots, appended to without a method call
+        self.deltas = snapshots.deltas if snapshots is not None else None
+        self.stock = {}
+        # the Demands waiting for each product, in arrival order
+        self.waiters = {}
+
+    def has(self, product_id):
+        """
+        Returns True if at least one producer has the product in stock.
+
+        :type product_id: Int
+        :param product_id: the id of the product to look for
+        """
+        return bool(self.stock.get(product_id))
+
+    def add(self, producer_id, product_id, count=1):
+        """
+        Hands units of the product to the waiting Demands, oldest first, and puts
+        the rest in the producer's stock.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product_id: Int
+        :param product_id: the id of the product to add
+
+        :type count: Int
+        :param count: the number of units to add
+        """
+        waiters = self.waiters.get(product_id)
+        while waiters and count > 0:
+            demand = waiters[0]
+            handed = min(count, demand.wanted)
+            demand.units.append((producer_id, handed))
+            demand.wanted -= handed
+            count -= handed
+            demand.filled.notify()
+            if demand.wanted == 0:
+                waiters.popleft()
+
+        if count == 0:
+            return
+
+        producers = self.stock.get(product_id)
+        if producers is None:
+            producers = self.stock[product_id] = {}
+        if not producers and self.index is not None:
+            self.index.add(product_id)
+
+        producers[producer_id] = producers.get(producer_id, 0) + count
+        if self.deltas is not None:
+            self.deltas.append((product_id, producer_id, count))
+            if len(self.deltas) >= MAX_PENDING_DELTAS:
+                self.snapshots.publish_later()
+
+    def take(self, product_id, quantity=1):
+        """
+        Removes up to quantity units of the product from the stock of the
+        producers that have it.
+
+        The producer of every batch of units is chosen by the stripe's
+        SelectionPolicy (see policy.py).
+
+        :type product_id: Int
+        :param product_id: the id of the product to take
+
+        :type quantity: Int
+        :param quantity: the maximum number of units to take
+
+        :returns a list of (producer_id, count) pairs with the units taken from
+        each producer, empty if the product is not in stock
+        """
+        producers = self.stock.get(product_id)
+        if not producers:
+            return []
+
+        taken = take_units(producers, quantity, self.policy.choose)
+
+        if taken and not producers and self.index is not None:
+            self.index.discard(product_id)
+        if self.deltas is not None:
+            for producer_id, count in taken:
+                self.deltas.append((product_id, producer_id, -count))
+            if len(self.deltas) >= MAX_PENDING_DELTAS:
+                self.snapshots.publish_later()
+        return taken
+
+    def wait(self, product_id, quantity, timeout):
+        """
+        Joins the end of the product's wait list and waits until some units are
+        handed over by add().
+
+        :type product_id: Int
+        :param product_id: the id of the product to wait for
+
+        :type quantity: Int
+        :param quantity: the maximum number of units wanted
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait (None means forever)
+
+        :returns a list of (producer_id, count) pairs with the units handed over,
+        empty if the wait timed out
+        """
+        demand = Demand(quantity, Condition(self.lock))
+        waiters = self.waiters.get(product_id)
+        if waiters is None:
+            waiters = self.waiters[product_id] = deque()
+        waiters.append(demand)
+
+        demand.filled.wait_for(lambda: demand.units, timeout)
+
+        # leave the list, with what has been handed over until now
+        if demand.wanted > 0:
+            waiters.remove(demand)
+        # the list may already have been dropped (and replaced) by another waiter
+        if not waiters and self.waiters.get(product_id) is waiters:
+            del self.waiters[product_id]
+
+        return demand.units
+
+
+class ProducerQueue:
+    """
+    Class that keeps the number of units a producer has in the Marketplace,
+    guarded by its own lock.
+    """
+
+    def __init__(self, lock_factory=Lock, producer_id=None, full=None):
+        """
+        Constructor
+
+        :type lock_factory: Function
+        :param lock_factory: creates the lock of the queue
+
+        :type producer_id: Int
+        :param producer_id: the producer the queue belongs to
+
+        :type full: Set
+        :param full: the ids of the producers whose queue was full when they
+        published and hasn't had a slot freed since, shared by the queues
+        """
+        self.lock = lock_factory()
+        self.size = 0
+        # condition (bound to lock) used to wait for a free slot
+        self.space = Condition(self.lock)
+        self.producer_id = producer_id
+        self.full = full if full is not None else set()
+
+    def reserve(self, capacity, quantity=1, block=False, timeout=None):
+        """
+        Reserves slots in the queue for new units.
+
+        :type capacity: Int
+        :param capacity: the maximum size of the queue
+
+        :type quantity: Int
+        :param quantity: the maximum number of slots to reserve
+
+        :type block: Bool
+        :param block: if True and the queue is full, wait until a slot is freed
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block (None means forever)
+
+        :returns the number of slots reserved (0 if the queue is full)
+        """
+        with self.lock:
+            if self.size >= capacity:
+                self.full.add(self.producer_id)
+                if not block or not self.space.wait_for(lambda: self.size < capacity, timeout):
+                    return 0
+
+            count = min(quantity, capacity - self.size)
+            self.size += count
+            return count
+
+    def restore(self, count=1):
+        """
+        Puts back units that have been removed from a cart, regardless of the capacity.
+
+        :type count: Int
+        :param count: the number of units
+        """
+        with self.lock:
+            self.size += count
+
+    def release(self, count=1):
+        """
+        Frees the slots of units that have been bought and wakes up the producer
+        if it is waiting for them.
+
+        :type count: Int
+        :param count: the number of units
+        """
+        with self.lock:
+            self.size -= count
+            self.full.discard(self.producer_id)
+            self.space.notify()
+
+
+class Inventory:
+    """
+    Class that indexes the products published in the Marketplace. The stock is split
+    into lock stripes by product, so that operations on different products run in
+    parallel, and every producer queue has its own lock.
+    """
+
+    def __init__(self, stripes=16, stripe_lock=Lock, queue_lock=Lock, *, index=None,
+                 snapshots=None, policy=DEFAULT_POLICY):
+        """
+        Constructor
+
+        :type stripes: Int
+        :param stripes: the number of locks the stock is split into
+
+        :type stripe_lock: Function
+        :param stripe_lock: creates the lock of a stripe
+
+        :type queue_lock: Function
+        :param queue_lock: creates the lock of a producer queue
+
+        :type index: ProductIndex
+        :param index: if given, kept up to date with the products in stock
+
+        :type snapshots: SnapshotPublisher
+        :param snapshots: if given, every change of the stock is recorded in it
+
+        :type policy: String
+        :param policy: the name of the policy that chooses the producer whose
+        units are taken, one of policy.POLICIES
+        """
+        self.queues = {}
+        # the producers waiting for a free slot in their queue
+        self.full_queues = set()
+        self.queue_lock = queue_lock
+        self.index = index
+        self.snapshots = snapshots
+        self.policy = create_policy(policy, self.queues, self.full_queues)
+        self.stripes = [Stripe(stripe_lock, index, snapshots, self.policy)
+                        for _ in range(stripes)]
+
+    def enable_index(self, index):
+        """
+        Indexes the products in stock and keeps the index up to date from now on.
+        All the stripe locks are held while the index is filled.
+
+        :type index: ProductIndex
+        :param index: the (empty) index
+        """
+        for stripe in self.stripes:
+            stripe.lock.acquire()
+        try:
+            for stripe in self.stripes:
+                for product_id, producers in stripe.stock.items():
+                    if producers:
+                        index.add(product_id)
+                stripe.index = index
+            self.index = index
+        finally:
+            for stripe in reversed(self.stripes):
+                stripe.lock.release()
+
+    def register_producer(self, producer_id):
+        """
+        Creates the (empty) queue of a new producer.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+        """
+        self.queues[producer_id] = ProducerQueue(self.queue_lock, producer_id,
+                                                 self.full_queues)
+
+    def queue(self, producer_id):
+        """
+        Returns the queue of the producer.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+        """
+        return self.queues[producer_id]
+
+    def queue_size(self, producer_id):
+        """
+        Returns the number of units the producer has in its queue.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+        """
+        return self.queues[producer_id].size
+
+    def stripe(self, product_id):
+        """
+        Returns the stripe that holds the stock of the product.
+
+        :type product_id: Int
+        :param product_id: the id of the product to look for
+        """
+        return self.stripes[hash(product_id) % len(self.stripes)]
+
+    def count(self, product_id):
+        """
+        Returns the number of units of the product available from all the producers.
+
+        :type product_id: Int
+        :param product_id: the id of the product to look for
+        """
+        stripe = self.stripe(product_id)
+        with stripe.lock:
+            return sum(stripe.stock.get(product_id, {}).values())
+
+
+class TestInventory(unittest.TestCase):
+    """
+    Class for testing the Inventory module
+    """
+
+    def test_stripe(self):
+        inventory = Inventory(4)
+
+        self.assertIs(inventory.stripe(1), inventory.stripes[1])
+        self.assertIs(inventory.stripe(6), inventory.stripes[2])
+
+    def test_add_take(self):
+        inventory = Inventory(policy='most-recent')
+        tea = 0
+        stripe = inventory.stripe(tea)
+
+        with stripe.lock:
+            self.assertEqual(stripe.take(tea), [])
+            stripe.add(0, tea)
+            stripe.add(1, tea)
+            stripe.add(1, tea)
+
+        self.assertEqual(inventory.count(tea), 3)
+
+        with stripe.lock:
+            self.assertEqual(stripe.take(tea), [(1, 1)])
+            self.assertEqual(stripe.take(tea, 5), [(1, 1), (0, 1)])
+            self.assertEqual(stripe.take(tea), [])
+            self.assertFalse(stripe.has(tea))
+            self.assertEqual(stripe.wait(tea, 1, 0.01), [])
+            self.assertEqual(stripe.waiters, {})
+
+    def test_wait(self):
+        inventory = Inventory()
+        tea = 0
+        stripe = inventory.stripe(tea)
+        handed = {}
+
+        def wait(quantity):
+            with stripe.lock:
+                handed[quantity] = stripe.wait(tea, quantity, 5)
+
+        waiters = [Thread(target=wait, args=(2,)), Thread(target=wait, args=(1,))]
+        for i, waiter in enumerate(waiters):
+            waiter.start()
+            while len(stripe.waiters.get(tea, ())) <= i:
+                time.sleep(0.001)
+
+        # the units go to the waiters in arrival order, then to the stock
+        with stripe.lock:
+            stripe.add(0, tea, 2)
+            stripe.add(1, tea, 2)
+        for waiter in waiters:
+            waiter.join()
+
+        self.assertEqual(handed, {2: [(0, 2)], 1: [(1, 1)]})
+        self.assertEqual(inventory.count(tea), 1)
+        self.assertEqual(stripe.waiters, {})
+
+    def test_enable_index(self):
+        catalog = ProductCatalog()
+        teas = [catalog.intern(Tea(name=f'Test {i}', price=i, type='test type'))
+                for i in range(3)]
+        inventory = Inventory(2)
+        for tea in teas[:2]:
+            with inventory.stripe(tea).lock:
+                inventory.stripe(tea).add(0, tea)
+
+        inventory.enable_index(ProductIndex(catalog))
+        self.assertEqual(inventory.index.find(ProductQuery()), teas[:2])
+
+        # the index follows the stock from now on
+        stripe = inventory.stripe(teas[0])
+        with stripe.lock:
+            stripe.take(teas[0])
+        with inventory.stripe(teas[2]).lock:
+            inventory.stripe(teas[2]).add(0, teas[2])
+        self.assertEqual(inventory.index.find(ProductQuery()), teas[1:])
+
+    def test_queue(self):
+        inventory = Inventory()
+        inventory.register_producer(0)
+        queue = inventory.queue(0)
+
+        self.assertEqual(queue.reserve(3, 2), 2)
+        self.assertEqual(queue.reserve(3, 2), 1)
+        self.assertEqual(queue.reserve(3), 0)
+        self.assertEqual(queue.reserve(3, block=True, timeout=0.01), 0)
+        self.assertEqual(inventory.full_queues, {0})
+
+        queue.release(3)
+        self.assertEqual(inventory.full_queues, set())
+        self.assertEqual(inventory.queue_size(0), 0)
+        queue.restore()
+        self.assertEqual(inventory.queue_size(0), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,795 @@
+"""
+This module represents the journal of the Marketplace.
+
+Every change of the Marketplace state (a producer registered, a product seen
+for the first time, units published, added to or removed from a cart, a cart
+created, ordered or expired) is appended to the journal as a small binary
+record. The records are buffered in memory and written by a flusher thread,
+which syncs them to disk in batches: one fsync covers every record appended
+since the previous one (group commit). A change is on disk at most
+sync_interval seconds after it is made; a journal made with sync_orders also
+makes place_order wait for its records, the orders placed meanwhile sharing
+the sync.
+
+The journal is a directory of numbered segments. A checkpoint folds the sealed
+segments into a snapshot of the state, made of arrays of integers that are read
+back through a memory map, and deletes them. The state is restored from the
+last checkpoint and the segments written after it.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from array import array
+from itertools import chain
+from threading import Condition, Event, Lock, Thread
+
+from tema.cart import CART_SLOT_BITS, CART_SLOT_MASK
+from tema.product import PRODUCT_TYPES, Coffee, Tea
+
+# the types of the records
+REGISTER, PRODUCT, PUBLISH, NEW_CART, ADD, REMOVE, ORDER, EXPIRE = range(8)
+# the type and up to four integer arguments, the first of which is 64 bit since
+# it may be a cart id; a PRODUCT record is followed by the description of the
+# product (JSON), whose length is its second argument
+RECORD = struct.Struct('<Bqiii')
+# the magic, the last segment folded in, then the number of producers, products
+# in stock, stock entries, cart slots, carts and cart entries and the length of
+# the products; the arrays that follow are in the native byte order, the 32 bit
+# ones (padded to 8 bytes) then the 64 bit ones of the carts
+CHECKPOINT_HEADER = struct.Struct('<8sqiiiqiii')
+CHECKPOINT_MAGIC = b'MKTCKPT2'
+CHECKPOINT_NAME = 'checkpoint'
+SEGMENT_SUFFIX = '.journal'
+# the maximum number of seconds a record stays in memory
+SYNC_INTERVAL = 0.005
+
+# fdatasync skips the metadata that doesn't matter for reading the segment back
+sync_file = getattr(os, 'fdatasync', os.fsync)
+
+
+def add_units(units, product_id, producer_id, count):
+    """
+    Adds count (which may be negative) units of a product to a
+    {product_id: {producer_id: count}} dict, dropping the entries that reach 0.
+    """
+    producers = units.get(product_id)
+    if producers is None:
+        producers = units[product_id] = {}
+
+    count += producers.get(producer_id, 0)
+    if count:
+        producers[producer_id] = count
+    else:
+        producers.pop(producer_id, None)
+        if not producers:
+            del units[product_id]
+
+
+class MarketState:
+    """
+    Class that represents the state of a Marketplace rebuilt from its journal.
+    The stock and the carts are kept like in the Stripes and the Carts, so that
+    a Marketplace can take over their dicts when it is restored.
+    """
+
+    def __init__(self):
+        """
+        Constructor. Creates an empty state.
+        """
+        # the last segment folded into the state
+        self.segment = 0
+        # the size of the queue of every producer id
+        self.queues = []
+        # product_id -> {producer_id: the number of units in stock}
+        self.stock = {}
+        # the number of cart slots used so far (including the freed ones)
+        self.cart_slots = 0
+        # cart_id -> {product_id: {producer_id: the number of units in the cart}}
+        self.carts = {}
+        # [product type, field values...] of every product id
+        self.products = []
+
+    def apply(self, record, payload=None):
+        """
+        Applies a journal record to the state.
+
+        :type record: Tuple
+        :param record: the type of the record followed by its four arguments
+
+        :type payload: Bytes
+        :param payload: the description of the product of a PRODUCT record
+        """
+        kind, first, second, third, fourth = record
+        if kind == PUBLISH:
+            # producer_id, product_id, count
+            self.queues[first] += third
+            add_units(self.stock, second, first, third)
+        elif kind == ADD:
+            # cart_id, product_id, producer_id, count
+            self.queues[third] -= fourth
+            add_units(self.stock, second, third, -fourth)
+            add_units(self.carts[first], second, third, fourth)
+        elif kind == REMOVE:
+            self.queues[third] += fourth
+            add_units(self.stock, second, third, fourth)
+            add_units(self.carts[first], second, third, -fourth)
+        elif kind == NEW_CART:
+            self.carts[first] = {}
+            self.cart_slots = max(self.cart_slots, (first & CART_SLOT_MASK) + 1)
+        elif kind == ORDER:
+            # the units left the queues when they were added to the cart
+            del self.carts[first]
+        elif kind == EXPIRE:
+            for product_id, producers in self.carts.pop(first).items():
+                for producer_id, count in producers.items():
+                    self.queues[producer_id] += count
+                    add_units(self.stock, product_id, producer_id, count)
+        elif kind == REGISTER:
+            self.queues.extend([0] * (first + 1 - len(self.queues)))
+        elif kind == PRODUCT:
+            self.products.extend([None] * (first + 1 - len(self.products)))
+            self.products[first] = json.loads(payload)
+
+    def replay(self, path):
+        """
+        Applies the records of a journal segment. A record cut short by a crash
+        at the end of the segment is ignored.
+
+        :type path: String
+        :param path: the segment
+        """
+        with open(path, 'rb') as segment:
+            data = segment.read()
+
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            record = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            payload = None
+            if record[0] == PRODUCT:
+                payload = data[pos:pos + record[2]]
+                if len(payload) < record[2]:
+                    break
+                pos += record[2]
+
+            self.apply(record, payload)
+
+    def product(self, product_id):
+        """
+        Returns the product with the given id.
+        """
+        product_type, *values = self.products[product_id]
+        return PRODUCT_TYPES[product_type](*values)
+
+    def save(self, path):
+        """
+        Writes the state as a checkpoint, replacing the file atomically.
+
+        :type path: String
+        :param path: the checkpoint
+        """
+        products = json.dumps(self.products).encode()
+        # (product_id, number of producers) pairs, then (producer_id, count) pairs
+        stock_index = array('i', chain.from_iterable(
+            (product_id, len(producers)) for product_id, producers in self.stock.items()))
+        stock = array('i', chain.from_iterable(
+            chain.from_iterable(producers.items()) for producers in self.stock.values()))
+        cart_ids = sorted(self.carts)
+        cart_units = [(cart_id, product_id, producer_id, count) for cart_id in cart_ids
+                      for product_id, producers in self.carts[cart_id].items()
+                      for producer_id, count in producers.items()]
+
+        header = CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, self.segment, len(self.queues),
+                                        len(self.stock), len(stock) // 2, self.cart_slots,
+                                        len(cart_ids), len(cart_units), len(products))
+        # the 64 bit arrays start on a multiple of 8 bytes
+        padding = array('i', [0] * ((len(self.queues) + len(stock_index) + len(stock)) % 2))
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as checkpoint:
+            checkpoint.write(header)
+            array('i', self.queues).tofile(checkpoint)
+            stock_index.tofile(checkpoint)
+            stock.tofile(checkpoint)
+            padding.tofile(checkpoint)
+            array('q', cart_ids).tofile(checkpoint)
+            array('q', chain.from_iterable(cart_units)).tofile(checkpoint)
+            checkpoint.write(products)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a checkpoint through a memory map. The stock and the carts are
+        built from views of the mapped arrays, which are never copied.
+
+        :type path: String
+        :param path: the checkpoint
+        """
+        state = cls()
+        with open(path, 'rb') as checkpoint, \
+                mmap.mmap(checkpoint.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = CHECKPOINT_HEADER.unpack_from(data)
+            if header[0] != CHECKPOINT_MAGIC:
+                raise ValueError(f'{path} is not a checkpoint')
+
+            (_, state.segment, producers, stock_products, stock, state.cart_slots, carts,
+             cart_units, products) = header
+            stock_start = producers + 2 * stock_products
+            ints_end = stock_start + 2 * stock
+            carts_start = CHECKPOINT_HEADER.size + 4 * (ints_end + ints_end % 2)
+            end = carts_start + 8 * (carts + 4 * cart_units)
+            # the slices of ints are views as well, they are gone when the calls return
+            with memoryview(data)[CHECKPOINT_HEADER.size:carts_start] as view, \
+                    view.cast('i') as ints:
+                state.queues = ints[:producers].tolist()
+                state.read_stock(ints[producers:stock_start], ints[stock_start:ints_end])
+            with memoryview(data)[carts_start:end] as view, view.cast('q') as longs:
+                state.read_carts(longs[:carts], longs[carts:])
+
+            state.products = json.loads(data[end:end + products])
+        return state
+
+    def read_stock(self, index, entries):
+        """
+        Fills the stock from the arrays of a checkpoint.
+
+        :type index: memoryview
+        :param index: the (product_id, number of producers) pairs
+
+        :type entries: memoryview
+        :param entries: the (producer_id, count) pairs of every product, in order
+        """
+        pos = 0
+        for product_id, producers in zip(index[::2], index[1::2]):
+            end = pos + 2 * producers
+            self.stock[product_id] = dict(zip(entries[pos:end:2], entries[pos + 1:end:2]))
+            pos = end
+
+    def read_carts(self, cart_ids, units):
+        """
+        Fills the carts from the arrays of a checkpoint.
+
+        :type cart_ids: memoryview
+        :param cart_ids: the ids of the carts
+
+        :type units: memoryview
+        :param units: the (cart_id, product_id, producer_id, count) entries
+        """
+        self.carts = {cart_id: {} for cart_id in cart_ids}
+        for cart_id, product_id, producer_id, count in zip(units[::4], units[1::4],
+                                                            units[2::4], units[3::4]):
+            cart = self.carts[cart_id]
+            producers = cart.get(product_id)
+            if producers is None:
+                producers = cart[product_id] = {}
+            producers[producer_id] = count
+
+
+class SegmentFiles:
+    """
+    Class that represents the directory of a journal: its numbered segments,
+    the last of which is written, and its checkpoint.
+    """
+
+    def __init__(self, directory):
+        """
+        Constructor. Starts a new segment.
+
+        :type directory: String
+        :param directory: the directory of the journal (created if needed)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # held while the current segment is written, synced or replaced
+        self.lock = Lock()
+        # the number of syncs so far, every one covering a batch of records
+        self.syncs = 0
+
+        self.segment = max(self.segments() + [self.checkpoint_segment()]) + 1
+        # pylint: disable=consider-using-with
+        self.file = open(self.segment_path(self.segment), 'ab', buffering=0)
+
+    def segment_path(self, segment):
+        """
+        Returns the path of a segment.
+        """
+        return os.path.join(self.directory, f'{segment:08d}{SEGMENT_SUFFIX}')
+
+    def checkpoint_path(self):
+        """
+        Returns the path of the checkpoint.
+        """
+        return os.path.join(self.directory, CHECKPOINT_NAME)
+
+    def segments(self):
+        """
+        Returns the numbers of the segments in the directory, in order.
+        """
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def checkpoint_segment(self):
+        """
+        Returns the last segment folded into the checkpoint (0 if there is none).
+        """
+        try:
+            with open(self.checkpoint_path(), 'rb') as checkpoint:
+                return CHECKPOINT_HEADER.unpack(checkpoint.read(CHECKPOINT_HEADER.size))[1]
+        except FileNotFoundError:
+            return 0
+
+    def write(self, data, rotate=False):
+        """
+        Writes records to the current segment and syncs it. The caller must
+        hold the lock.
+
+        :type data: Bytes
+        :param data: the records
+
+        :type rotate: Bool
+        :param rotate: if True, the segment is then sealed and a new one is started
+
+        :returns the number of the segment the records were written to
+        """
+        segment = self.segment
+        if data:
+            self.file.write(data)
+            sync_file(self.file.fileno())
+            self.syncs += 1
+        if rotate:
+            self.file.close()
+            self.segment += 1
+            # pylint: disable=consider-using-with
+            self.file = open(self.segment_path(self.segment), 'ab', buffering=0)
+        return segment
+
+    def close(self):
+        """
+        Closes the current segment.
+        """
+        self.file.close()
+
+
+class GroupCommit:
+    """
+    Class that buffers the records in memory and writes them to the segments
+    from a flusher thread, one sync for every batch (group commit).
+    """
+
+    def __init__(self, files, sync_interval):
+        """
+        Constructor. Starts the flusher thread.
+
+        :type files: SegmentFiles
+        :param files: where the records are written
+
+        :type sync_interval: Float
+        :param sync_interval: the maximum number of seconds between two syncs
+        """
+        self.files = files
+        # guards the buffer; the lock of the files is taken first
+        self.lock = Lock()
+        self.buffer = bytearray()
+        # the number of bytes appended so far, and how many of them are on disk
+        self.appended = 0
+        self.durable = 0
+        self.wakeup = Condition(self.lock)
+        self.flushed = Condition(self.lock)
+        self.stopped = False
+        # what stopped the flusher thread, if it failed
+        self.error = None
+
+        self.thread = Thread(target=self.flush_loop, args=(sync_interval,), daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        """
+        Appends a packed record to the buffer.
+        """
+        with self.lock:
+            self.buffer += record
+            self.appended += len(record)
+
+    def sync(self, timeout=None):
+        """
+        Waits until all the records appended so far are on disk. The callers
+        that wait at the same time share the same sync.
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait (forever by default)
+
+        :returns False if the records aren't on disk yet after timeout seconds
+
+        :raises RuntimeError: if the flusher thread failed, with its exception as the cause
+        """
+        with self.lock:
+            target = self.appended
+            self.wakeup.notify()
+            self.flushed.wait_for(lambda: self.durable >= target or self.error is not None,
+                                  timeout)
+            if self.durable < target and self.error is not None:
+                raise RuntimeError('the journal can\'t be written') from self.error
+            return self.durable >= target
+
+    def flush(self, rotate=False):
+        """
+        Writes the buffered records to the current segment and syncs it.
+
+        :type rotate: Bool
+        :param rotate: if True, the segment is then sealed and a new one is started
+
+        :returns the number of the segment the records were written to
+        """
+        with self.files.lock:
+            with self.lock:
+                data, self.buffer = self.buffer, bytearray()
+                end = self.appended
+            segment = self.files.write(data, rotate)
+
+        with self.lock:
+            self.durable = end
+            self.flushed.notify_all()
+        return segment
+
+    def flush_loop(self, sync_interval):
+        """
+        Flushes the buffer every sync_interval seconds, or as soon as someone
+        waits in sync(), until it is stopped. If a flush fails, the exception
+        is kept and the threads waiting in sync() are woken up.
+        """
+        try:
+            while True:
+                with self.lock:
+                    if not self.stopped and self.durable == self.appended:
+                        self.wakeup.wait(sync_interval)
+                    stopped = self.stopped
+
+                self.flush()
+                if stopped:
+                    return
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            with self.lock:
+                self.error = error
+                self.flushed.notify_all()
+
+    def close(self):
+        """
+        Stops the flusher thread once it has synced the buffered records.
+
+        :raises RuntimeError: if the flusher thread failed, with its exception as the cause
+        """
+        with self.lock:
+            self.stopped = True
+            self.wakeup.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('the journal can\'t be written') from self.error
+
+
+class Journal:
+    """
+    Class that appends the changes of a Marketplace to a directory of segments.
+    The methods that record a change can be called from any thread; the caller
+    must hold the lock that orders the change (e.g. the cart lock for the
+    changes of a cart).
+    """
+
+    def __init__(self, directory, sync_interval=SYNC_INTERVAL, checkpoint_interval=None,
+                 sync_orders=False):
+        """
+        Constructor. Starts a new segment and the flusher thread.
+
+        :type directory: String
+        :param directory: the directory of the journal (created if needed)
+
+        :type sync_interval: Float
+        :param sync_interval: the maximum number of seconds between two syncs
+
+        :type checkpoint_interval: Float
+        :param checkpoint_interval: if given, a checkpoint is made every
+        checkpoint_interval seconds by a background thread
+
+        :type sync_orders: Bool
+        :param sync_orders: if True, place_order returns only once the order is
+        on disk; otherwise it gets there within sync_interval seconds
+        """
+        self.files = SegmentFiles(directory)
+        self.commit = GroupCommit(self.files, sync_interval)
+        self.sync_orders = sync_orders
+        self.checkpoint_lock = Lock()
+        self.closing = Event()
+
+        self.checkpointer = None
+        if checkpoint_interval is not None:
+            self.checkpointer = Thread(target=self.checkpoint_loop,
+                                       args=(checkpoint_interval,), daemon=True)
+            self.checkpointer.start()
+
+    def register(self, producer_id):
+        """
+        Records a new producer.
+        """
+        self.commit.append(RECORD.pack(REGISTER, producer_id, 0, 0, 0))
+
+    def product(self, product_id, product):
+        """
+        Records the id given to a product.
+        """
+        description = json.dumps([type(product).__name__, *product.values()]).encode()
+        self.commit.append(RECORD.pack(PRODUCT, product_id, len(description), 0, 0)
+                           + description)
+
+    def publish(self, producer_id, product_id, count):
+        """
+        Records units published by a producer.
+        """
+        self.commit.append(RECORD.pack(PUBLISH, producer_id, product_id, count, 0))
+
+    def new_cart(self, cart_id):
+        """
+        Records a new cart.
+        """
+        self.commit.append(RECORD.pack(NEW_CART, cart_id, 0, 0, 0))
+
+    def add(self, cart_id, product_id, producer_id, count):
+        """
+        Records units of a producer added to a cart.
+        """
+        self.commit.append(RECORD.pack(ADD, cart_id, product_id, producer_id, count))
+
+    def remove(self, cart_id, product_id, producer_id, count):
+        """
+        Records units of a producer removed from a cart.
+        """
+        self.commit.append(RECORD.pack(REMOVE, cart_id, product_id, producer_id, count))
+
+    def order(self, cart_id):
+        """
+        Records an ordered cart.
+        """
+        self.commit.append(RECORD.pack(ORDER, cart_id, 0, 0, 0))
+
+    def expire(self, cart_id):
+        """
+        Records an expired cart, whose units went back to the producers.
+        """
+        self.commit.append(RECORD.pack(EXPIRE, cart_id, 0, 0, 0))
+
+    def sync(self, timeout=None):
+        """
+        Waits until all the records appended so far are on disk.
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait (forever by default)
+
+        :returns False if the records aren't on disk yet after timeout seconds
+
+        :raises RuntimeError: if the journal can't be written
+        """
+        return self.commit.sync(timeout)
+
+    def load(self):
+        """
+        Returns the MarketState recorded in the directory: the checkpoint with
+        the segments written after it applied on top.
+        """
+        if os.path.exists(self.files.checkpoint_path()):
+            state = MarketState.load(self.files.checkpoint_path())
+        else:
+            state = MarketState()
+
+        for segment in self.files.segments():
+            if segment > state.segment:
+                state.replay(self.files.segment_path(segment))
+        return state
+
+    def checkpoint(self):
+        """
+        Seals the current segment, folds it (and the segments before it) into
+        the checkpoint and deletes the folded segments.
+
+        :returns the MarketState written to the checkpoint
+        """
+        with self.checkpoint_lock:
+            sealed = self.commit.flush(rotate=True)
+
+            if os.path.exists(self.files.checkpoint_path()):
+                state = MarketState.load(self.files.checkpoint_path())
+            else:
+                state = MarketState()
+            for segment in self.files.segments():
+                if state.segment < segment <= sealed:
+                    state.replay(self.files.segment_path(segment))
+
+            state.segment = sealed
+            state.save(self.files.checkpoint_path())
+            for segment in self.files.segments():
+                if segment <= sealed:
+                    os.remove(self.files.segment_path(segment))
+            return state
+
+    def checkpoint_loop(self, interval):
+        """
+        Makes a checkpoint every interval seconds until the journal is closed.
+        """
+        while not self.closing.wait(interval):
+            self.checkpoint()
+
+    def close(self):
+        """
+        Stops the background threads, syncs the buffered records and closes the
+        segment.
+
+        :raises RuntimeError: if the journal can't be written
+        """
+        self.closing.set()
+        if self.checkpointer is not None:
+            self.checkpointer.join()
+        try:
+            self.commit.close()
+        finally:
+            self.files.close()
+
+
+class TestJournal(unittest.TestCase):
+    """
+    Class for testing the journal
+    """
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.directory = tempfile.TemporaryDirectory()
+        self.tea = Tea(name='Test', price=12, type='test type')
+        self.coffee = Coffee(name='Test', price=12, acidity='test type', roast_level='MEDIUM')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fill(self, marketplace):
+        """
+        Registers two producers and leaves some units in the queues and in two carts.
+        """
+        marketplace.register_producer()
+        marketplace.register_producer()
+        marketplace.publish_many(0, self.tea, 3)
+        marketplace.publish_many(1, self.coffee, 4)
+
+        ordered, kept, other = (marketplace.new_cart() for _ in range(3))
+        marketplace.add_many_to_cart(ordered, self.tea, 1)
+        marketplace.place_order(ordered)
+        marketplace.add_many_to_cart(kept, self.tea, 2)
+        marketplace.add_many_to_cart(kept, self.coffee, 3)
+        marketplace.remove_many_from_cart(kept, self.coffee, 1)
+        marketplace.add_many_to_cart(other, self.coffee, 1)
+        return kept, other
+
+    def assert_restored(self, marketplace, kept, other):
+        """
+        Checks the state left by fill() in a restored Marketplace.
+        """
+        tea_id = marketplace.catalog.intern(self.tea)
+        coffee_id = marketplace.catalog.intern(self.coffee)
+        self.assertEqual(len(marketplace.catalog), 2)
+        self.assertEqual(marketplace.inventory.queue_size(0), 0)
+        self.assertEqual(marketplace.inventory.queue_size(1), 1)
+        self.assertEqual(marketplace.inventory.count(tea_id), 0)
+        self.assertEqual(marketplace.inventory.count(coffee_id), 1)
+        self.assertEqual(marketplace.carts[kept].units, {tea_id: {0: 2}, coffee_id: {1: 2}})
+        self.assertEqual(marketplace.carts[other].units, {coffee_id: {1: 1}})
+        self.assertEqual(list(marketplace.free_cart_ids), [0])
+
+    def test_replay(self):
+        # imported here, the Marketplace doesn't depend on the journal module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+
+        marketplace = Marketplace(5, journal=Journal(self.directory.name))
+        kept, other = self.fill(marketplace)
+        marketplace.journal.close()
+
+        restored = Marketplace(5, journal=Journal(self.directory.name))
+        self.assert_restored(restored, kept, other)
+        self.assertEqual(restored.producer_id_gen, 1)
+        self.assertEqual(restored.place_order(kept), [self.tea] * 2 + [self.coffee] * 2)
+        self.assertEqual(restored.expire_carts(0), 1)
+        restored.journal.close()
+
+        # the restored Marketplace goes on with a new segment
+        journal = Journal(self.directory.name)
+        state = journal.load()
+        journal.close()
+        self.assertEqual(len(journal.files.segments()), 3)
+        self.assertEqual(state.carts, {})
+        self.assertEqual(state.queues, [0, 2])
+        self.assertEqual(state.stock, {1: {1: 2}})
+
+    def test_checkpoint(self):
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+
+        journal = Journal(self.directory.name)
+        marketplace = Marketplace(5, journal=journal)
+        kept, other = self.fill(marketplace)
+        journal.checkpoint()
+        marketplace.register_producer()
+        journal.close()
+
+        self.assertEqual(journal.files.segments(), [journal.files.segment])
+        restored = Marketplace(5, journal=Journal(self.directory.name))
+        self.assert_restored(restored, kept, other)
+        self.assertEqual(restored.producer_id_gen, 2)
+        restored.journal.close()
+
+    def test_torn_record(self):
+        journal = Journal(self.directory.name)
+        journal.register(0)
+        journal.publish(0, 0, 3)
+        self.assertTrue(journal.sync(timeout=1))
+        self.assertEqual(journal.commit.durable, 2 * RECORD.size)
+        journal.close()
+
+        with open(journal.files.segment_path(journal.files.segment), 'ab') as segment:
+            segment.write(RECORD.pack(PUBLISH, 0, 0, 1, 0)[:7])
+
+        journal = Journal(self.directory.name)
+        state = journal.load()
+        journal.close()
+        self.assertEqual(state.queues, [3])
+        self.assertEqual(state.stock, {0: {0: 3}})
+
+    def test_sync_orders(self):
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+
+        journal = Journal(self.directory.name)
+        marketplace = Marketplace(5, journal=journal)
+        # nothing can be written meanwhile, so the order doesn't wait for it
+        with journal.files.lock:
+            marketplace.place_order(marketplace.new_cart())
+            self.assertLess(journal.commit.durable, journal.commit.appended)
+
+        journal.sync_orders = True
+        marketplace.place_order(marketplace.new_cart())
+        self.assertEqual(journal.commit.durable, 4 * RECORD.size)
+        journal.close()
+
+    def test_flush_error(self):
+        journal = Journal(self.directory.name, sync_interval=60)
+        journal.register(0)
+        # the flusher can't write to a closed segment
+        journal.files.file.close()
+
+        with self.assertRaises(RuntimeError) as error:
+            journal.sync(timeout=1)
+        self.assertIsInstance(error.exception.__cause__, ValueError)
+        self.assertFalse(journal.commit.thread.is_alive())
+        self.assertRaises(RuntimeError, journal.close)
+
+    def test_save_load(self):
+        state = MarketState()
+        # an odd number of 32 bit ints before the carts, and a cart id beyond them
+        cart_id = 3 << CART_SLOT_BITS | 2
+        for record in [(REGISTER, 2, 0, 0, 0), (PUBLISH, 1, 7, 5, 0),
+                       (NEW_CART, cart_id, 0, 0, 0), (ADD, cart_id, 7, 1, 2)]:
+            state.apply(record)
+        state.apply((PRODUCT, 0, 0, 0, 0), json.dumps(['Tea', 'Test', 12, 'test type']))
+        state.segment = 4
+
+        path = os.path.join(self.directory.name, CHECKPOINT_NAME)
+        state.save(path)
+        loaded = MarketState.load(path)
+        self.assertEqual(vars(loaded), vars(state))
+        self.assertEqual(loaded.cart_slots, 3)
+        self.assertEqual(loaded.product(0), self.tea)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,54 +6,166 @@ Assignment 1
 March 2021
 """
 
+import gc
 import time
 import unittest
-import logging
-from threading import Lock
-from logging.handlers import RotatingFileHandler
-
+from collections import deque
+from threading import Lock, Thread
+
+from tema.cart import CART_SLOT_MASK, Cart, CartExpired, CartStripe, next_cart_id
+from tema.catalog import ProductCatalog
+from tema.consumer import Consumer
+from tema.index import ProductIndex, ProductQuery
+from tema.inventory import Inventory
+from tema.marketplace_log import method_logger
+from tema.policy import DEFAULT_POLICY
 from tema.product import Coffee, Tea
+from tema.snapshot import SnapshotPublisher
+
+# one logger per method, so the log level can be set per method
+REGISTER_PRODUCER_LOG = method_logger('register_producer')
+PUBLISH_LOG = method_logger('publish')
+NEW_CART_LOG = method_logger('new_cart')
+ADD_TO_CART_LOG = method_logger('add_to_cart')
+REMOVE_FROM_CART_LOG = method_logger('remove_from_cart')
+PLACE_ORDER_LOG = method_logger('place_order')
+PRINT_LOCK_LOG = method_logger('get_print_lock')
+EXPIRE_CARTS_LOG = method_logger('expire_carts')
+FIND_PRODUCTS_LOG = method_logger('find_products')
+ADD_MATCHING_LOG = method_logger('add_matching_to_cart')
+SNAPSHOT_LOG = method_logger('inventory_snapshot')
 
-logging.basicConfig(
-    handlers=[RotatingFileHandler('tema/marketplace.log', maxBytes=10000, backupCount=10)],
-    format='%(asctime)s - %(message)s',
-    level=logging.INFO
-    )
-
-logging.Formatter.converter = time.gmtime
 
 class Marketplace:
     """
     Class that represents the Marketplace. It's the central part of the implementation.
     The producers and consumers use its methods concurrently.
     """
-    def __init__(self, queue_size_per_producer):
+    def __init__(self, queue_size_per_producer, lock_stripes=16, *, journal=None,
+                 snapshot_interval=None, selection_policy=DEFAULT_POLICY):
         """
         Constructor
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type lock_stripes: Int
+        :param lock_stripes: the number of locks the products (and the carts) are split into
+
+        :type journal: Journal
+        :param journal: if given, the Marketplace starts from the state recorded in
+        the journal and records every change in it (nothing is recorded by default)
+
+        :type snapshot_interval: Float
+        :param snapshot_interval: if given, the changes of the stock are recorded
+        and inventory_snapshot() publishes them at most once every
+        snapshot_interval seconds (0 for every call)
+
+        :type selection_policy: String
+        :param selection_policy: the name of the policy that chooses the producer
+        whose units are added to a cart when several have the product, one of
+        policy.POLICIES (policy.MostRecentFirst by default)
         """
         self.queue_size_per_producer = queue_size_per_producer
         self.producer_id_gen = -1
+        # the queues and the carts store the ids the catalog gives to the products
+        self.catalog = ProductCatalog()
+        # the slots of the carts that have been ordered (or expired) are None,
+        # the ids the next carts in those slots get are on the free list, which
+        # is FIFO so that a freed id is reused as late as possible
         self.carts = []
-        self.queue = []
-        self.print_lock = Lock()
-        self.queue_lock = Lock()
+        self.free_cart_ids = deque()
+        self.journal = journal
+
+        snapshots = None
+        if snapshot_interval is not None:
+            snapshots = SnapshotPublisher(self.catalog, snapshot_interval)
+        # the stripes hold the product queues; the index of the products in
+        # stock by type, field values and price is only built by the first
+        # find_products, since it has a single lock that every product coming
+        # in stock or running out takes from then on
+        self.inventory = Inventory(lock_stripes, self.lock_factory('queue_lock'),
+                                   self.lock_factory('producer_lock'),
+                                   snapshots=snapshots, policy=selection_policy)
+        self.print_lock = self.lock_factory('print_lock')()
+        # guards the producer and cart id generation, the free cart ids and the
+        # building of the index (it is taken before the stripe locks)
+        self.register_lock = self.lock_factory('register_lock')()
+        cart_lock = self.lock_factory('cart_lock')
+        self.cart_stripes = [CartStripe(cart_lock()) for _ in range(lock_stripes)]
+
+        if journal is not None:
+            # everything the restore creates lives on, so collecting in the
+            # meanwhile would only slow it down
+            collecting = gc.isenabled()
+            gc.disable()
+            try:
+                self._restore(journal.load())
+            finally:
+                if collecting:
+                    gc.enable()
+            self.catalog.on_intern = journal.product
+
+    def lock_factory(self, name):
+        """
+        Returns the function that creates the locks of the given kind.
+
+        :type name: String
+        :param name: the kind of lock, e.g. 'cart_lock'
+        """
+        # pylint: disable=unused-argument
+        return Lock
+
+    def _restore(self, state):
+        """
+        Rebuilds the products, the producers' queues, the stock and the carts
+        from the state read from the journal.
+
+        :type state: MarketState
+        :param state: the state (its stock and carts are taken over)
+        """
+        for product_id in range(len(state.products)):
+            self.catalog.intern(state.product(product_id))
+
+        for producer_id, size in enumerate(state.queues):
+            self.inventory.register_producer(producer_id)
+            self.inventory.queue(producer_id).size = size
+        self.producer_id_gen = len(state.queues) - 1
+
+        for product_id, producers in state.stock.items():
+            self.inventory.stripe(product_id).stock[product_id] = producers
+            if self.inventory.snapshots is not None:
+                for producer_id, count in producers.items():
+                    self.inventory.snapshots.record(product_id, producer_id, count)
+
+        self.carts = [None] * state.cart_slots
+        for cart_id, units in state.carts.items():
+            cart = self.carts[cart_id & CART_SLOT_MASK] = Cart(cart_id)
+            cart.units = units
+            cart.size = sum(sum(producers.values()) for producers in units.values())
+            self._cart_stripe(cart_id).add(cart)
+        # the generations of the free slots aren't recorded, they start over
+        self.free_cart_ids = deque(slot for slot in range(state.cart_slots)
+                                   if self.carts[slot] is None)
 
     def register_producer(self):
         """
         Returns an id for the producer that calls this.
         """
-        logging.info('Entered register_producer')
+        REGISTER_PRODUCER_LOG.info('Entered register_producer')
 
-        self.producer_id_gen += 1
-        self.queue.append([])
+        with self.register_lock:
+            self.producer_id_gen += 1
+            producer_id = self.producer_id_gen
+            self.inventory.register_producer(producer_id)
+            if self.journal is not None:
+                self.journal.register(producer_id)
 
-        logging.info('Exited register_producer and returned producer id %s', self.producer_id_gen)
-        return self.producer_id_gen
+        REGISTER_PRODUCER_LOG.info('Exited register_producer and returned producer id %s',
+                                   producer_id)
+        return producer_id
 
-    def publish(self, producer_id, product):
+    def publish(self, producer_id, product, block=False, timeout=None):
         """
         Adds the product provided by the producer to the marketplace
 
@@ -63,20 +175,63 @@ class Marketplace:
         :type product: Product
         :param product: the Product that will be published in the Marketplace
 
+        :type block: Bool
+        :param block: if True and the producer's queue is full, wait until a
+        consumer frees a slot instead of returning False right away
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block (None means forever)
+
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
-        logging.info('Entered publish with producer_id=%s and product=%s', producer_id, product)
-        if producer_id > self.producer_id_gen:
-            logging.info('Producer not registered (in publish)')
-            return False
+        return self.publish_many(producer_id, product, 1, block, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, block=False, timeout=None):
+        """
+        Adds as many units of the product as fit in the producer's queue (at most quantity)
+
+        :type producer_id: String
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
 
-        if len(self.queue[producer_id]) >= self.queue_size_per_producer:
-            logging.info('Producer limit exceeded (in publish)')
-            return False
+        :type block: Bool
+        :param block: if True and the producer's queue is full, wait until a
+        consumer frees a slot instead of returning 0 right away
 
-        self.queue[producer_id].append(product)
-        logging.info('Exited publish with return value True')
-        return True
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block (None means forever)
+
+        :returns the number of units published. If it is less than quantity, the
+        caller should wait and then try again with the rest.
+        """
+        PUBLISH_LOG.info('Entered publish_many with producer_id=%s product=%s quantity=%s',
+                         producer_id, product, quantity)
+        if producer_id > self.producer_id_gen:
+            PUBLISH_LOG.info('Producer not registered (in publish_many)')
+            return 0
+
+        # first reserve the slots in the producer's queue, then make the units
+        # visible to the consumers
+        count = self.inventory.queue(producer_id).reserve(self.queue_size_per_producer,
+                                                          quantity, block, timeout)
+        if count == 0:
+            PUBLISH_LOG.info('Producer limit exceeded (in publish_many)')
+            return 0
+
+        product_id = self.catalog.intern(product)
+        stripe = self.inventory.stripe(product_id)
+        with stripe.lock:
+            stripe.add(producer_id, product_id, count)
+            if self.journal is not None:
+                self.journal.publish(producer_id, product_id, count)
+
+        PUBLISH_LOG.info('Exited publish_many with return value %s', count)
+        return count
 
     def new_cart(self):
         """
@@ -84,12 +239,65 @@ class Marketplace:
 
         :returns an int representing the cart_id
         """
-        logging.info('Entered new_cart')
-        self.carts.append([])
-        logging.info('Exited new_cart and returned cart id %s', len(self.carts) - 1)
-        return len(self.carts) - 1
+        NEW_CART_LOG.info('Entered new_cart')
+        with self.register_lock:
+            if self.free_cart_ids:
+                cart_id = self.free_cart_ids.popleft()
+            elif len(self.carts) <= CART_SLOT_MASK:
+                cart_id = len(self.carts)
+                self.carts.append(None)
+            else:
+                raise RuntimeError(f'more than {CART_SLOT_MASK + 1} carts in use')
+
+        cart = Cart(cart_id)
+        stripe = self._cart_stripe(cart_id)
+        with stripe.lock:
+            self.carts[cart_id & CART_SLOT_MASK] = cart
+            stripe.add(cart)
+            if self.journal is not None:
+                self.journal.new_cart(cart_id)
+        NEW_CART_LOG.info('Exited new_cart and returned cart id %s', cart_id)
+        return cart_id
+
+    def _cart_stripe(self, cart_id):
+        """
+        Returns the stripe that guards the cart (and the other ids of its slot).
+        """
+        return self.cart_stripes[(cart_id & CART_SLOT_MASK) % len(self.cart_stripes)]
+
+    def _cart(self, cart_id):
+        """
+        Returns the cart with the given id, or None if it has been ordered or
+        expired (or never existed). Must be called with its stripe's lock held.
+        """
+        slot = cart_id & CART_SLOT_MASK
+        cart = self.carts[slot] if slot < len(self.carts) else None
+        return cart if cart is not None and cart.cart_id == cart_id else None
 
-    def add_to_cart(self, cart_id, product):
+    def _free_cart(self, cart, stripe):
+        """
+        Frees the slot of a cart and puts the id of the slot's next cart on the
+        free list. Must be called with the stripe's lock held.
+        """
+        self.carts[cart.cart_id & CART_SLOT_MASK] = None
+        stripe.discard(cart)
+        with self.register_lock:
+            self.free_cart_ids.append(next_cart_id(cart.cart_id))
+
+    def _restock(self, units):
+        """
+        Puts units back in the stock of their producers.
+
+        :type units: List
+        :param units: a list of (product_id, producer_id, count) tuples
+        """
+        for product_id, producer_id, count in units:
+            self.inventory.queue(producer_id).restore(count)
+            stripe = self.inventory.stripe(product_id)
+            with stripe.lock:
+                stripe.add(producer_id, product_id, count)
+
+    def add_to_cart(self, cart_id, product, block=False, timeout=None):
         """
         Adds a product to the given cart. The method returns
 
@@ -99,27 +307,141 @@ class Marketplace:
         :type product: Product
         :param product: the product to add to cart
 
+        :type block: Bool
+        :param block: if True and the product is not available, wait until it
+        is published instead of returning False right away
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block (None means forever)
+
         :returns True or False. If the caller receives False, it should wait and then try again
         """
-        logging.info('Entered add_to_cart with cart_id=%s product=%s', cart_id, product)
-        with self.queue_lock:
+        return self.add_many_to_cart(cart_id, product, 1, block, timeout) == 1
+
+    def add_many_to_cart(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Adds as many units of the product as are available (at most quantity) to the given cart
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :type block: Bool
+        :param block: if True and the product is not available, wait until it
+        is published instead of returning 0 right away
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block (None means forever)
+
+        :returns the number of units added. If it is less than quantity, the
+        caller should wait and then try again with the rest.
+
+        :raises CartExpired: if the cart has been ordered or expired
+        """
+        ADD_TO_CART_LOG.info('Entered add_many_to_cart with cart_id=%s product=%s quantity=%s',
+                             cart_id, product, quantity)
+        product_id = self.catalog.intern(product)
+        stripe = self.inventory.stripe(product_id)
+        with stripe.lock:
             # use the lock so that another thread won't remove
-            # the same product from the queue at the same time
-            producer_id = -1
-            for temp_producer_id in range(self.producer_id_gen + 1):
-                if product in self.queue[temp_producer_id]:
-                    producer_id = temp_producer_id
+            # the same units from the queues at the same time
+            taken = stripe.take(product_id, quantity)
+            if not taken and block:
+                # join the product's wait list, the publishers hand the units over
+                taken = stripe.wait(product_id, quantity, timeout)
+
+        # exit if the product is not in the queue
+        if not taken:
+            ADD_TO_CART_LOG.info('Product not found in queue (in add_many_to_cart)')
+            return 0
+
+        for producer_id, count in taken:
+            self.inventory.queue(producer_id).release(count)
+
+        count = 0
+        cart_stripe = self._cart_stripe(cart_id)
+        with cart_stripe.lock:
+            cart = self._cart(cart_id)
+            if cart is not None:
+                cart_stripe.touch(cart)
+                for producer_id, producer_count in taken:
+                    cart.add(product_id, producer_id, producer_count)
+                    count += producer_count
+                    if self.journal is not None:
+                        self.journal.add(cart_id, product_id, producer_id, producer_count)
+
+        # the cart has been ordered or expired in the meantime
+        if cart is None:
+            ADD_TO_CART_LOG.info('Cart doesn\'t exist (in add_many_to_cart)')
+            self._restock([(product_id, producer_id, producer_count)
+                           for producer_id, producer_count in taken])
+            raise CartExpired(cart_id)
+
+        ADD_TO_CART_LOG.info('Exited add_many_to_cart with return value %s', count)
+        return count
+
+    def find_products(self, query):
+        """
+        Returns the products in stock that match a query, cheapest first. Only the
+        products of the query's narrowest field value or price range are checked.
+        The first call builds the index of the products in stock.
 
-            # exit if the product is not in the queue
-            if producer_id == -1:
-                logging.info('Product not found in queue (in add_to_cart)')
-                return False
+        :type query: ProductQuery
+        :param query: the products wanted, e.g. ProductQuery(Coffee, roast_level='DARK',
+        max_price=5)
+        """
+        FIND_PRODUCTS_LOG.info('Entered find_products')
+        index = self.inventory.index
+        if index is None:
+            with self.register_lock:
+                if self.inventory.index is None:
+                    self.inventory.enable_index(ProductIndex(self.catalog))
+                index = self.inventory.index
+
+        products = [self.catalog.product(product_id) for product_id in index.find(query)]
+        FIND_PRODUCTS_LOG.info('Exited find_products with %s products', len(products))
+        return products
+
+    def add_matching_to_cart(self, cart_id, query, quantity=1):
+        """
+        Adds up to quantity units of the products in stock that match a query
+        to the given cart, cheapest first.
 
-            self.carts[cart_id].append((product, producer_id))
-            self.queue[producer_id].remove(product)
+        :type cart_id: Int
+        :param cart_id: id cart
 
-            logging.info('Exited add_to_cart with return value True')
-            return True
+        :type query: ProductQuery or Function
+        :param query: the products wanted; a function is used as the predicate
+        of a query that accepts any product
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :returns a list of (product, count) pairs with the units added. If they are
+        less than quantity, the caller should wait and then try again with the rest.
+        """
+        ADD_MATCHING_LOG.info('Entered add_matching_to_cart with cart_id=%s quantity=%s',
+                              cart_id, quantity)
+        if not isinstance(query, ProductQuery):
+            query = ProductQuery(predicate=query)
+
+        added = []
+        for product in self.find_products(query):
+            # another consumer may have taken the last units in the meanwhile
+            count = self.add_many_to_cart(cart_id, product, quantity)
+            if count:
+                added.append((product, count))
+                quantity -= count
+            if quantity == 0:
+                break
+
+        ADD_MATCHING_LOG.info('Exited add_matching_to_cart with %s products', len(added))
+        return added
 
     def remove_from_cart(self, cart_id, product):
         """
@@ -131,43 +453,160 @@ class Marketplace:
         :type product: Product
         :param product: the product to remove from cart
         """
-        logging.info('Entered remove_to_cart with cart_id=%s product=%s', cart_id, product)
+        self.remove_many_from_cart(cart_id, product, 1)
 
-        producer_id = -1
-        for pair in self.carts[cart_id]:
-            if pair[0] == product:
-                producer_id = pair[1]
+    def remove_many_from_cart(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of a product from cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove
+
+        :returns the number of units removed
+
+        :raises CartExpired: if the cart has been ordered or expired
+        """
+        REMOVE_FROM_CART_LOG.info(
+            'Entered remove_many_from_cart with cart_id=%s product=%s quantity=%s',
+            cart_id, product, quantity)
+
+        product_id = self.catalog.intern(product)
+
+        # units to give back to each producer
+        cart_stripe = self._cart_stripe(cart_id)
+        with cart_stripe.lock:
+            cart = self._cart(cart_id)
+            if cart is None:
+                REMOVE_FROM_CART_LOG.info('Cart doesn\'t exist (in remove_many_from_cart)')
+                raise CartExpired(cart_id)
+
+            cart_stripe.touch(cart)
+            removed = cart.remove(product_id, quantity)
+            if self.journal is not None:
+                for producer_id, count in removed:
+                    self.journal.remove(cart_id, product_id, producer_id, count)
 
         # exit if the product is not in the cart
-        if producer_id == -1:
-            logging.info('Product not in the cart (in remove_from_cart)')
-            return
+        if not removed:
+            REMOVE_FROM_CART_LOG.info('Product not in the cart (in remove_many_from_cart)')
+            return 0
+
+        for producer_id, count in removed:
+            self.inventory.queue(producer_id).restore(count)
+
+        stripe = self.inventory.stripe(product_id)
+        with stripe.lock:
+            for producer_id, count in removed:
+                stripe.add(producer_id, product_id, count)
 
-        self.carts[cart_id].remove((product, producer_id))
-        self.queue[producer_id].append(product)
-        logging.info('Exited remove_from_cart')
+        REMOVE_FROM_CART_LOG.info('Exited remove_many_from_cart')
+        return sum(count for _, count in removed)
 
     def place_order(self, cart_id):
         """
-        Return a list with all the products in the cart.
+        Return a list with all the products in the cart. The cart is then freed
+        and its slot is given to a new cart.
 
         :type cart_id: Int
         :param cart_id: id cart
+
+        :raises CartExpired: if the cart has already been ordered or has expired
+        """
+        return [product for product, count in self.place_order_lines(cart_id)
+                for _ in range(count)]
+
+    def place_order_lines(self, cart_id):
+        """
+        Return a list of (product, count) pairs, one for every product in the cart.
+        The cart is then freed and its slot is given to a new cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :raises CartExpired: if the cart has already been ordered or has expired
         """
-        logging.info('Entered place_order with cart_id=%s', cart_id)
-        if len(self.carts) <= cart_id:
-            logging.info('Cart doens\'t exist (in place_order)')
+        PLACE_ORDER_LOG.info('Entered place_order with cart_id=%s', cart_id)
+        if len(self.carts) <= cart_id & CART_SLOT_MASK:
+            PLACE_ORDER_LOG.info('Cart doens\'t exist (in place_order)')
             return []
 
-        cart = list(map(lambda pair: pair[0], self.carts[cart_id]))
-        logging.info('Exited place_order succesfully')
-        return cart
+        cart_stripe = self._cart_stripe(cart_id)
+        with cart_stripe.lock:
+            cart = self._cart(cart_id)
+            if cart is None:
+                PLACE_ORDER_LOG.info('Cart already ordered or expired (in place_order)')
+                raise CartExpired(cart_id)
+
+            lines = [(self.catalog.product(product_id), count)
+                     for product_id, count in cart.lines()]
+            self._free_cart(cart, cart_stripe)
+            if self.journal is not None:
+                self.journal.order(cart_id)
+
+        # with sync_orders, the order is reported only once it is on disk
+        if self.journal is not None and self.journal.sync_orders:
+            self.journal.sync()
+        PLACE_ORDER_LOG.info('Exited place_order succesfully')
+        return lines
+
+    def expire_carts(self, max_idle):
+        """
+        Frees the carts that haven't been used for max_idle seconds and puts
+        their products back in the producers' queues.
+
+        :type max_idle: Float
+        :param max_idle: the number of seconds after which an unused cart expires
+
+        :returns the number of carts expired
+        """
+        EXPIRE_CARTS_LOG.info('Entered expire_carts with max_idle=%s', max_idle)
+        deadline = time.monotonic() - max_idle
+        expired = 0
+
+        # only the idle carts at the front of every stripe are looked at
+        for stripe in self.cart_stripes:
+            units = []
+            with stripe.lock:
+                for cart in stripe.idle(deadline):
+                    units += cart.clear()
+                    self._free_cart(cart, stripe)
+                    if self.journal is not None:
+                        self.journal.expire(cart.cart_id)
+                    expired += 1
+
+            self._restock(units)
+
+        EXPIRE_CARTS_LOG.info('Exited expire_carts with return value %s', expired)
+        return expired
+
+    def inventory_snapshot(self):
+        """
+        Returns an immutable InventorySnapshot of the stock: the units of every
+        product from every producer, with a version that grows with every new
+        snapshot. It never waits for (or holds up) the other methods.
+
+        :returns None if the Marketplace was made without a snapshot_interval
+        """
+        SNAPSHOT_LOG.info('Entered inventory_snapshot')
+        if self.inventory.snapshots is None:
+            SNAPSHOT_LOG.info('Snapshots not enabled (in inventory_snapshot)')
+            return None
+
+        snapshot = self.inventory.snapshots.get()
+        SNAPSHOT_LOG.info('Exited inventory_snapshot with version %s', snapshot.version)
+        return snapshot
 
     def get_print_lock(self):
         """
         Return the lock used for printing
         """
-        logging.info('Entered get_print_lock')
+        PRINT_LOCK_LOG.info('Entered get_print_lock')
         return self.print_lock
 
 class TestMarketplace(unittest.TestCase):
@@ -212,7 +651,9 @@ class TestMarketplace(unittest.TestCase):
         marketplace.register_producer()
         marketplace.publish(0, Tea(name='Test', price=12, type='test type'))
         self.assertTrue(marketplace.add_to_cart(0, Tea(name='Test', price=12, type='test type')))
-        self.assertEqual([(Tea(name='Test', price=12, type='test type'), 0)], marketplace.carts[0])
+        self.assertEqual([(0, 1)], marketplace.carts[0].lines())
+        self.assertEqual(marketplace.catalog.product(0),
+                         Tea(name='Test', price=12, type='test type'))
 
     def test_remove_from_cart(self):
         marketplace = Marketplace(20)
@@ -223,12 +664,12 @@ class TestMarketplace(unittest.TestCase):
 
         marketplace.remove_from_cart(0, Tea(name='Test', price=12, type='test type'))
 
-        self.assertEqual([], marketplace.carts[0])
+        self.assertEqual(0, len(marketplace.carts[0]))
 
         marketplace.add_to_cart(0, Tea(name='Test', price=12, type='test type'))
         marketplace.remove_from_cart(0, Tea(name='Test', price=12, type='test type'))
 
-        self.assertEqual([], marketplace.carts[0])
+        self.assertEqual(0, len(marketplace.carts[0]))
 
     def test_place_order(self):
         marketplace = Marketplace(5)
@@ -248,9 +689,305 @@ class TestMarketplace(unittest.TestCase):
 
         self.assertEqual(marketplace.place_order(0), ref)
 
+    def test_add_to_cart_blocking(self):
+        marketplace = Marketplace(5)
+
+        marketplace.new_cart()
+        marketplace.register_producer()
+        tea = Tea(name='Test', price=12, type='test type')
+        self.assertFalse(marketplace.add_to_cart(0, tea, block=True, timeout=0.01))
+
+        publisher = Thread(target=marketplace.publish, args=(0, tea))
+        publisher.start()
+        self.assertTrue(marketplace.add_to_cart(0, tea, block=True, timeout=5))
+        publisher.join()
+        self.assertEqual({marketplace.catalog.intern(tea): {0: 1}}, marketplace.carts[0].units)
+
+    def test_publish_blocking(self):
+        marketplace = Marketplace(1)
+
+        marketplace.new_cart()
+        marketplace.register_producer()
+        tea = Tea(name='Test', price=12, type='test type')
+        marketplace.publish(0, tea)
+        self.assertFalse(marketplace.publish(0, tea, block=True, timeout=0.01))
+
+        consumer = Thread(target=marketplace.add_to_cart, args=(0, tea))
+        consumer.start()
+        self.assertTrue(marketplace.publish(0, tea, block=True, timeout=5))
+        consumer.join()
+        self.assertEqual(marketplace.inventory.queue_size(0), 1)
+
+    def test_add_many_to_cart(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+
+        marketplace.new_cart()
+        marketplace.register_producer()
+        marketplace.register_producer()
+        self.assertEqual(marketplace.publish_many(0, tea, 3), 3)
+        self.assertEqual(marketplace.publish_many(1, tea, 10), 5)
+        self.assertEqual(marketplace.publish_many(1, tea, 10), 0)
+
+        self.assertEqual(marketplace.add_many_to_cart(0, tea, 7), 7)
+        self.assertEqual(marketplace.add_many_to_cart(0, tea, 7), 1)
+        self.assertEqual(marketplace.add_many_to_cart(0, tea, 7, block=True, timeout=0.01), 0)
+        self.assertEqual(marketplace.place_order(0), [tea] * 8)
+        self.assertEqual(marketplace.inventory.queue_size(0), 0)
+        self.assertEqual(marketplace.inventory.queue_size(1), 0)
+
+    def test_add_matching_to_cart(self):
+        marketplace = Marketplace(5)
+        oolong = Tea(name='Oolong', price=7, type='Oolong')
+        cheap_oolong = Tea(name='Oolong 2', price=3, type='Oolong')
+        dark = Coffee(name='Dark', price=5, acidity='5.05', roast_level='DARK')
+
+        cart_id = marketplace.new_cart()
+        marketplace.register_producer()
+        marketplace.publish_many(0, oolong, 2)
+        marketplace.publish_many(0, cheap_oolong, 1)
+        marketplace.publish_many(0, dark, 1)
+
+        query = ProductQuery(Tea, type='Oolong')
+        self.assertEqual(marketplace.find_products(query), [cheap_oolong, oolong])
+        self.assertEqual(marketplace.add_matching_to_cart(cart_id, query, 2),
+                         [(cheap_oolong, 1), (oolong, 1)])
+        self.assertEqual(marketplace.find_products(ProductQuery(max_price=5)), [dark])
+        self.assertEqual(marketplace.add_matching_to_cart(
+            cart_id, lambda product: product.price > 5, 2), [(oolong, 1)])
+        self.assertEqual(marketplace.add_matching_to_cart(cart_id, query), [])
+
+        # the removed units can be found again
+        marketplace.remove_from_cart(cart_id, cheap_oolong)
+        self.assertEqual(marketplace.find_products(query), [cheap_oolong])
+
+    def test_inventory_snapshot(self):
+        self.assertIsNone(Marketplace(5).inventory_snapshot())
+
+        marketplace = Marketplace(5, snapshot_interval=0)
+        tea = Tea(name='Test', price=12, type='test type')
+        cart_id = marketplace.new_cart()
+        marketplace.register_producer()
+        marketplace.register_producer()
+        marketplace.publish_many(0, tea, 3)
+        marketplace.publish_many(1, tea, 2)
+
+        snapshot = marketplace.inventory_snapshot()
+        self.assertEqual(snapshot.count(tea), 5)
+        self.assertEqual(dict(snapshot.producers), {0: 3, 1: 2})
+
+        marketplace.add_many_to_cart(cart_id, tea, 4)
+        newer = marketplace.inventory_snapshot()
+        self.assertGreater(newer.version, snapshot.version)
+        self.assertEqual(newer.count(tea), 1)
+        self.assertEqual(snapshot.count(tea), 5)
+
+        marketplace.remove_from_cart(cart_id, tea)
+        self.assertEqual(marketplace.inventory_snapshot().count(tea), 2)
+
+    def test_remove_many_from_cart(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+        coffee = Coffee(name='Test', price=12, acidity='test type', roast_level='MEDIUM')
+
+        marketplace.new_cart()
+        marketplace.register_producer()
+        marketplace.publish_many(0, tea, 3)
+        marketplace.publish_many(0, coffee, 2)
+        marketplace.add_many_to_cart(0, tea, 3)
+        marketplace.add_many_to_cart(0, coffee, 2)
+
+        self.assertEqual(marketplace.remove_many_from_cart(0, tea, 2), 2)
+        self.assertEqual(marketplace.remove_many_from_cart(0, tea, 2), 1)
+        self.assertEqual(marketplace.remove_many_from_cart(0, tea, 2), 0)
+        self.assertEqual(marketplace.place_order(0), [coffee, coffee])
+        self.assertEqual(marketplace.inventory.count(marketplace.catalog.intern(tea)), 3)
+        self.assertEqual(marketplace.inventory.queue_size(0), 3)
+
+    def test_stress(self):
+        marketplace = Marketplace(200, lock_stripes=4)
+        products = [Tea(name=f'Test {i}', price=i, type='test type') for i in range(8)]
+        units = 200
+
+        def produce():
+            producer_id = marketplace.register_producer()
+            for i in range(units):
+                marketplace.publish(producer_id, products[i % len(products)], block=True)
+
+        def consume(index):
+            cart_id = marketplace.new_cart()
+            for i in range(units):
+                product = products[(i + index) % len(products)]
+                marketplace.add_to_cart(cart_id, product, block=True)
+                if i % 4 == 0:
+                    marketplace.remove_from_cart(cart_id, product)
+
+        threads = [Thread(target=produce) for _ in range(4)]
+        threads += [Thread(target=consume, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        # every published unit is either in a cart or back in a producer's queue
+        bought = sum(len(marketplace.place_order(i)) for i in range(4))
+        queued = sum(marketplace.inventory.queue_size(i) for i in range(4))
+        self.assertEqual(bought, 4 * units - 4 * units // 4)
+        self.assertEqual(bought + queued, 4 * units)
+        self.assertEqual(queued, sum(marketplace.inventory.count(marketplace.catalog.intern(p))
+                                     for p in products))
+
+    def test_place_order_lines(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+        coffee = Coffee(name='Test', price=12, acidity='test type', roast_level='MEDIUM')
+        self.assertEqual(marketplace.place_order_lines(0), [])
+
+        marketplace.new_cart()
+        marketplace.register_producer()
+        marketplace.register_producer()
+        marketplace.publish_many(0, tea, 2)
+        marketplace.publish_many(1, tea, 2)
+        marketplace.publish_many(1, coffee, 1)
+        marketplace.add_many_to_cart(0, tea, 4)
+        marketplace.add_many_to_cart(0, coffee, 1)
+        marketplace.remove_from_cart(0, tea)
+
+        self.assertEqual(marketplace.place_order_lines(0), [(tea, 3), (coffee, 1)])
+
     def test_get_print_lock(self):
         marketplace = Marketplace(5)
         self.assertEqual(marketplace.get_print_lock(), marketplace.print_lock)
 
+
+class TestCartLifecycle(unittest.TestCase):
+    """
+    Class for testing how the Marketplace frees, recycles and expires the carts
+    """
+
+    def test_cart_lifecycle(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+
+        marketplace.register_producer()
+        marketplace.publish_many(0, tea, 2)
+        self.assertEqual(marketplace.new_cart(), 0)
+        self.assertEqual(marketplace.new_cart(), 1)
+        marketplace.add_to_cart(0, tea)
+        self.assertEqual(marketplace.place_order(0), [tea])
+
+        # the ordered cart is freed, its id is rejected and the unit taken
+        # for it goes back
+        self.assertIsNone(marketplace.carts[0])
+        self.assertRaises(CartExpired, marketplace.place_order, 0)
+        self.assertRaises(CartExpired, marketplace.add_to_cart, 0, tea)
+        self.assertRaises(CartExpired, marketplace.remove_from_cart, 0, tea)
+        self.assertEqual(marketplace.inventory.count(0), 1)
+
+        # the slot is recycled with a new id, the old one doesn't reach the new cart
+        cart_id = marketplace.new_cart()
+        self.assertEqual(cart_id & CART_SLOT_MASK, 0)
+        self.assertNotEqual(cart_id, 0)
+        self.assertEqual(len(marketplace.carts), 2)
+        self.assertRaises(CartExpired, marketplace.add_to_cart, 0, tea)
+        self.assertTrue(marketplace.add_to_cart(cart_id, tea))
+        self.assertEqual(marketplace.place_order(cart_id), [tea])
+
+    def test_free_cart_ids(self):
+        marketplace = Marketplace(5)
+        first, second = marketplace.new_cart(), marketplace.new_cart()
+        marketplace.place_order(first)
+        marketplace.place_order(second)
+
+        # the slot freed first is reused first
+        self.assertEqual(marketplace.new_cart() & CART_SLOT_MASK, first)
+        self.assertEqual(marketplace.new_cart() & CART_SLOT_MASK, second)
+
+    def test_many_carts(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+        marketplace.register_producer()
+        marketplace.publish(0, tea)
+
+        # there is no cap on the carts open at once
+        cart_ids = [marketplace.new_cart() for _ in range(70000)]
+        self.assertEqual(cart_ids, list(range(70000)))
+        self.assertTrue(marketplace.add_to_cart(cart_ids[-1], tea))
+        self.assertEqual(marketplace.place_order(cart_ids[-1]), [tea])
+
+    def test_expire_carts(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+
+        marketplace.register_producer()
+        marketplace.publish_many(0, tea, 3)
+        marketplace.new_cart()
+        marketplace.add_many_to_cart(0, tea, 2)
+        self.assertEqual(marketplace.inventory.queue_size(0), 1)
+
+        self.assertEqual(marketplace.expire_carts(60), 0)
+        self.assertEqual(marketplace.expire_carts(0), 1)
+        self.assertIsNone(marketplace.carts[0])
+        self.assertEqual(marketplace.inventory.queue_size(0), 3)
+        self.assertEqual(marketplace.inventory.count(0), 3)
+        self.assertRaises(CartExpired, marketplace.add_many_to_cart, 0, tea, 1)
+        self.assertEqual(marketplace.inventory.count(0), 3)
+
+    def test_consumer_expired_cart(self):
+        marketplace = Marketplace(5)
+        tea = Tea(name='Test', price=12, type='test type')
+        orders = []
+        consumer = Consumer([[{'type': 'add', 'product': tea, 'quantity': 2}]], marketplace,
+                            0.01, output=lambda name, lines: orders.append(lines))
+
+        marketplace.register_producer()
+        marketplace.publish(0, tea)
+        consumer.start()
+        while marketplace.inventory.count(0):
+            time.sleep(0.001)
+
+        # the consumer starts over in a new cart and gets both units
+        self.assertEqual(marketplace.expire_carts(0), 1)
+        marketplace.publish(0, tea)
+        consumer.join(5)
+        self.assertEqual(orders, [[(tea, 2)]])
+
+    def test_expire_idle_carts(self):
+        marketplace = Marketplace(5, lock_stripes=1)
+        tea = Tea(name='Test', price=12, type='test type')
+
+        marketplace.register_producer()
+        marketplace.publish_many(0, tea, 2)
+        idle, used = marketplace.new_cart(), marketplace.new_cart()
+        marketplace.add_to_cart(idle, tea)
+        deadline = time.monotonic()
+        time.sleep(0.01)
+        marketplace.add_to_cart(used, tea)
+
+        # only the cart left alone since before the deadline expires
+        self.assertEqual(marketplace.expire_carts(time.monotonic() - deadline), 1)
+        self.assertIsNone(marketplace.carts[idle])
+        self.assertEqual(marketplace.place_order(used), [tea])
+
+    def test_soak(self):
+        marketplace = Marketplace(5)
+        teas = [Tea(name=f'Test {i}', price=i, type='test type') for i in range(10)]
+        marketplace.register_producer()
+
+        for i in range(20000):
+            cart_id = marketplace.new_cart()
+            marketplace.publish_many(0, teas[i % 10], 2)
+            marketplace.add_many_to_cart(cart_id, teas[i % 10], 2)
+            marketplace.remove_from_cart(cart_id, teas[i % 10])
+            self.assertEqual(marketplace.place_order_lines(cart_id), [(teas[i % 10], 1)])
+            # the unit put back is bought by the next cart
+            cart_id = marketplace.new_cart()
+            marketplace.add_to_cart(cart_id, teas[i % 10])
+            marketplace.place_order(cart_id)
+
+        self.assertEqual(len(marketplace.carts), 1)
+        self.assertEqual(marketplace.inventory.queue_size(0), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,249 @@
+"""
+This module represents the logging of the Marketplace.
+
+Every Marketplace method logs through its own child of the 'tema.marketplace'
+logger, so the level can be set per method. The records are handed to a
+background thread that formats them and writes them to a rotating file, so
+neither the formatting nor the file rotations happen on the caller's thread.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import atexit
+import logging
+import os
+import queue
+import tempfile
+import time
+import unittest
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from threading import Thread
+
+LOGGER_NAME = 'tema.marketplace'
+DEFAULT_LOG_PATH = 'tema/marketplace.log'
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 10
+LOG_FORMAT = '%(asctime)s - %(message)s'
+
+
+def method_logger(method):
+    """
+    Returns the logger used by a Marketplace method.
+
+    :type method: String
+    :param method: the name of the method
+    """
+    return logging.getLogger(f'{LOGGER_NAME}.{method}')
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting of the message (and of its
+    arguments) to the background thread.
+    """
+
+    def prepare(self, record):
+        """
+        Returns the record as it is, the queue never leaves the process.
+        """
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """
+    Filter that lets through only one record out of every n.
+    """
+
+    def __init__(self, every):
+        """
+        Constructor
+
+        :type every: Int
+        :param every: keep one record out of every records
+        """
+        super().__init__()
+        self.every = every
+        # next() on an itertools.count is atomic, the records of several
+        # threads can't get the same number
+        self.counter = count(1)
+
+    def filter(self, record):
+        """
+        Returns True for one record out of every n.
+        """
+        return next(self.counter) % self.every == 0
+
+
+def setup_logging(path=DEFAULT_LOG_PATH, level=logging.INFO, method_levels=None, sample=1, *,
+                  max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+    """
+    Configures the Marketplace logging and starts the background writer thread.
+
+    :type path: String
+    :param path: the log file
+
+    :type level: Int
+    :param level: the level of all the Marketplace methods
+
+    :type method_levels: Dict
+    :param method_levels: the level of specific methods (method name -> level)
+
+    :type sample: Int
+    :param sample: write only one record out of every sample records
+
+    :type max_bytes: Int
+    :param max_bytes: the size at which the log file is rotated
+
+    :type backup_count: Int
+    :param backup_count: the number of rotated files kept
+
+    :returns the QueueListener that writes the records; it is stopped (and the
+    queue flushed) at exit
+    """
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                       encoding='utf-8')
+    formatter = logging.Formatter(LOG_FORMAT)
+    formatter.converter = time.gmtime
+    file_handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    if sample > 1:
+        handler.addFilter(SampleFilter(sample))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    for method, method_level in (method_levels or {}).items():
+        method_logger(method).setLevel(method_level)
+
+    listener = QueueListener(records, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
+
+
+def stop_logging(listener):
+    """
+    Stops the background writer thread after it writes the queued records.
+
+    :type listener: QueueListener
+    :param listener: the listener returned by setup_logging
+    """
+    atexit.unregister(listener.stop)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def log_to_queue(records):
+    """
+    Sends the Marketplace records of this process to the process that reads
+    them with forward_records(): a child process doesn't have the writer
+    thread of its parent.
+
+    :type records: Queue
+    :param records: a multiprocessing.Queue shared with the parent
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(QueueHandler(records))
+
+
+def forward_records(records):
+    """
+    Starts a thread that hands the records sent by log_to_queue() in other
+    processes to the Marketplace handlers of this one.
+
+    :type records: Queue
+    :param records: a multiprocessing.Queue shared with the children
+
+    :returns the QueueListener that forwards the records
+    """
+    listener = QueueListener(records, *logging.getLogger(LOGGER_NAME).handlers,
+                             respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class TestMarketplaceLog(unittest.TestCase):
+    """
+    Class for testing the Marketplace logging
+    """
+
+    def tearDown(self):
+        logger = logging.getLogger(LOGGER_NAME)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+        method_logger('publish').setLevel(logging.NOTSET)
+
+    def read_log(self, **kwargs):
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, 'marketplace.log')
+            listener = setup_logging(path, **kwargs)
+            for i in range(10):
+                method_logger('publish').info('publish %s', i)
+                method_logger('new_cart').info('new_cart %s', i)
+            stop_logging(listener)
+
+            with open(path, encoding='utf-8') as log_file:
+                return log_file.read()
+
+    def test_setup_logging(self):
+        log = self.read_log()
+        self.assertIn('publish 9', log)
+        self.assertIn('new_cart 9', log)
+
+    def test_method_levels(self):
+        log = self.read_log(method_levels={'publish': logging.WARNING})
+        self.assertNotIn('publish', log)
+        self.assertIn('new_cart 9', log)
+
+    def test_sample(self):
+        log = self.read_log(sample=5)
+        self.assertEqual(len(log.splitlines()), 4)
+
+    def test_forward_records(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, 'marketplace.log')
+            listener = setup_logging(path)
+            records = queue.SimpleQueue()
+            forwarder = forward_records(records)
+
+            # what a child process does with the records of its Marketplace
+            log_to_queue(records)
+            method_logger('publish').info('publish %s', 1)
+            forwarder.stop()
+            stop_logging(listener)
+
+            with open(path, encoding='utf-8') as log_file:
+                self.assertIn('publish 1', log_file.read())
+
+    def test_sample_threads(self):
+        sample_filter = SampleFilter(10)
+        kept = []
+
+        def log():
+            kept.append(sum(sample_filter.filter(None) for _ in range(10000)))
+
+        threads = [Thread(target=log) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(kept), 4000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,376 @@
+"""
+This module represents the metrics of the Marketplace: counters and latency
+histograms for the Marketplace methods and locks.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import unittest
+from functools import wraps
+from threading import Condition, Lock, Thread, get_ident, local
+from time import perf_counter_ns, sleep
+
+
+class Histogram:
+    """
+    Class that represents a latency histogram with power of two buckets (in ns),
+    guarded by its own lock.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.lock = Lock()
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """
+        Records a latency.
+
+        :type value: Int
+        :param value: the latency in nanoseconds
+        """
+        with self.lock:
+            self.buckets[min(value.bit_length(), 63)] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket that holds the given percentile.
+
+        :type fraction: Float
+        :param fraction: the percentile, between 0 and 1
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                # the bucket holds the values of bucket bits
+                return min(2 ** bucket - 1, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Returns a dict with the count, the mean, p50, p99 and the max latency.
+        """
+        with self.lock:
+            return {'count': self.count,
+                    'mean': self.total // self.count if self.count else 0,
+                    'p50': self.percentile(0.5),
+                    'p99': self.percentile(0.99),
+                    'max': self.max}
+
+
+class Count:
+    """
+    Class that represents a counter guarded by its own lock.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.lock = Lock()
+        self.value = 0
+
+    def add(self, value):
+        """
+        Increments the counter.
+
+        :type value: Int
+        :param value: the increment
+        """
+        with self.lock:
+            self.value += value
+
+
+class Metrics:
+    """
+    Class that keeps named counters and latency histograms. It is thread safe:
+    every counter and histogram has its own lock, so the threads only wait for
+    each other to record under the same name, and the lock of the Metrics is
+    only taken to add a name.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        """
+        Increments a counter.
+
+        :type name: String
+        :param name: the name of the counter
+
+        :type value: Int
+        :param value: the increment
+        """
+        counter = self.counters.get(name)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(name, Count())
+        counter.add(value)
+
+    def observe(self, name, value):
+        """
+        Records a latency in a histogram.
+
+        :type name: String
+        :param name: the name of the histogram
+
+        :type value: Int
+        :param value: the latency in nanoseconds
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(value)
+
+    def lock_factory(self, name):
+        """
+        Returns a function that creates TimedLocks recorded under name.
+
+        :type name: String
+        :param name: the name of the locks
+        """
+        return lambda: TimedLock(self, name)
+
+    def snapshot(self):
+        """
+        Returns a dict with the counters and the latency histograms (in ns).
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = sorted(self.histograms.items())
+        return {'counters': {name: counter.value for name, counter in counters.items()},
+                'latency_ns': {name: histogram.snapshot() for name, histogram in histograms}}
+
+
+def timed_methods(names, failing=()):
+    """
+    Returns a class decorator that wraps the named methods of the class (or of
+    its bases) so that they record their latency in self.metrics.
+
+    :type names: List
+    :param names: the names of the methods, also used as the histogram names
+
+    :type failing: Set
+    :param failing: the methods whose failed calls (that return False or 0)
+    are also counted as '<name>.failed', only by the outermost of them when
+    they call each other (e.g. publish calls publish_many)
+    """
+    # the thread is in a call of one of the failing methods
+    calls = local()
+
+    def timed_method(name, method):
+        count_failures = name in failing
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            outer = count_failures and not getattr(calls, 'failing', False)
+            if outer:
+                calls.failing = True
+            start = perf_counter_ns()
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                if outer:
+                    calls.failing = False
+            self.metrics.observe(name, perf_counter_ns() - start)
+            if outer and not result:
+                self.metrics.incr(name + '.failed')
+            return result
+
+        return wrapper
+
+    def decorate(cls):
+        for name in names:
+            setattr(cls, name, timed_method(name, getattr(cls, name)))
+        return cls
+
+    return decorate
+
+
+class TimedLock:
+    """
+    Class that wraps a Lock and records how long the threads wait for it
+    ('lock.<name>.wait') and how long they hold it ('lock.<name>.hold').
+    It can be used as the lock of a Condition; the time spent waiting on the
+    condition is not counted.
+    """
+
+    def __init__(self, metrics, name):
+        """
+        Constructor
+
+        :type metrics: Metrics
+        :param metrics: where the times are recorded
+
+        :type name: String
+        :param name: the name of the lock
+        """
+        self.lock = Lock()
+        self.metrics = metrics
+        self.wait_name = f'lock.{name}.wait'
+        self.hold_name = f'lock.{name}.hold'
+        self.acquired_at = 0
+        # the thread that holds the lock, for Condition
+        self.owner = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the lock, recording the time spent waiting for it.
+        """
+        start = perf_counter_ns()
+        # this is the lock, the caller releases it
+        acquired = self.lock.acquire(blocking, timeout)  # pylint: disable=consider-using-with
+        if acquired:
+            self.owner = get_ident()
+            self.acquired_at = perf_counter_ns()
+            self.metrics.observe(self.wait_name, self.acquired_at - start)
+        return acquired
+
+    def release(self):
+        """
+        Releases the lock, recording the time it was held.
+        """
+        held = perf_counter_ns() - self.acquired_at
+        self.owner = None
+        self.lock.release()
+        self.metrics.observe(self.hold_name, held)
+
+    def locked(self):
+        """
+        Returns True if the lock is held.
+        """
+        return self.lock.locked()
+
+    def _release_save(self):
+        self.release()
+
+    def _acquire_restore(self, _):
+        # woken up from a condition wait, not a lock wait
+        self.lock.acquire()  # pylint: disable=consider-using-with
+        self.owner = get_ident()
+        self.acquired_at = perf_counter_ns()
+
+    def _is_owned(self):
+        return self.owner == get_ident()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Class for testing the metrics
+    """
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.record(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['mean'], 50)
+        self.assertEqual(snapshot['p50'], 63)
+        self.assertEqual(snapshot['p99'], 100)
+
+    def test_threads(self):
+        metrics = Metrics()
+
+        def record(index):
+            for value in range(1000):
+                metrics.observe('shared', value)
+                metrics.observe(f'own {index}', value)
+                metrics.incr('calls')
+
+        threads = [Thread(target=record, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'calls': 4000})
+        self.assertEqual(snapshot['latency_ns']['shared']['count'], 4000)
+        self.assertEqual(snapshot['latency_ns']['own 3']['count'], 1000)
+
+    def test_timed_methods(self):
+        @timed_methods(['method', 'other'], {'method'})
+        class Timed:
+            # pylint: disable=missing-class-docstring, missing-function-docstring
+            def __init__(self):
+                self.metrics = Metrics()
+
+            def method(self, value):
+                return value
+
+            def other(self, value):
+                return value
+
+        timed = Timed()
+        timed.method(True)
+        timed.method(False)
+        timed.other(0)
+
+        snapshot = timed.metrics.snapshot()
+        self.assertEqual(snapshot['latency_ns']['method']['count'], 2)
+        self.assertEqual(snapshot['latency_ns']['other']['count'], 1)
+        self.assertEqual(snapshot['counters'], {'method.failed': 1})
+
+    def test_timed_lock(self):
+        metrics = Metrics()
+        lock = TimedLock(metrics, 'test')
+        condition = Condition(lock)
+
+        def notify():
+            sleep(0.01)
+            with condition:
+                condition.notify()
+
+        notifier = Thread(target=notify)
+        with condition:
+            notifier.start()
+            self.assertTrue(condition.wait(5))
+        notifier.join()
+
+        latency = metrics.snapshot()['latency_ns']
+        self.assertEqual(latency['lock.test.wait']['count'], 2)
+        self.assertEqual(latency['lock.test.hold']['count'], 3)
+
+    def test_timed_lock_owner(self):
+        lock = TimedLock(Metrics(), 'test')
+        owned = []
+
+        # pylint: disable=protected-access
+        with lock:
+            thread = Thread(target=lambda: owned.append(lock._is_owned()))
+            thread.start()
+            thread.join()
+            owned.append(lock._is_owned())
+        owned.append(lock._is_owned())
+
+        self.assertEqual(owned, [False, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
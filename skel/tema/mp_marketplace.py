@@ -0,0 +1,718 @@
+"""
+This module represents the multi-process engine of the Marketplace.
+
+The stock is split across shard processes, each one keeping a Marketplace with
+the queues of its own producers, so the calls of different shards run in
+parallel. The producers and the consumers run as scripts in worker processes:
+every worker sends each shard, in one message, the next calls of its ready
+scripts for that shard and gets back all the results at once.
+
+A producer registers with a single shard and publishes only there, so its queue
+limit is the same as with one Marketplace. The cart of a consumer is split into
+one cart on every shard it takes units from: add_many_to_cart takes them from
+the shards in turn, remove_many_from_cart gives them back to the shards they
+were taken from and the order joins the lines of all the shards' carts.
+
+Every shard expires the carts that haven't been used for cart_max_idle
+seconds. When a consumer's cart expires on a shard, the units of its carts on
+the other shards are given back at once and the consumer starts the cart over.
+
+The units in the carts of a worker that dies stay reserved and its producers
+stop publishing, so the other consumers might never be done: the run is
+stopped with a ProcessDied error instead.
+
+The processes only get picklable arguments (the scripts are made in the
+workers), so the engine runs with every start method, including spawn.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import io
+import multiprocessing
+import queue
+import time
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing.connection import wait
+from threading import Thread
+
+from tema.marketplace_log import forward_records, log_to_queue
+from tema.product import Tea
+from tema.scripts import (check_sample_orders, consumer_script, drive, execute, print_order,
+                          producer_script, sample_market)
+from tema.timed_marketplace import create_marketplace
+
+# the seconds after which a shard expires an unused cart
+CART_MAX_IDLE = 60
+
+
+class ProcessDied(Exception):
+    """
+    Raised when a worker or a shard process exits before the consumers are done.
+    """
+
+    def __init__(self, name, exitcode):
+        """
+        Constructor
+
+        :type name: String
+        :param name: the name of the process, e.g. 'worker 2'
+
+        :type exitcode: Int
+        :param exitcode: the exit code of the process
+        """
+        super().__init__(f'{name} exited with code {exitcode} before the consumers were done')
+        self.name = name
+        self.exitcode = exitcode
+
+
+def send_results(results):
+    """
+    Sends the results put on the queue to their workers, until it gets None.
+
+    :type results: SimpleQueue
+    :param results: (connection, results) pairs
+    """
+    for connection, calls_results in iter(results.get, None):
+        connection.send(calls_results)
+
+
+def serve(marketplace, connections, control, cart_max_idle=None):
+    """
+    Executes the batches of calls sent by the workers until it is told to stop,
+    expiring the unused carts once every cart_max_idle seconds.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace of the shard
+
+    :type connections: List
+    :param connections: a connection to every worker
+
+    :type control: Connection
+    :param control: the connection the shard is told to stop on, once the
+    workers are done
+
+    :type cart_max_idle: Float
+    :param cart_max_idle: the seconds after which an unused cart expires (the
+    carts never expire if None)
+    """
+    # the results are sent by another thread: a worker that is still sending
+    # its calls to the other shards doesn't read them yet, but the shard has to
+    # keep reading the calls of the other workers meanwhile
+    results = queue.SimpleQueue()
+    sender = Thread(target=send_results, args=(results,), daemon=True)
+    sender.start()
+    active = list(connections)
+    next_expiry = None if cart_max_idle is None else time.monotonic() + cart_max_idle
+
+    while True:
+        timeout = None if next_expiry is None else max(0, next_expiry - time.monotonic())
+        ready = wait(active + [control], timeout)
+        if control in ready:
+            break
+
+        if next_expiry is not None and time.monotonic() >= next_expiry:
+            marketplace.expire_carts(cart_max_idle)
+            next_expiry = time.monotonic() + cart_max_idle
+
+        for connection in ready:
+            try:
+                calls = connection.recv()
+            except EOFError:
+                active.remove(connection)
+                continue
+
+            results.put((connection, [execute(marketplace, call) for call in calls]))
+
+    results.put(None)
+    sender.join()
+
+
+def run_shard(marketplace_config, connections, control, records, cart_max_idle):
+    """
+    Runs a shard process: creates its Marketplace and serves the workers.
+
+    :type marketplace_config: Dict
+    :param marketplace_config: the arguments of the Marketplace
+
+    :type connections: List
+    :param connections: a connection to every worker
+
+    :type control: Connection
+    :param control: the connection the shard is told to stop on
+
+    :type records: Queue
+    :param records: where the Marketplace's log records are sent
+
+    :type cart_max_idle: Float
+    :param cart_max_idle: the seconds after which an unused cart expires
+    """
+    log_to_queue(records)
+    serve(create_marketplace(**marketplace_config), connections, control, cart_max_idle)
+
+
+class ShardedCalls:
+    """
+    Class that turns the Marketplace calls of a script into calls to the
+    Marketplaces of the shards.
+
+    Every method is a generator that yields lists of (shard, call) pairs, gets
+    back the lists of their results and returns the result of the Marketplace
+    method with the same name.
+    """
+
+    def __init__(self, shards, first_shard, output):
+        """
+        Constructor
+
+        :type shards: Int
+        :param shards: the number of shards
+
+        :type first_shard: Int
+        :param first_shard: the shard the producer registers with, and the one
+        the consumer takes units from first
+
+        :type output: Function
+        :param output: the function that prints an order
+        """
+        self.shards = shards
+        self.first_shard = first_shard
+        self.output = output
+        self.cart_id_gen = -1
+        # cart id -> the id of the cart on every shard (None if it has no cart there)
+        self.carts = {}
+        # cart id -> product -> the number of units taken from every shard
+        self.units = {}
+
+    def run(self, script):
+        """
+        Runs a script on the shards. Yields the number of seconds the script
+        waits or a list of (shard, call) pairs, and gets back the list of the
+        results of those calls.
+
+        :type script: Generator
+        :param script: a producer or a consumer script
+        """
+        yield from drive(script, lambda call: getattr(self, call[0])(*call[1:]))
+
+    def register_producer(self):
+        """
+        Registers the producer with its shard.
+
+        :returns the shard and the id of the producer on the shard
+        """
+        [producer_id] = yield [(self.first_shard, ('register_producer',))]
+        return self.first_shard, producer_id
+
+    def publish_many(self, producer_id, product, quantity):
+        """
+        Publishes the units on the producer's shard.
+        """
+        shard, shard_producer_id = producer_id
+        [published] = yield [(shard, ('publish_many', shard_producer_id, product, quantity))]
+        return published
+
+    def new_cart(self):
+        """
+        Creates a cart, which gets a cart on a shard when units are first
+        taken from that shard.
+        """
+        yield from ()
+        self.cart_id_gen += 1
+        self.carts[self.cart_id_gen] = [None] * self.shards
+        self.units[self.cart_id_gen] = {}
+        return self.cart_id_gen
+
+    def add_many_to_cart(self, cart_id, product, quantity):
+        """
+        Takes the units from the first shard and, if it has too few, the rest
+        from all the other shards at once: every one of them is asked for the
+        rest and the units taken over quantity are given back, so a call takes
+        at most three round trips (four with the carts made on the shards),
+        however many shards there are.
+        """
+        shards = [(self.first_shard + i) % self.shards for i in range(self.shards)]
+        added = yield from self.take(cart_id, product, shards[:1], quantity)
+        if added is None or added == quantity or len(shards) == 1:
+            return added
+
+        more = yield from self.take(cart_id, product, shards[1:], quantity - added)
+        if more is None:
+            return None
+        return added + min(more, quantity - added)
+
+    def take(self, cart_id, product, shards, quantity):
+        """
+        Asks every one of the shards for quantity units of the product, then
+        gives back the units taken over quantity, from the last shards first.
+
+        :returns the number of units taken (before the excess is given back),
+        or None if the cart of a shard expired
+        """
+        shard_carts = self.carts[cart_id]
+        missing = [shard for shard in shards if shard_carts[shard] is None]
+        if missing:
+            cart_ids = yield [(shard, ('new_cart',)) for shard in missing]
+            for shard, shard_cart_id in zip(missing, cart_ids):
+                shard_carts[shard] = shard_cart_id
+
+        counts = yield [(shard, ('add_many_to_cart', shard_carts[shard], product, quantity))
+                        for shard in shards]
+        taken = self.units[cart_id].setdefault(product, [0] * self.shards)
+        for shard, count in zip(shards, counts):
+            taken[shard] += count or 0
+        if None in counts:
+            yield from self.expired(cart_id)
+            return None
+
+        excess = sum(counts) - quantity
+        calls = []
+        for shard, count in reversed(list(zip(shards, counts))):
+            if excess > 0 and count:
+                calls.append((shard, ('remove_many_from_cart', shard_carts[shard], product,
+                                      min(count, excess))))
+                excess -= min(count, excess)
+        if calls:
+            removed = yield calls
+            if None in removed:
+                yield from self.expired(cart_id)
+                return None
+            for (shard, _), count in zip(calls, removed):
+                taken[shard] -= count
+        return sum(counts)
+
+    def remove_many_from_cart(self, cart_id, product, quantity):
+        """
+        Gives the units back to the shards they were taken from.
+        """
+        taken = self.units[cart_id].get(product, [0] * self.shards)
+        calls = []
+        for shard in range(self.shards):
+            count = min(quantity, taken[shard])
+            if count:
+                calls.append((shard, ('remove_many_from_cart', self.carts[cart_id][shard],
+                                      product, count)))
+                quantity -= count
+
+        removed = yield calls
+        for (shard, _), count in zip(calls, removed):
+            taken[shard] -= count or 0
+        if None in removed:
+            yield from self.expired(cart_id)
+            return None
+        return sum(removed)
+
+    def expired(self, cart_id):
+        """
+        Forgets a cart whose cart on a shard has expired: the units of its
+        carts on the other shards are given back and those carts are freed.
+        """
+        shard_carts = self.carts.pop(cart_id)
+        units = self.units.pop(cart_id)
+        # the calls on the expired cart fail, and are ignored
+        calls = [(shard, ('remove_many_from_cart', shard_carts[shard], product, count))
+                 for product, taken in units.items()
+                 for shard, count in enumerate(taken) if count]
+        calls += [(shard, ('place_order_lines', shard_cart_id))
+                  for shard, shard_cart_id in enumerate(shard_carts) if shard_cart_id is not None]
+        yield calls
+
+    def print_order(self, name, cart_id):
+        """
+        Places the orders of the cart's carts on the shards and prints their lines.
+
+        :returns the number of units ordered, or None if the cart of a shard
+        expired; nothing is printed then, the consumer starts the cart over
+        """
+        results = yield [(shard, ('place_order_lines', shard_cart_id))
+                         for shard, shard_cart_id in enumerate(self.carts.pop(cart_id))
+                         if shard_cart_id is not None]
+        del self.units[cart_id]
+        if None in results:
+            return None
+
+        # the same product may come from several shards
+        lines = {}
+        for shard_lines in results:
+            for product, count in shard_lines:
+                lines[product] = lines.get(product, 0) + count
+        self.output(name, list(lines.items()))
+        return sum(lines.values())
+
+
+def exchange(connections, batch):
+    """
+    Sends every shard the calls of the scripts in the batch and collects the results.
+
+    :type connections: List
+    :param connections: the connection to every shard
+
+    :type batch: List
+    :param batch: (script, list of (shard, call) pairs) tuples
+
+    :returns a (script, list of results) tuple for every script in the batch
+    """
+    shard_calls = [[] for _ in connections]
+    for _, calls in batch:
+        for shard, call in calls:
+            shard_calls[shard].append(call)
+
+    for connection, calls in zip(connections, shard_calls):
+        if calls:
+            connection.send(calls)
+    shard_results = [iter(connection.recv()) if calls else None
+                     for connection, calls in zip(connections, shard_calls)]
+
+    return [(script, [next(shard_results[shard]) for shard, _ in calls])
+            for script, calls in batch]
+
+
+def work(connections, owner, stop, producers, consumers):
+    """
+    Runs the scripts of a worker process, batching their calls to every shard.
+
+    :type connections: List
+    :param connections: the connection to every shard
+
+    :type owner: Connection
+    :param owner: the connection to the process that started the run, which
+    gets the orders and the number of consumers done
+
+    :type stop: Event
+    :param stop: set once all the consumers are done
+
+    :type producers: List
+    :param producers: (config, first shard) pairs with the producers of the worker
+
+    :type consumers: List
+    :param consumers: (config, first shard) pairs with the consumers of the worker
+    """
+    scripts = [(producer_script(**config), first_shard) for config, first_shard in producers]
+    scripts += [(consumer_script(**config), first_shard) for config, first_shard in consumers]
+    orders = []
+    ready = [(ShardedCalls(len(connections), first_shard,
+                           lambda name, lines: orders.append((name, lines))).run(script), None)
+             for script, first_shard in scripts]
+    sleeping = []
+    done = 0
+
+    while ready or sleeping:
+        # advance every ready script up to its next calls
+        batch = []
+        for script, value in ready:
+            try:
+                step = script.send(value)
+            except StopIteration:
+                # only the consumers are ever done
+                done += 1
+                continue
+
+            if isinstance(step, list):
+                batch.append((script, step))
+            else:
+                heapq.heappush(sleeping, (time.monotonic() + step, id(script), script))
+
+        if orders or done:
+            owner.send((orders, done))
+            orders.clear()
+            done = 0
+
+        ready = exchange(connections, batch)
+        if not ready and sleeping:
+            # nothing to send, sleep until the next script wakes up
+            stop.wait(max(0, sleeping[0][0] - time.monotonic()))
+        if stop.is_set():
+            break
+
+        now = time.monotonic()
+        while sleeping and sleeping[0][0] <= now:
+            ready.append((heapq.heappop(sleeping)[2], None))
+
+    for connection in connections:
+        connection.close()
+    owner.close()
+
+
+def start_shards(context, marketplace_config, pipes, records, cart_max_idle):
+    """
+    Starts the shard processes.
+
+    :type context: BaseContext
+    :param context: the multiprocessing context the processes are started with
+
+    :type marketplace_config: Dict
+    :param marketplace_config: the arguments of the Marketplace
+
+    :type pipes: List
+    :param pipes: for every worker, the pipe to every shard
+
+    :type records: Queue
+    :param records: where the shards send their log records
+
+    :type cart_max_idle: Float
+    :param cart_max_idle: the seconds after which a shard expires an unused cart
+
+    :returns the shard processes and the connections they are told to stop on
+    """
+    processes = []
+    controls = []
+    for shard in range(len(pipes[0])):
+        control, shard_control = context.Pipe(duplex=False)
+        process = context.Process(target=run_shard, args=(
+            marketplace_config, [worker_pipes[shard][0] for worker_pipes in pipes], control,
+            records, cart_max_idle), daemon=True, name=f'shard {shard}')
+        process.start()
+        processes.append(process)
+        controls.append(shard_control)
+
+    return processes, controls
+
+
+def start_workers(context, market_config, pipes, stop):
+    """
+    Starts the worker processes, each one with its share of the producers and
+    of the consumers, which are spread evenly over the shards.
+
+    :type context: BaseContext
+    :param context: the multiprocessing context the processes are started with
+
+    :type market_config: Dict
+    :param market_config: the parsed input file
+
+    :type pipes: List
+    :param pipes: for every worker, the pipe to every shard
+
+    :type stop: Event
+    :param stop: set once all the consumers are done
+
+    :returns the worker processes and the number of consumers of every worker,
+    by the connection it sends the orders on
+    """
+    workers = len(pipes)
+    shards = len(pipes[0])
+    processes = []
+    remaining = {}
+
+    for worker, worker_pipes in enumerate(pipes):
+        owner_end, worker_end = context.Pipe(duplex=False)
+        producers = [(p_config, (worker + i * workers) % shards) for i, p_config
+                     in enumerate(market_config['producers'][worker::workers])]
+        consumers = [(c_config, (worker + i * workers) % shards) for i, c_config
+                     in enumerate(market_config['consumers'][worker::workers])]
+
+        process = context.Process(target=work, args=(
+            [worker_pipe for _, worker_pipe in worker_pipes], worker_end, stop, producers,
+            consumers), daemon=True, name=f'worker {worker}')
+        process.start()
+        processes.append(process)
+        remaining[owner_end] = len(consumers)
+
+    return processes, remaining
+
+
+def collect(processes, remaining, output):
+    """
+    Prints the orders sent by the workers until all the consumers are done.
+
+    :type processes: List
+    :param processes: the workers and the shards
+
+    :type remaining: Dict
+    :param remaining: the number of consumers not done, by the connection the
+    worker sends the orders on
+
+    :type output: Function
+    :param output: the function that prints an order
+
+    :raises ProcessDied: if a worker or a shard exits before the consumers are done
+    """
+    sentinels = {process.sentinel: process for process in processes}
+    connections = list(remaining)
+
+    while any(remaining.values()):
+        for ready in wait(connections + list(sentinels)):
+            if ready in sentinels:
+                # a worker without producers exits once its consumers are done
+                process = sentinels.pop(ready)
+                process.join()
+                if process.exitcode != 0:
+                    raise ProcessDied(process.name, process.exitcode)
+                continue
+
+            try:
+                orders, done = ready.recv()
+            except EOFError:
+                # the worker exited, its sentinel tells how
+                connections.remove(ready)
+                continue
+
+            for name, lines in orders:
+                output(name, lines)
+            remaining[ready] -= done
+
+
+def run_market(market_config, workers=None, output=print_order, shards=None, *,
+               cart_max_idle=CART_MAX_IDLE, start_method=None):
+    """
+    Runs the producers and the consumers described by market_config in worker
+    processes, with the stock split across shard processes, until all the
+    consumers are done.
+
+    :type market_config: Dict
+    :param market_config: the parsed input file, with the product ids already
+    replaced by products
+
+    :type workers: Int
+    :param workers: the number of worker processes (one per CPU by default)
+
+    :type output: Function
+    :param output: the function that prints an order
+
+    :type shards: Int
+    :param shards: the number of shard processes (as many as the workers by default)
+
+    :type cart_max_idle: Float
+    :param cart_max_idle: the seconds after which a shard expires an unused cart
+
+    :type start_method: String
+    :param start_method: how the processes are started, e.g. 'spawn' (the
+    default start method of the platform if None)
+
+    :raises ProcessDied: if a worker or a shard exits before the consumers are done
+    """
+    context = multiprocessing.get_context(start_method)
+    workers = workers or multiprocessing.cpu_count()
+    shards = shards or workers
+    stop = context.Event()
+    records = context.Queue()
+    forwarder = forward_records(records)
+
+    # the children inherit each other's ends of the pipes, so no end is closed
+    # for good before the run is over: the shards are told to stop and the
+    # processes that exit are noticed by their sentinels
+    pipes = [[context.Pipe() for _ in range(shards)] for _ in range(workers)]
+    shard_processes, controls = start_shards(context, market_config['marketplace'], pipes,
+                                             records, cart_max_idle)
+    worker_processes, remaining = start_workers(context, market_config, pipes, stop)
+    processes = shard_processes + worker_processes
+
+    try:
+        collect(processes, remaining, output)
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    else:
+        stop.set()
+        for process in worker_processes:
+            process.join()
+        for control in controls:
+            control.send(None)
+    finally:
+        for process in processes:
+            process.join()
+        forwarder.stop()
+
+
+class TestMpMarketplace(unittest.TestCase):
+    """
+    Class for testing the multi-process engine
+    """
+
+    def test_run_market(self):
+        market_config = sample_market(producers=2)
+
+        for workers, shards in [(3, 1), (3, 2), (2, 4)]:
+            output = io.StringIO()
+            with redirect_stdout(output):
+                run_market(market_config, workers, shards=shards)
+
+            check_sample_orders(self, market_config, output.getvalue())
+
+    def test_spawn(self):
+        market_config = sample_market(producers=2)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            run_market(market_config, 2, shards=2, start_method='spawn')
+
+        check_sample_orders(self, market_config, output.getvalue())
+
+    def test_sharded_calls(self):
+        tea = Tea(name='Test', price=12, type='test type')
+        orders = []
+        calls = ShardedCalls(3, 1, lambda name, lines: orders.append((name, lines)))
+        script = calls.run(consumer_script([[{'type': 'add', 'product': tea, 'quantity': 3},
+                                             {'type': 'remove', 'product': tea, 'quantity': 2}]],
+                                           0.1, 'cons0'))
+
+        # the units are taken from the first shard, then the rest from all the
+        # other ones, which get their carts at once, and the excess is given back
+        self.assertEqual(next(script), [(1, ('new_cart',))])
+        self.assertEqual(script.send([6]), [(1, ('add_many_to_cart', 6, tea, 3))])
+        self.assertEqual(script.send([1]), [(2, ('new_cart',)), (0, ('new_cart',))])
+        self.assertEqual(script.send([7, 5]), [(2, ('add_many_to_cart', 7, tea, 2)),
+                                               (0, ('add_many_to_cart', 5, tea, 2))])
+        self.assertEqual(script.send([2, 2]), [(0, ('remove_many_from_cart', 5, tea, 2))])
+        self.assertEqual(script.send([2]), [(1, ('remove_many_from_cart', 6, tea, 1)),
+                                            (2, ('remove_many_from_cart', 7, tea, 1))])
+        self.assertEqual(script.send([1, 1]), [(0, ('place_order_lines', 5)),
+                                               (1, ('place_order_lines', 6)),
+                                               (2, ('place_order_lines', 7))])
+        self.assertRaises(StopIteration, script.send, [[], [], [(tea, 1)]])
+
+        # a cart with nothing taken is never made on the shards
+        script = calls.run(consumer_script([[]], 0.1, 'cons1'))
+        self.assertEqual(next(script), [])
+        self.assertRaises(StopIteration, script.send, [])
+        self.assertEqual(orders, [('cons0', [(tea, 1)]), ('cons1', [])])
+
+        # a cart that expired on a shard gives its units on the other shards
+        # back and is started over in a new one
+        script = calls.run(consumer_script([[{'type': 'add', 'product': tea, 'quantity': 2}]],
+                                           0.1, 'cons2'))
+        self.assertEqual(next(script), [(1, ('new_cart',))])
+        self.assertEqual(script.send([8]), [(1, ('add_many_to_cart', 8, tea, 2))])
+        self.assertEqual(script.send([1]), [(2, ('new_cart',)), (0, ('new_cart',))])
+        self.assertEqual(script.send([9, 4]), [(2, ('add_many_to_cart', 9, tea, 1)),
+                                               (0, ('add_many_to_cart', 4, tea, 1))])
+        self.assertEqual(script.send([None, 0]), [(1, ('remove_many_from_cart', 8, tea, 1)),
+                                                  (0, ('place_order_lines', 4)),
+                                                  (1, ('place_order_lines', 8)),
+                                                  (2, ('place_order_lines', 9))])
+        self.assertEqual(script.send([1, [], [], None]), [(1, ('new_cart',))])
+        self.assertEqual(list(calls.carts), [3])
+
+    def test_serve_expires_carts(self):
+        tea = Tea(name='Test', price=12, type='test type')
+        marketplace = create_marketplace(5)
+        producer_id = marketplace.register_producer()
+        marketplace.publish(producer_id, tea)
+        marketplace.add_to_cart(marketplace.new_cart(), tea)
+        control, shard_control = multiprocessing.Pipe(duplex=False)
+
+        # the shard stops once the cart has expired
+        server = Thread(target=serve, args=(marketplace, [], control, 0.01))
+        server.start()
+        while not marketplace.inventory.count(marketplace.catalog.intern(tea)):
+            time.sleep(0.01)
+        shard_control.send(None)
+        server.join()
+
+    def test_worker_dies(self):
+        market_config = sample_market()
+        # the worker of this consumer fails on the malformed action
+        del market_config['consumers'][3]['carts'][0][0]['quantity']
+
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            with self.assertRaises(ProcessDied) as raised:
+                run_market(market_config, workers=2)
+        self.assertEqual(raised.exception.name, 'worker 1')
+        self.assertEqual(raised.exception.exitcode, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+This module represents the output of the orders: a writer thread that takes
+the formatted orders from a queue and writes them to a stream.
+
+The consumers never wait for each other or for the stream: every order is
+formatted once by its consumer and queued, and only the writer thread writes,
+whole orders at a time, so the lines of different orders can't be tangled.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import io
+import queue
+import sys
+import unittest
+from threading import Thread
+
+from tema.consumer import format_order
+from tema.product import Tea
+
+# the buffer size of the files the orders are written to
+FILE_BUFFER_SIZE = 1 << 20
+
+
+class OrderWriter:
+    """
+    Class that writes the orders of all the consumers from a background thread.
+    """
+
+    def __init__(self, stream=None, close_stream=False):
+        """
+        Constructor
+
+        :type stream: TextIO
+        :param stream: where the orders are written (the standard output by default)
+
+        :type close_stream: Bool
+        :param close_stream: if True, the stream is closed together with the writer
+        """
+        self.stream = stream or sys.stdout
+        self.close_stream = close_stream
+        self.orders = queue.SimpleQueue()
+        self.thread = Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def open(cls, path):
+        """
+        Returns a writer that writes the orders to a file with a large buffer.
+
+        :type path: String
+        :param path: the file
+        """
+        return cls(open(path, 'w', buffering=FILE_BUFFER_SIZE, encoding='utf-8'),
+                   close_stream=True)
+
+    def write_order(self, name, lines):
+        """
+        Queues the order of a consumer; it can be called from any thread.
+
+        :type name: String
+        :param name: the consumer's name
+
+        :type lines: List
+        :param lines: a list of (product, count) pairs
+        """
+        self.orders.put(format_order(name, lines))
+
+    def write(self):
+        """
+        Writes the queued orders until the writer is closed, batching the orders
+        queued while the previous write was in progress.
+        """
+        while True:
+            batch = [self.orders.get()]
+            while not self.orders.empty():
+                batch.append(self.orders.get())
+
+            closed = batch[-1] is None
+            if closed:
+                batch.pop()
+            self.stream.write(''.join(batch))
+
+            if closed:
+                break
+
+    def close(self):
+        """
+        Writes the orders still in the queue and flushes (or closes) the stream.
+        """
+        self.orders.put(None)
+        self.thread.join()
+        if self.close_stream:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class TestOrderWriter(unittest.TestCase):
+    """
+    Class for testing the OrderWriter
+    """
+
+    def test_write_order(self):
+        tea = Tea(name='Test', price=12, type='test type')
+        stream = io.StringIO()
+        writer = OrderWriter(stream)
+
+        writer.write_order('cons1', [(tea, 2)])
+        writer.write_order('cons2', [])
+        writer.write_order('cons3', [(tea, 1)])
+        writer.close()
+
+        self.assertEqual(stream.getvalue(), f'cons1 bought {tea}\n' * 2 + f'cons3 bought {tea}\n')
+        self.assertFalse(writer.thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+"""
+This module represents the policies that choose the producer whose units are
+taken when several producers have a product in stock:
+
+    most-recent    the producer that started stocking the product last (the default)
+    oldest-unit    the producer that has had the product in stock the longest
+    fullest-queue  the producer with the most units in the Marketplace
+    round-robin    the producers of the product in turn
+
+Whatever the policy, the units of a producer waiting for a free slot in its
+full queue are taken first (see SelectionPolicy.choose). python3 -m
+bench.policies compares the policies.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import unittest
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+
+DEFAULT_POLICY = 'most-recent'
+
+
+class SelectionPolicy(ABC):
+    """
+    Class that chooses the producer to take units from. The methods are called
+    with the lock of the stripe that holds the product.
+
+    The producers waiting for a free slot in their full queue go first, in the
+    order of the policy, so that the units taken unblock them; the policy only
+    chooses among the others when none of them has the product.
+    """
+
+    def __init__(self, queues, full_queues=frozenset()):
+        """
+        Constructor
+
+        :type queues: Dict
+        :param queues: producer_id -> the ProducerQueue of the producer
+
+        :type full_queues: Set
+        :param full_queues: the producers waiting for a free slot in their
+        queue, kept up to date by the ProducerQueues
+        """
+        self.queues = queues
+        self.full_queues = full_queues
+
+    def choose(self, producers):
+        """
+        Returns the producer to take the next units from.
+
+        :type producers: Dict
+        :param producers: producer_id -> the number of units in stock (not
+        empty), in the order the producers stocked the product
+        """
+        full_queues = self.full_queues
+        producer_id = None
+        if full_queues:
+            producer_id = next((producer_id for producer_id in self.order(producers)
+                                if producer_id in full_queues), None)
+        if producer_id is None:
+            producer_id = next(iter(self.order(producers)))
+
+        self.chosen(producers, producer_id)
+        return producer_id
+
+    @abstractmethod
+    def order(self, producers):
+        """
+        Returns the producers of the product, the one the policy takes the
+        units of first at the front.
+
+        :type producers: Dict
+        :param producers: as for choose()
+        """
+
+    def chosen(self, producers, producer_id):
+        """
+        Called with the producer whose units are taken; does nothing by default.
+
+        :type producers: Dict
+        :param producers: as for choose()
+
+        :type producer_id: Int
+        :param producer_id: the producer returned by choose()
+        """
+
+
+class MostRecentFirst(SelectionPolicy):
+    """
+    Takes the units of the producer that started stocking the product last.
+    A producer keeps its place while it has the product in stock, however many
+    times it publishes it again; one that runs out goes to the end of the line
+    when it stocks the product again.
+    """
+
+    def order(self, producers):
+        return reversed(producers)
+
+
+class OldestUnitFirst(SelectionPolicy):
+    """
+    Takes the units of the producer that has had the product in stock for the
+    longest time, i.e. the oldest unit.
+    """
+
+    def order(self, producers):
+        return producers
+
+
+class FullestQueueFirst(SelectionPolicy):
+    """
+    Takes the units of the producer with the most units in the Marketplace.
+    """
+
+    def order(self, producers):
+        # the sizes are read without the queue locks, so a size may be off by
+        # the calls running meanwhile; the producer chosen still has the units
+        queues = self.queues
+        return sorted(producers, key=lambda producer_id: queues[producer_id].size,
+                      reverse=True)
+
+
+class RoundRobin(SelectionPolicy):
+    """
+    Takes the units of the producers of a product in turn.
+    """
+
+    def order(self, producers):
+        return producers
+
+    def chosen(self, producers, producer_id):
+        # the chosen producer goes to the end of the line
+        producers[producer_id] = producers.pop(producer_id)
+
+
+POLICIES = {'most-recent': MostRecentFirst, 'oldest-unit': OldestUnitFirst,
+            'fullest-queue': FullestQueueFirst, 'round-robin': RoundRobin}
+
+
+def create_policy(name, queues, full_queues=frozenset()):
+    """
+    Returns a new SelectionPolicy.
+
+    :type name: String
+    :param name: one of POLICIES
+
+    :type queues: Dict
+    :param queues: producer_id -> the ProducerQueue of the producer
+
+    :type full_queues: Set
+    :param full_queues: the producers waiting for a free slot in their queue
+    """
+    if name not in POLICIES:
+        raise ValueError(f'unknown selection policy {name}, expected one of '
+                         f'{", ".join(POLICIES)}')
+    return POLICIES[name](queues, full_queues)
+
+
+class TestSelectionPolicy(unittest.TestCase):
+    """
+    Class for testing the producer selection policies
+    """
+
+    def setUp(self):
+        # stand-ins for the ProducerQueues, only their sizes are read
+        self.queues = {producer_id: SimpleNamespace(size=size)
+                       for producer_id, size in enumerate((2, 5, 1))}
+        # producer 1 stocked the product first, producer 2 last
+        self.producers = {1: 1, 0: 2, 2: 1}
+
+    def choices(self, name, count):
+        """
+        Returns the producers chosen count times by a new policy.
+        """
+        policy = create_policy(name, self.queues)
+        return [policy.choose(self.producers) for _ in range(count)]
+
+    def test_policies(self):
+        self.assertEqual(self.choices('most-recent', 2), [2, 2])
+        self.assertEqual(self.choices('oldest-unit', 2), [1, 1])
+        self.assertEqual(self.choices('fullest-queue', 2), [1, 1])
+        self.assertEqual(self.choices('round-robin', 4), [1, 0, 2, 1])
+        self.assertEqual(self.producers, {0: 2, 2: 1, 1: 1})
+
+    def test_full_queues(self):
+        # producers 1 and 2 wait for a free slot, the policy chooses among them
+        chosen = {name: create_policy(name, self.queues, {1, 2}).choose(dict(self.producers))
+                  for name in POLICIES}
+        self.assertEqual(chosen, {'most-recent': 2, 'oldest-unit': 1, 'fullest-queue': 1,
+                                  'round-robin': 1})
+
+        # producer 0 waits, it goes first whatever the policy
+        for name in POLICIES:
+            policy = create_policy(name, self.queues, {0})
+            producers = dict(self.producers)
+            self.assertEqual([policy.choose(producers) for _ in range(2)], [0, 0], name)
+
+        # if they all wait, the policy chooses among all of them
+        chosen = {name: create_policy(name, self.queues, {0, 1, 2}).choose(self.producers)
+                  for name in POLICIES}
+        self.assertEqual(chosen, {'most-recent': 2, 'oldest-unit': 1, 'fullest-queue': 1,
+                                  'round-robin': 1})
+
+    def test_abstract_policy(self):
+        self.assertRaises(TypeError, SelectionPolicy, self.queues)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, create_policy, 'cheapest', self.queues)
+
+    def test_selection_policy(self):
+        # the Marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        from tema.product import Tea  # pylint: disable=import-outside-toplevel
+
+        tea = Tea(name='Test', price=12, type='test type')
+        freed = {}
+        blocked = {}
+        for policy in POLICIES:
+            marketplace = Marketplace(5, selection_policy=policy)
+            cart_id = marketplace.new_cart()
+            for _ in range(3):
+                marketplace.register_producer()
+            marketplace.publish_many(0, tea, 2)
+            marketplace.publish_many(1, tea, 4)
+            marketplace.publish_many(2, tea, 1)
+
+            # the producers whose slots the units added one by one freed
+            freed[policy] = []
+            for _ in range(3):
+                sizes = [marketplace.inventory.queue_size(i) for i in range(3)]
+                marketplace.add_to_cart(cart_id, tea)
+                freed[policy].append(next(i for i in range(3)
+                                          if marketplace.inventory.queue_size(i) < sizes[i]))
+
+            # producer 1 fails to publish with a full queue, its units go first
+            marketplace.publish_many(1, tea, 5)
+            marketplace.publish_many(2, tea, 1)
+            self.assertFalse(marketplace.publish(1, tea))
+            blocked[policy] = marketplace.inventory.queue_size(1)
+            marketplace.add_to_cart(cart_id, tea)
+            blocked[policy] -= marketplace.inventory.queue_size(1)
+
+        self.assertEqual(freed, {'most-recent': [2, 1, 1], 'oldest-unit': [0, 0, 1],
+                                 'fullest-queue': [1, 1, 0], 'round-robin': [0, 1, 2]})
+        self.assertEqual(blocked, dict.fromkeys(POLICIES, 1))
+        self.assertRaises(ValueError, Marketplace, 5, selection_policy='cheapest')
+
+    def test_full_queue_released(self):
+        # the Marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        from tema.product import Tea  # pylint: disable=import-outside-toplevel
+
+        tea = Tea(name='Test', price=12, type='test type')
+        for policy in POLICIES:
+            marketplace = Marketplace(2, selection_policy=policy)
+            cart_id = marketplace.new_cart()
+            full, other = marketplace.register_producer(), marketplace.register_producer()
+            marketplace.publish_many(full, tea, 2)
+            marketplace.publish_many(other, tea, 2)
+            self.assertFalse(marketplace.publish(full, tea))
+
+            # the unit taken frees a slot of the full queue
+            self.assertTrue(marketplace.add_to_cart(cart_id, tea))
+            self.assertEqual(marketplace.inventory.queue_size(full), 1, policy)
+            self.assertEqual(marketplace.inventory.queue_size(other), 2, policy)
+            self.assertTrue(marketplace.publish(full, tea), policy)
+
+
+if __name__ == '__main__':
+    unittest.main()
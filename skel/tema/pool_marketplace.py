@@ -0,0 +1,283 @@
+"""
+This module represents the worker pool engine of the Marketplace.
+
+The producers and the consumers run as scripts on a fixed number of worker
+threads. A worker runs a script up to its next wait and then moves on to
+another one: the waiting script (e.g. a consumer waiting for a product to be
+published) doesn't keep a thread, it is put back in the ready queue by a timer
+thread when its wait is over.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import io
+import queue
+import time
+import traceback
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from threading import Condition, Thread
+
+from tema.marketplace import Marketplace
+from tema.scripts import (check_sample_orders, consumer_script, execute, market_entities,
+                          print_order, producer_script, sample_market)
+from tema.timed_marketplace import create_marketplace
+
+DEFAULT_WORKERS = 4
+
+
+class ScriptFailed(Exception):
+    """
+    Raised when a producer or consumer script of the pool raises an exception.
+    """
+
+    def __init__(self, error):
+        """
+        Constructor
+
+        :type error: Exception
+        :param error: the exception raised by the script
+        """
+        super().__init__(f'a script failed: {error!r}')
+        self.error = error
+
+
+class WorkerPool:
+    """
+    Class that runs scripts on a fixed number of worker threads.
+    """
+
+    def __init__(self, marketplace, workers=DEFAULT_WORKERS, output=print_order):
+        """
+        Constructor. Starts the workers and the timer thread.
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace the scripts call
+
+        :type workers: Int
+        :param workers: the number of worker threads
+
+        :type output: Function
+        :param output: the function that prints an order
+        """
+        self.marketplace = marketplace
+        self.output = output
+        self.ready = queue.SimpleQueue()
+        # (wake up time, id of the script, script, consumer) of the waiting scripts
+        self.timers = []
+        self.timers_changed = Condition()
+        self.stopped = False
+        # the number of consumers that are not done
+        self.consumers = 0
+        # the exceptions raised by the scripts, which stop the pool
+        self.failures = []
+        self.consumers_done = Condition()
+
+        self.threads = [Thread(target=self.work, daemon=True) for _ in range(workers)]
+        self.threads.append(Thread(target=self.wake, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, script, consumer=False):
+        """
+        Schedules a new script.
+
+        :type script: Generator
+        :param script: a producer or consumer script
+
+        :type consumer: Bool
+        :param consumer: True for consumer scripts, the pool is done when they finish
+        """
+        if consumer:
+            with self.consumers_done:
+                self.consumers += 1
+        self.ready.put((script, consumer))
+
+    def sleep(self, script, consumer, seconds):
+        """
+        Puts a script in the ready queue after the given number of seconds.
+        """
+        if seconds <= 0:
+            self.ready.put((script, consumer))
+            return
+
+        with self.timers_changed:
+            wake_time = time.monotonic() + seconds
+            heapq.heappush(self.timers, (wake_time, id(script), script, consumer))
+            if self.timers[0][2] is script:
+                self.timers_changed.notify()
+
+    def wake(self):
+        """
+        Moves the scripts whose wait is over to the ready queue until the pool stops.
+        """
+        with self.timers_changed:
+            while not self.stopped:
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    _, _, script, consumer = heapq.heappop(self.timers)
+                    self.ready.put((script, consumer))
+
+                timeout = self.timers[0][0] - now if self.timers else None
+                self.timers_changed.wait(timeout)
+
+    def work(self):
+        """
+        Runs the ready scripts up to their next wait until the pool stops.
+        """
+        while True:
+            task = self.ready.get()
+            if task is None:
+                return
+
+            script, consumer = task
+            try:
+                step = script.send(None)
+                while isinstance(step, tuple):
+                    step = script.send(execute(self.marketplace, step, self.output))
+            except StopIteration:
+                self.finish(consumer)
+                continue
+            except Exception as error:  # pylint: disable=broad-except
+                # the orders of the script would be missing, join() raises it
+                traceback.print_exc()
+                with self.consumers_done:
+                    self.failures.append(error)
+                    self.consumers_done.notify_all()
+                continue
+
+            self.sleep(script, consumer, step)
+
+    def finish(self, consumer):
+        """
+        Counts a script that ended.
+        """
+        if consumer:
+            with self.consumers_done:
+                self.consumers -= 1
+                self.consumers_done.notify_all()
+
+    def join(self):
+        """
+        Waits until all the submitted consumers are done, or a script fails,
+        then stops the pool (the producers are dropped).
+
+        :raises ScriptFailed: if a script raised an exception
+        """
+        with self.consumers_done:
+            self.consumers_done.wait_for(lambda: self.consumers == 0 or self.failures)
+
+        with self.timers_changed:
+            self.stopped = True
+            self.timers_changed.notify()
+        for _ in self.threads[:-1]:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.failures:
+            raise ScriptFailed(self.failures[0]) from self.failures[0]
+
+
+def run_market(marketplace_config, entities, workers=DEFAULT_WORKERS, output=print_order):
+    """
+    Runs producers and consumers on a worker pool until all the consumers are done.
+
+    :type marketplace_config: Dict
+    :param marketplace_config: the arguments of the Marketplace
+
+    :type entities: Iterable
+    :param entities: ('producers', configuration) and ('consumers', configuration)
+    pairs, like the ones streamed by Scenario.stream(); every script is started
+    as soon as it is read
+
+    :type workers: Int
+    :param workers: the number of worker threads
+
+    :type output: Function
+    :param output: the function that prints an order
+
+    :raises ScriptFailed: if a script raised an exception
+    """
+    pool = WorkerPool(create_marketplace(**marketplace_config), workers, output)
+
+    for key, config in entities:
+        if key == 'producers':
+            pool.submit(producer_script(**config))
+        else:
+            pool.submit(consumer_script(**config), consumer=True)
+
+    pool.join()
+
+
+class TestWorkerPool(unittest.TestCase):
+    """
+    Class for testing the worker pool engine
+    """
+
+    def test_run_market(self):
+        market_config = sample_market(producers=2)
+        entities = market_entities(market_config)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            run_market(market_config['marketplace'], entities, workers=2)
+
+        check_sample_orders(self, market_config, output.getvalue())
+
+    def test_script_fails(self):
+        market_config = sample_market()
+        # this consumer fails on the malformed action
+        del market_config['consumers'][3]['carts'][0][0]['quantity']
+        entities = market_entities(market_config)
+
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            with self.assertRaises(ScriptFailed) as raised:
+                run_market(market_config['marketplace'], entities, workers=2)
+        self.assertIsInstance(raised.exception.error, KeyError)
+
+    def test_single_worker(self):
+        # the consumers waiting for stock don't keep the worker from the producers
+        market_config = sample_market(producers=2)
+        entities = [('consumers', config) for config in market_config['consumers']]
+        entities += [('producers', config) for config in market_config['producers']]
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            run_market(market_config['marketplace'], entities, workers=1)
+
+        check_sample_orders(self, market_config, output.getvalue())
+
+    def test_waits_free_the_workers(self):
+        pool = WorkerPool(Marketplace(1), workers=1)
+
+        def script():
+            yield 0.1
+
+        start = time.monotonic()
+        for _ in range(20):
+            pool.submit(script(), consumer=True)
+        pool.join()
+        # the 20 waits overlap on the only worker
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_sleep(self):
+        pool = WorkerPool(Marketplace(1), workers=1)
+        waits = []
+
+        def script():
+            start = time.monotonic()
+            yield 0.05
+            waits.append(time.monotonic() - start)
+
+        pool.submit(script(), consumer=True)
+        pool.join()
+        self.assertGreaterEqual(waits[0], 0.05)
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,7 @@ class Producer(Thread):
     Class that represents a producer.
     """
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, metrics=None, **kwargs):
         """
         Constructor.
 
@@ -29,6 +29,9 @@ class Producer(Thread):
         @param republish_wait_time: the number of seconds that a producer must
         wait until the marketplace becomes available
 
+        @type metrics: Metrics
+        @param metrics: if given, the retries are recorded in it
+
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
         """
@@ -37,17 +40,23 @@ class Producer(Thread):
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.metrics = metrics
 
         self.producer_id = marketplace.register_producer()
 
     def run(self):
         while True:
             for product in self.products:
-                for _ in range(product[1]):
-                    # try to publish
-                    # if the queue limit is reached, wait and try again,
-                    # maybe a customer will buy something in the meanwhile
-                    while not self.marketplace.publish(self.producer_id, product[0]):
-                        sleep(product[2])
-
-                    sleep(self.republish_wait_time)
+                # publish the <quantity> units in as few calls as possible
+                # if the queue limit is reached, wait until a customer
+                # buys something and frees a slot in the queue
+                remaining = product[1]
+                while remaining > 0:
+                    published = self.marketplace.publish_many(self.producer_id, product[0],
+                                                              remaining, block=True,
+                                                              timeout=product[2])
+                    remaining -= published
+                    if published == 0 and self.metrics is not None:
+                        self.metrics.incr(f'producer.{self.name}.retries')
+
+                    sleep(self.republish_wait_time * published)
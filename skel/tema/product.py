@@ -6,7 +6,8 @@ Assignment 1
 March 2021
 """
 
-from dataclasses import dataclass
+import unittest
+from dataclasses import dataclass, fields
 
 
 @dataclass(init=True, repr=True, order=False, frozen=True)
@@ -14,15 +15,39 @@ class Product:
     """
     Class that represents a product.
     """
+    # no per-instance __dict__; _hash caches the hash of the (immutable) fields
+    __slots__ = ('name', 'price', '_hash')
+
     name: str
     price: int
 
+    def values(self):
+        """
+        Returns the values of the fields of the product.
+        """
+        return tuple(getattr(self, field.name) for field in fields(self))
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            product_hash = hash(self.values())
+            object.__setattr__(self, '_hash', product_hash)
+            return product_hash
+
+    def __reduce__(self):
+        return (self.__class__, self.values())
+
 
 @dataclass(init=True, repr=True, order=False, frozen=True)
 class Tea(Product):
     """
     Tea products
     """
+    __slots__ = ('type',)
+    # keep the cached hash, instead of the one dataclass would generate
+    __hash__ = Product.__hash__
+
     type: str
 
 
@@ -31,5 +56,49 @@ class Coffee(Product):
     """
     Coffee products
     """
+    __slots__ = ('acidity', 'roast_level')
+    # keep the cached hash, instead of the one dataclass would generate
+    __hash__ = Product.__hash__
+
     acidity: str
     roast_level: str
+
+
+PRODUCT_TYPES = {'Product': Product, 'Tea': Tea, 'Coffee': Coffee}
+
+
+def create_product(description):
+    """
+    Creates a product from its description in the input file.
+
+    :type description: Dict
+    :param description: the product_type and the fields of the product
+    """
+    params = {k: v for k, v in description.items() if k != 'product_type'}
+    return PRODUCT_TYPES[description['product_type']](**params)
+
+
+class TestProduct(unittest.TestCase):
+    """
+    Class for testing the products
+    """
+
+    def test_hash(self):
+        tea = Tea(name='Test', price=12, type='test type')
+        coffee = Coffee(name='Test', price=12, acidity='5.05', roast_level='DARK')
+
+        for product in (tea, coffee):
+            product_hash = hash(product)
+            # the hash is computed once and cached
+            # pylint: disable=protected-access, no-member
+            self.assertEqual(product._hash, product_hash)
+            self.assertEqual(hash(product), product_hash)
+
+        self.assertEqual(hash(tea), hash(Tea(name='Test', price=12, type='test type')))
+        self.assertNotEqual(tea, Tea(name='Test', price=12, type='other type'))
+        self.assertEqual(create_product({'product_type': 'Tea', 'name': 'Test', 'price': 12,
+                                         'type': 'test type'}), tea)
+
+
+if __name__ == '__main__':
+    unittest.main()
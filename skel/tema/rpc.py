@@ -0,0 +1,799 @@
+"""
+This module represents the network interface of the Marketplace: a server that
+runs the Marketplace methods for remote producers and consumers, and a client
+that can be used instead of a Marketplace.
+
+Every request and every response is a frame made of a small binary header
+(the method or the status, the request id and the length of the body) and a
+body of packed integers. The products are sent as the ids given to them by the
+server's catalog; the client asks for the id of a product once and keeps it.
+
+The client keeps a pool of connections and never waits for a response before
+sending the next request: the calls made at the same time by different threads
+share the connections, and a list of calls can be sent in a single write with
+submit(). The server answers the requests as soon as they are done, the blocking
+calls (e.g. add_to_cart with block=True) on a fixed number of worker threads per
+method, so a waiting call doesn't hold up the requests behind it. The blocking
+calls that find every worker busy wait for one in a queue.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import json
+import queue
+import socket
+import socketserver
+import struct
+import unittest
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import asdict
+from itertools import count
+from threading import Lock, Thread
+
+from tema.cart import CART_SLOT_BITS, CART_SLOT_MASK, CartExpired
+from tema.consumer import Consumer
+from tema.marketplace import Marketplace
+from tema.product import Tea, create_product
+
+# the methods a client can call
+(REGISTER_PRODUCER, PUBLISH_MANY, NEW_CART, ADD_MANY_TO_CART, REMOVE_MANY_FROM_CART,
+ PLACE_ORDER_LINES, INTERN) = range(7)
+METHODS = {'register_producer': REGISTER_PRODUCER, 'publish_many': PUBLISH_MANY,
+           'new_cart': NEW_CART, 'add_many_to_cart': ADD_MANY_TO_CART,
+           'remove_many_from_cart': REMOVE_MANY_FROM_CART,
+           'place_order_lines': PLACE_ORDER_LINES, 'intern': INTERN}
+OK, ERROR = range(2)
+
+# the method (or the status), the request id and the length of the body
+HEADER = struct.Struct('<BII')
+INT = struct.Struct('<i')
+# the cart ids are 64 bit
+CART_ID = struct.Struct('<q')
+# producer or cart id, product id, quantity, block, timeout (negative for None)
+QUANTITY_ARGS = struct.Struct('<qiiBd')
+# cart id, product id, quantity
+REMOVE_ARGS = struct.Struct('<qii')
+# product id, count, length of the description of the product
+ORDER_LINE = struct.Struct('<iiI')
+
+RECEIVE_SIZE = 1 << 16
+# the longest body of a frame; a longer one ends the connection
+MAX_BODY = 1 << 20
+DEFAULT_CONNECTIONS = 4
+# the threads that run the blocking calls of each method
+BLOCKING_WORKERS = 16
+
+
+class RemoteError(Exception):
+    """
+    Raised by the client when a call fails on the server with an exception
+    that isn't in REMOTE_EXCEPTIONS.
+    """
+
+
+class FrameError(ValueError):
+    """
+    Raised for a frame whose body is longer than MAX_BODY.
+    """
+
+
+# the exceptions raised again by the client with their type and arguments
+REMOTE_EXCEPTIONS = {exception.__name__: exception
+                     for exception in (CartExpired, KeyError, ValueError, TypeError)}
+
+
+def encode_error(error):
+    """
+    Returns the body of the response to a call that raised error.
+    """
+    return json.dumps([type(error).__name__, list(error.args)], default=repr).encode()
+
+
+def decode_error(body):
+    """
+    Returns the exception encoded by encode_error(): one of REMOTE_EXCEPTIONS
+    if it has the type of the remote one, a RemoteError otherwise.
+    """
+    try:
+        name, args = json.loads(body)
+    except ValueError:
+        return RemoteError(body.decode(errors='replace'))
+    exception = REMOTE_EXCEPTIONS.get(name)
+    if exception is None:
+        return RemoteError(f'{name}{tuple(args)}')
+    return exception(*args)
+
+
+def describe(product):
+    """
+    Returns the description of a product, as in the input file.
+    """
+    return {'product_type': type(product).__name__, **asdict(product)}
+
+
+def frames(buffer):
+    """
+    Yields the (header fields, body) of the complete frames at the start of
+    the buffer, then deletes them from it.
+
+    :type buffer: Bytearray
+    :param buffer: the bytes received so far
+
+    :raises FrameError: if a frame is longer than MAX_BODY, with the request id
+    of the frame as its second argument
+    """
+    pos = 0
+    while len(buffer) - pos >= HEADER.size:
+        kind, request_id, length = HEADER.unpack_from(buffer, pos)
+        if length > MAX_BODY:
+            del buffer[:pos]
+            raise FrameError(f'frame of {length} bytes', request_id)
+        end = pos + HEADER.size + length
+        if end > len(buffer):
+            break
+
+        yield kind, request_id, bytes(buffer[pos + HEADER.size:end])
+        pos = end
+
+    del buffer[:pos]
+
+
+def is_blocking(method, body):
+    """
+    Returns True if the request is a call that may block, False if not (or if
+    its body is malformed, which execute() then reports).
+    """
+    return (method in (PUBLISH_MANY, ADD_MANY_TO_CART) and len(body) == QUANTITY_ARGS.size
+            and bool(QUANTITY_ARGS.unpack(body)[3]))
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    """
+    Class that serves the requests of a client connection.
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # guards the socket, the blocking calls answer from the worker threads
+        self.send_lock = Lock()
+
+    def handle(self):
+        buffer = bytearray()
+        while True:
+            try:
+                data = self.request.recv(RECEIVE_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+
+            buffer += data
+            # answer all the requests received at once in a single write
+            responses = bytearray()
+            try:
+                for method, request_id, body in frames(buffer):
+                    if is_blocking(method, body):
+                        self.server.blocking_calls[method].put((self, method, request_id, body))
+                    else:
+                        responses += self.server.execute(method, request_id, body)
+            except FrameError as error:
+                # the rest of the stream can't be split into frames any more
+                result = encode_error(error)
+                responses += HEADER.pack(ERROR, error.args[1], len(result)) + result
+                buffer = None
+
+            if responses:
+                with self.send_lock:
+                    self.request.sendall(responses)
+            if buffer is None:
+                return
+
+    def respond(self, method, request_id, body):
+        """
+        Executes a (blocking) request and sends its response.
+        """
+        response = self.server.execute(method, request_id, body)
+        try:
+            with self.send_lock:
+                self.request.sendall(response)
+        except OSError:
+            # the client is gone
+            pass
+
+
+class MarketplaceServer(socketserver.ThreadingTCPServer):
+    """
+    Class that serves a Marketplace over TCP, one thread per client connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, marketplace, address=('127.0.0.1', 0),
+                 blocking_workers=BLOCKING_WORKERS):
+        """
+        Constructor. Binds the server and starts the workers of the blocking
+        calls, serve_forever() starts serving.
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace
+
+        :type address: Tuple
+        :param address: the (host, port) to listen on; port 0 picks a free port
+
+        :type blocking_workers: Int
+        :param blocking_workers: the number of threads that run the blocking
+        calls of each method (publish_many and add_many_to_cart have their own,
+        so the waiting calls of one can't keep out the calls that end them)
+        """
+        super().__init__(address, RequestHandler)
+        self.marketplace = marketplace
+        # the encoded descriptions of the products, sent with the orders
+        self.descriptions = {}
+        # method -> the (handler, method, request id, body) of its blocking calls
+        self.blocking_calls = {PUBLISH_MANY: queue.SimpleQueue(),
+                               ADD_MANY_TO_CART: queue.SimpleQueue()}
+        self.workers = [Thread(target=self.work, args=(calls,), daemon=True)
+                        for calls in self.blocking_calls.values()
+                        for _ in range(blocking_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def work(self, calls):
+        """
+        Runs blocking calls from the queue until it yields None.
+        """
+        while True:
+            call = calls.get()
+            if call is None:
+                return
+            handler, method, request_id, body = call
+            handler.respond(method, request_id, body)
+
+    def server_close(self):
+        """
+        Closes the socket and stops the workers once they are done with the
+        calls they were given.
+        """
+        super().server_close()
+        for calls in self.blocking_calls.values():
+            for _ in range(len(self.workers) // len(self.blocking_calls)):
+                calls.put(None)
+
+    def product(self, product_id):
+        """
+        Returns the product with an id sent by a client.
+
+        :raises KeyError: if the catalog has no product with that id
+        """
+        if not 0 <= product_id < len(self.marketplace.catalog):
+            raise KeyError(product_id)
+        return self.marketplace.catalog.product(product_id)
+
+    def execute(self, method, request_id, body):
+        """
+        Executes a request and returns its response frame.
+        """
+        try:
+            result = self.call(method, body)
+            status = OK
+        except Exception as error:  # pylint: disable=broad-except
+            result = encode_error(error)
+            status = ERROR
+
+        return HEADER.pack(status, request_id, len(result)) + result
+
+    def call(self, method, body):
+        """
+        Executes the Marketplace method of a request and returns the packed result.
+        """
+        marketplace = self.marketplace
+        if method in (PUBLISH_MANY, ADD_MANY_TO_CART):
+            owner_id, product_id, quantity, block, timeout = QUANTITY_ARGS.unpack(body)
+            function = (marketplace.publish_many if method == PUBLISH_MANY
+                        else marketplace.add_many_to_cart)
+            return INT.pack(function(owner_id, self.product(product_id),
+                                     quantity, bool(block), None if timeout < 0 else timeout))
+        if method == REMOVE_MANY_FROM_CART:
+            cart_id, product_id, quantity = REMOVE_ARGS.unpack(body)
+            return INT.pack(marketplace.remove_many_from_cart(
+                cart_id, self.product(product_id), quantity))
+        if method == NEW_CART:
+            return CART_ID.pack(marketplace.new_cart())
+        if method == PLACE_ORDER_LINES:
+            return self.order_lines(marketplace.place_order_lines(CART_ID.unpack(body)[0]))
+        if method == REGISTER_PRODUCER:
+            return INT.pack(marketplace.register_producer())
+        if method == INTERN:
+            return INT.pack(marketplace.catalog.intern(create_product(json.loads(body))))
+        raise ValueError(f'unknown method {method}')
+
+    def order_lines(self, lines):
+        """
+        Packs the lines of an order, with the descriptions of their products.
+        """
+        packed = bytearray()
+        for product, product_count in lines:
+            product_id = self.marketplace.catalog.intern(product)
+            description = self.descriptions.get(product_id)
+            if description is None:
+                description = self.descriptions[product_id] = json.dumps(
+                    describe(product)).encode()
+            packed += ORDER_LINE.pack(product_id, product_count, len(description))
+            packed += description
+        return bytes(packed)
+
+
+class Connection:
+    """
+    Class that represents a client connection: the requests are sent as soon as
+    they are made and a reader thread completes their futures as the responses
+    arrive, in any order.
+    """
+
+    def __init__(self, address):
+        """
+        Constructor. Connects to the server and starts the reader thread.
+
+        :type address: Tuple
+        :param address: the (host, port) of the server
+        """
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the reader never waits for a sender (that may be waiting for the
+        # server, which may be waiting for the reader), so they use two locks
+        self.send_lock = Lock()
+        self.pending_lock = Lock()
+        self.request_ids = count()
+        # request id -> (future, function that decodes the response)
+        self.pending = {}
+        self.closed = False
+        self.reader = Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def submit(self, requests):
+        """
+        Sends the requests in a single write.
+
+        :type requests: List
+        :param requests: (method, body, decode, future) tuples; the future is
+        completed with decode(response body)
+        """
+        data = bytearray()
+        with self.pending_lock:
+            if self.closed:
+                raise ConnectionError('the connection is closed')
+
+            for method, body, decode, future in requests:
+                request_id = next(self.request_ids) & 0xFFFFFFFF
+                self.pending[request_id] = (future, decode)
+                data += HEADER.pack(method, request_id, len(body)) + body
+
+        with self.send_lock:
+            self.socket.sendall(data)
+
+    def read(self):
+        """
+        Completes the futures of the responses until the connection is closed,
+        then fails the futures still waiting (even if the reader itself fails).
+        """
+        buffer = bytearray()
+        try:
+            while True:
+                try:
+                    data = self.socket.recv(RECEIVE_SIZE)
+                except OSError:
+                    data = b''
+                if not data:
+                    break
+
+                buffer += data
+                try:
+                    for status, request_id, body in frames(buffer):
+                        self.complete(status, request_id, body)
+                except FrameError:
+                    # the rest of the stream can't be split into frames any more
+                    break
+        finally:
+            with self.pending_lock:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future, _ in pending.values():
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(ConnectionError('the connection is closed'))
+
+    def complete(self, status, request_id, body):
+        """
+        Completes the future of a response. A response to an unknown request
+        is dropped, as is the response to a call cancelled by its caller.
+        """
+        with self.pending_lock:
+            future, decode = self.pending.pop(request_id, (None, None))
+        if future is None or not future.set_running_or_notify_cancel():
+            return
+
+        if status == OK:
+            try:
+                future.set_result(decode(body))
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+        else:
+            future.set_exception(decode_error(body))
+
+    def close(self):
+        """
+        Closes the connection; the calls still waiting fail.
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.join()
+        self.socket.close()
+
+
+def decode_int(body):
+    """
+    Decodes a response that holds an int.
+    """
+    return INT.unpack(body)[0]
+
+
+def decode_cart_id(body):
+    """
+    Decodes a response that holds a cart id.
+    """
+    return CART_ID.unpack(body)[0]
+
+
+class MarketplaceClient:
+    """
+    Class that calls the methods of a Marketplace served by a MarketplaceServer.
+    It has the methods of a Marketplace, so the producers and the consumers can
+    use it instead of one; it can be used from any number of threads.
+    """
+
+    def __init__(self, address, connections=DEFAULT_CONNECTIONS):
+        """
+        Constructor. Opens the connections.
+
+        :type address: Tuple
+        :param address: the (host, port) of the server
+
+        :type connections: Int
+        :param connections: the number of connections the calls are spread over
+        """
+        self.connections = [Connection(address) for _ in range(connections)]
+        self.next_connection = count()
+        # the ids given to the products by the server, and the other way around
+        self.product_ids = {}
+        self.products = {}
+        self.print_lock = Lock()
+
+    def connection(self):
+        """
+        Returns the connection the next requests are sent on.
+        """
+        return self.connections[next(self.next_connection) % len(self.connections)]
+
+    def product_id(self, product):
+        """
+        Returns the id the server gave to the product.
+        """
+        product_id = self.product_ids.get(product)
+        if product_id is None:
+            future = Future()
+            self.connection().submit([(INTERN, json.dumps(describe(product)).encode(),
+                                       decode_int, future)])
+            product_id = self.product_ids[product] = future.result()
+            self.products[product_id] = product
+        return product_id
+
+    def decode_lines(self, body):
+        """
+        Decodes the lines of an order.
+        """
+        lines = []
+        pos = 0
+        while pos < len(body):
+            product_id, product_count, length = ORDER_LINE.unpack_from(body, pos)
+            pos += ORDER_LINE.size
+            product = self.products.get(product_id)
+            if product is None:
+                product = create_product(json.loads(body[pos:pos + length]))
+                self.products[product_id] = product
+                self.product_ids[product] = product_id
+            pos += length
+            lines.append((product, product_count))
+        return lines
+
+    def request(self, call):
+        """
+        Returns the (method, body, decode, future) request of a call.
+
+        :type call: Tuple
+        :param call: the name of the method followed by its arguments, like the
+        calls yielded by the scripts
+        """
+        name, *args = call
+        method = METHODS[name]
+        decode = decode_int
+        body = b''
+
+        if method in (PUBLISH_MANY, ADD_MANY_TO_CART):
+            owner_id, product, quantity, *options = args
+            block, timeout = options + [False, None][len(options):]
+            body = QUANTITY_ARGS.pack(owner_id, self.product_id(product), quantity, block,
+                                      -1 if timeout is None else timeout)
+        elif method == REMOVE_MANY_FROM_CART:
+            cart_id, product, quantity = args
+            body = REMOVE_ARGS.pack(cart_id, self.product_id(product), quantity)
+        elif method == NEW_CART:
+            decode = decode_cart_id
+        elif method == PLACE_ORDER_LINES:
+            body = CART_ID.pack(args[0])
+            decode = self.decode_lines
+
+        return method, body, decode, Future()
+
+    def submit(self, calls):
+        """
+        Sends a list of calls in a single write, without waiting for their results.
+
+        :type calls: List
+        :param calls: tuples with the name of a method followed by its arguments,
+        e.g. ('add_many_to_cart', cart_id, product, 2)
+
+        :returns the futures of the results, in the order of the calls
+        """
+        requests = [self.request(call) for call in calls]
+        self.connection().submit(requests)
+        return [future for _, _, _, future in requests]
+
+    def call(self, *call):
+        """
+        Makes a call and waits for its result.
+        """
+        return self.submit([call])[0].result()
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        return self.call('register_producer')
+
+    def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace.
+        """
+        return self.publish_many(producer_id, product, 1, block, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, block=False, timeout=None):
+        """
+        Adds as many units of the product as fit in the producer's queue (at most quantity).
+        """
+        return self.call('publish_many', producer_id, product, quantity, block, timeout)
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer.
+        """
+        return self.call('new_cart')
+
+    def add_to_cart(self, cart_id, product, block=False, timeout=None):
+        """
+        Adds a product to the given cart.
+        """
+        return self.add_many_to_cart(cart_id, product, 1, block, timeout) == 1
+
+    def add_many_to_cart(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Adds as many units of the product as are available (at most quantity) to the cart.
+        """
+        return self.call('add_many_to_cart', cart_id, product, quantity, block, timeout)
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes a product from cart.
+        """
+        self.remove_many_from_cart(cart_id, product, 1)
+
+    def remove_many_from_cart(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of a product from cart.
+        """
+        return self.call('remove_many_from_cart', cart_id, product, quantity)
+
+    def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart.
+        """
+        return [product for product, product_count in self.place_order_lines(cart_id)
+                for _ in range(product_count)]
+
+    def place_order_lines(self, cart_id):
+        """
+        Return a list of (product, count) pairs, one for every product in the cart.
+        """
+        return self.call('place_order_lines', cart_id)
+
+    def get_print_lock(self):
+        """
+        Return the lock used for printing (a local one, the output is local).
+        """
+        return self.print_lock
+
+    def close(self):
+        """
+        Closes the connections.
+        """
+        for connection in self.connections:
+            connection.close()
+
+
+class TestRpc(unittest.TestCase):
+    """
+    Class for testing the Marketplace server and client
+    """
+
+    def setUp(self):
+        self.server = MarketplaceServer(Marketplace(5))
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = MarketplaceClient(self.server.server_address, connections=2)
+        self.tea = Tea(name='Test', price=12, type='test type')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_calls(self):
+        client = self.client
+        producer_id = client.register_producer()
+        cart_id = client.new_cart()
+        self.assertTrue(client.publish(producer_id, self.tea))
+        self.assertEqual(client.publish_many(producer_id, self.tea, 10), 4)
+        self.assertEqual(client.add_many_to_cart(cart_id, self.tea, 3), 3)
+        self.assertEqual(client.remove_many_from_cart(cart_id, self.tea, 1), 1)
+        self.assertFalse(client.add_to_cart(cart_id, Tea(name='Other', price=1, type='test'),
+                                            block=True, timeout=0.01))
+        self.assertEqual(client.place_order(cart_id), [self.tea] * 2)
+
+        # a new client doesn't know the products yet
+        other = MarketplaceClient(self.server.server_address, connections=1)
+        cart_id = other.new_cart()
+        client.add_to_cart(cart_id, self.tea)
+        self.assertEqual(other.place_order_lines(cart_id), [(self.tea, 1)])
+        other.close()
+
+        # the exceptions of the Marketplace keep their type
+        self.assertRaises(CartExpired, client.remove_from_cart, 99, self.tea)
+
+        # the cart ids don't fit in 32 bits once their slot has been reused enough
+        free_cart_ids = self.server.marketplace.free_cart_ids
+        free_cart_ids[0] = 7 << CART_SLOT_BITS | free_cart_ids[0] & CART_SLOT_MASK
+        cart_id = client.new_cart()
+        self.assertGreaterEqual(cart_id, 1 << 32)
+        self.assertEqual(client.add_many_to_cart(cart_id, self.tea, 1), 1)
+        self.assertEqual(client.place_order_lines(cart_id), [(self.tea, 1)])
+
+    def test_submit(self):
+        client = self.client
+        producer_id = client.register_producer()
+        cart_id = client.new_cart()
+        futures = client.submit([('publish_many', producer_id, self.tea, 5)] +
+                                [('add_many_to_cart', cart_id, self.tea, 1)] * 6 +
+                                [('place_order_lines', cart_id)])
+
+        self.assertEqual([future.result() for future in futures],
+                         [5, 1, 1, 1, 1, 1, 0, [(self.tea, 5)]])
+
+    def test_blocking_call(self):
+        client = self.client
+        producer_id = client.register_producer()
+        cart_id = client.new_cart()
+
+        # the blocked call doesn't hold up the calls sent after it
+        blocked = client.submit([('add_many_to_cart', cart_id, self.tea, 1, True, 5)])[0]
+        self.assertEqual(client.publish_many(producer_id, self.tea, 1), 1)
+        self.assertEqual(blocked.result(), 1)
+
+    def test_blocking_workers(self):
+        server = MarketplaceServer(Marketplace(5), blocking_workers=1)
+        Thread(target=server.serve_forever, daemon=True).start()
+        client = MarketplaceClient(server.server_address, connections=1)
+        producer_id = client.register_producer()
+        cart_ids = [client.new_cart() for _ in range(2)]
+
+        # the second call waits for the worker of the first one
+        blocked = client.submit([('add_many_to_cart', cart_id, self.tea, 1, True, 5)
+                                 for cart_id in cart_ids])
+        self.assertEqual(client.publish_many(producer_id, self.tea, 2), 2)
+        self.assertEqual([future.result(timeout=5) for future in blocked], [1, 1])
+
+        # the blocking publishes don't wait for the worker of the adds
+        other = Tea(name='Other', price=1, type='test')
+        blocked = client.submit([('add_many_to_cart', cart_ids[0], other, 1, True, 5)])[0]
+        self.assertEqual(client.publish_many(producer_id, other, 1, block=True, timeout=5), 1)
+        self.assertEqual(blocked.result(timeout=5), 1)
+
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_unknown_product(self):
+        cart_id = self.client.new_cart()
+        futures = [Future() for _ in range(2)]
+        self.client.connection().submit(
+            [(REMOVE_MANY_FROM_CART, REMOVE_ARGS.pack(cart_id, product_id, 1), decode_int,
+              future) for product_id, future in zip((-1, 0), futures)])
+
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=5), KeyError)
+
+    def test_bad_frames(self):
+        with socket.create_connection(self.server.server_address) as connection:
+            # a malformed body gets an error response, the connection goes on
+            connection.sendall(HEADER.pack(ADD_MANY_TO_CART, 1, 3) + b'bad' +
+                               HEADER.pack(NEW_CART, 2, 0))
+            responses = bytearray()
+            while len(responses) < 2 * HEADER.size + CART_ID.size:
+                responses += connection.recv(RECEIVE_SIZE)
+            (status, request_id, body), (_, new_cart, _) = frames(responses)
+            self.assertEqual((status, request_id, new_cart), (ERROR, 1, 2))
+            self.assertIsInstance(decode_error(body), RemoteError)
+
+            # an oversized frame gets an error response, then the connection is closed
+            connection.sendall(HEADER.pack(NEW_CART, 3, MAX_BODY + 1))
+            responses = bytearray()
+            while data := connection.recv(RECEIVE_SIZE):
+                responses += data
+            [(status, request_id, body)] = frames(responses)
+            self.assertEqual((status, request_id), (ERROR, 3))
+            self.assertIn('FrameError', str(decode_error(body)))
+
+    def test_reader(self):
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            connection = Connection(listener.getsockname())
+            server_side, _ = listener.accept()
+            futures = [Future() for _ in range(2)]
+            connection.submit([(NEW_CART, b'', decode_int, future) for future in futures])
+
+            # the response to an unknown request is dropped
+            server_side.sendall(HEADER.pack(OK, 99, INT.size) + INT.pack(7) +
+                                HEADER.pack(OK, 0, INT.size) + INT.pack(3))
+            self.assertEqual(futures[0].result(timeout=5), 3)
+
+            # the calls still waiting fail when the connection is lost
+            server_side.close()
+            self.assertIsInstance(futures[1].exception(timeout=5), ConnectionError)
+            connection.close()
+
+    def test_consumers(self):
+        orders = deque()
+        producer_id = self.client.register_producer()
+
+        def publish(remaining):
+            while remaining > 0:
+                remaining -= self.client.publish_many(producer_id, self.tea, remaining,
+                                                      block=True, timeout=5)
+
+        producer = Thread(target=publish, args=(24,))
+        producer.start()
+        consumers = [Consumer([[{'type': 'add', 'product': self.tea, 'quantity': 3}]] * 2,
+                              self.client, 0.01, name=f'cons{i}',
+                              output=lambda *order: orders.append(order)) for i in range(4)]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+        producer.join()
+
+        self.assertEqual(len(orders), 8)
+        self.assertTrue(all(lines == [(self.tea, 3)] for _, lines in orders))
+
+
+if __name__ == '__main__':
+    unittest.main()
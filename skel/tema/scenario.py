@@ -0,0 +1,284 @@
+"""
+This module represents the streaming loader of the test scenarios.
+
+The input file is parsed incrementally, one element of the 'producers' and
+'consumers' lists at a time, so the memory used doesn't depend on the size of
+the scenario. The 'products' and 'marketplace' entries are read first; if they
+come before the lists, as in the files written by stream_generator.py, the
+lists are only parsed once, when the producers and the consumers are streamed
+with their product ids replaced by products. Otherwise the lists are parsed
+(and dropped) once more to get to the entries after them.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from tema.product import Tea, create_product
+
+CHUNK_SIZE = 1 << 16
+# the entries of the input file streamed one element at a time
+LIST_KEYS = ('producers', 'consumers')
+
+
+class JsonStream:
+    """
+    Class that parses a JSON document from a file, one value at a time.
+    """
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        """
+        Constructor
+
+        :type file: TextIO
+        :param file: the file to parse
+
+        :type chunk_size: Int
+        :param chunk_size: the number of characters read at once
+        """
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+
+    def fill(self):
+        """
+        Reads the next chunk of the file, dropping the parsed part of the buffer.
+
+        :returns False at the end of the file
+        """
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips the whitespace and returns the next character.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('unexpected end of the JSON document')
+
+    def expect(self, char):
+        """
+        Skips the next character, which must be char.
+        """
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} at {self.buffer[self.pos:self.pos + 20]!r}')
+        self.pos += 1
+
+    def value(self):
+        """
+        Parses and returns the next value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+
+            # a number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def members(self):
+        """
+        Yields the keys of the next object; the caller must parse the value of
+        every key before asking for the next one.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+
+            if self.peek() != ',':
+                self.expect('}')
+                return
+            self.pos += 1
+
+    def elements(self):
+        """
+        Yields the values of the next array, one at a time.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self.pos += 1
+
+
+class Scenario:
+    """
+    Class that represents a test scenario read from an input file.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        """
+        Constructor. Reads the products and the marketplace configuration.
+
+        :type path: String
+        :param path: the input file
+
+        :type chunk_size: Int
+        :param chunk_size: the number of characters read at once
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.products = {}
+        self.marketplace = {}
+
+        header = {'products', 'marketplace'}
+        with open(path, encoding='utf-8') as input_file:
+            stream = JsonStream(input_file, chunk_size)
+            for key in stream.members():
+                header.discard(key)
+                if key in LIST_KEYS:
+                    for _ in stream.elements():
+                        pass
+                elif key == 'products':
+                    self.products = {product_id: create_product(description)
+                                     for product_id, description in stream.value().items()}
+                elif key == 'marketplace':
+                    self.marketplace = stream.value()
+                else:
+                    stream.value()
+                if not header:
+                    # the rest of the file is only read by stream()
+                    break
+
+    def producer(self, config):
+        """
+        Replaces the product ids of a producer's configuration with products.
+        """
+        config['products'] = [(self.products[product_id], quantity, wait_time)
+                              for product_id, quantity, wait_time in config['products']]
+        return config
+
+    def consumer(self, config):
+        """
+        Replaces the product ids of a consumer's configuration with products.
+        """
+        for cart in config['carts']:
+            for operation in cart:
+                operation['product'] = self.products[operation['product']]
+        return config
+
+    def stream(self):
+        """
+        Yields a (key, configuration) pair for every producer ('producers') and
+        every consumer ('consumers'), in the order of the input file.
+        """
+        with open(self.path, encoding='utf-8') as input_file:
+            stream = JsonStream(input_file, self.chunk_size)
+            for key in stream.members():
+                if key not in LIST_KEYS:
+                    stream.value()
+                    continue
+
+                convert = self.producer if key == 'producers' else self.consumer
+                for config in stream.elements():
+                    yield key, convert(config)
+
+    def load(self):
+        """
+        Returns the whole scenario as a dict, like the parsed input file with
+        the product ids replaced by products.
+        """
+        market_config = {'marketplace': self.marketplace, 'producers': [], 'consumers': []}
+        for key, config in self.stream():
+            market_config[key].append(config)
+        return market_config
+
+
+class TestScenario(unittest.TestCase):
+    """
+    Class for testing the scenario loader
+    """
+
+    def test_json_stream(self):
+        stream = JsonStream(io.StringIO('{"a": [1, {"b": 22}, []], "c": 333 , "d": {}}'),
+                            chunk_size=3)
+        keys = []
+        for key in stream.members():
+            keys.append(key)
+            if key == 'a':
+                self.assertEqual(list(stream.elements()), [1, {'b': 22}, []])
+            else:
+                self.assertIn(stream.value(), (333, {}))
+
+        self.assertEqual(keys, ['a', 'c', 'd'])
+
+    def test_scenario(self):
+        scenario = {
+            'products': {'id1': {'product_type': 'Tea', 'name': 'Test', 'price': 12,
+                                 'type': 'test type'}},
+            'producers': [{'name': 'prod1', 'products': [['id1', 2, 0.1]],
+                           'republish_wait_time': 0.2}],
+            'consumers': [{'name': 'cons1', 'retry_wait_time': 0.1,
+                           'carts': [[{'type': 'add', 'product': 'id1', 'quantity': 2}]]}],
+            'marketplace': {'queue_size_per_producer': 5},
+        }
+        tea = Tea(name='Test', price=12, type='test type')
+
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            path = os.path.join(scenario_dir, 'test.in')
+            with open(path, 'w', encoding='utf-8') as scenario_file:
+                json.dump(scenario, scenario_file, indent=4)
+
+            scenario = Scenario(path, chunk_size=16)
+            self.assertEqual(scenario.marketplace, {'queue_size_per_producer': 5})
+            self.assertEqual([key for key, _ in scenario.stream()], ['producers', 'consumers'])
+            market_config = scenario.load()
+
+        self.assertEqual(market_config['producers'][0]['products'], [(tea, 2, 0.1)])
+        self.assertEqual(market_config['consumers'][0]['carts'][0][0]['product'], tea)
+
+    def test_header_first(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            path = os.path.join(scenario_dir, 'test.in')
+            with open(path, 'w', encoding='utf-8') as scenario_file:
+                # the lists after the header aren't read by the constructor
+                scenario_file.write('{"products": {}, '
+                                    '"marketplace": {"queue_size_per_producer": 5}, '
+                                    '"producers": [not json')
+
+            scenario = Scenario(path, chunk_size=16)
+
+        self.assertEqual(scenario.marketplace, {'queue_size_per_producer': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+"""
+This module represents the producer and consumer scripts used by the engines
+that don't run one thread per producer/consumer.
+
+A script is a generator that yields either a call, i.e. a tuple with the name of
+a Marketplace method followed by its arguments (the engine sends the result
+back), or a number of seconds the script has to wait before its next step.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import unittest
+
+from tema.cart import CartExpired
+from tema.consumer import print_order
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+
+def execute(marketplace, call, output=print_order):
+    """
+    Executes a call yielded by a script on the marketplace.
+
+    The 'print_order' call places the order of a cart and passes its
+    (product, count) lines to output, since the consumer can't print them
+    itself when it runs in another process. A call on a cart that has expired
+    returns None, so the script can start the cart over.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace
+
+    :type call: Tuple
+    :param call: the name of the method followed by its arguments
+
+    :type output: Function
+    :param output: the function that prints an order
+
+    :returns the result of the call
+    """
+    try:
+        if call[0] == 'print_order':
+            lines = marketplace.place_order_lines(call[2])
+            output(call[1], lines)
+            return sum(count for _, count in lines)
+
+        return getattr(marketplace, call[0])(*call[1:])
+    except CartExpired:
+        return None
+
+
+def drive(script, call):
+    """
+    Runs a script, with a generator function that carries out its calls. Yields
+    the number of seconds the script waits (and sends back the value it gets)
+    and everything call yields (and sends back to call the value it gets).
+
+    :type script: Generator
+    :param script: a producer or a consumer script
+
+    :type call: Function
+    :param call: called with every call of the script, returns a generator
+    whose return value is sent to the script
+    """
+    value = None
+    while True:
+        try:
+            step = script.send(value)
+        except StopIteration:
+            return
+
+        if isinstance(step, tuple):
+            value = yield from call(step)
+        else:
+            value = yield step
+
+
+def producer_script(products, republish_wait_time, name=None):
+    """
+    Publishes the products forever, like Producer.run().
+
+    :type products: List()
+    :param products: a list of (product, quantity, wait time) tuples
+
+    :type republish_wait_time: Time
+    :param republish_wait_time: the number of seconds to wait after publishing a unit
+
+    :type name: String
+    :param name: the producer's name
+    """
+    # pylint: disable=unused-argument
+    producer_id = yield ('register_producer',)
+
+    while True:
+        for product, quantity, wait_time in products:
+            remaining = quantity
+            while remaining > 0:
+                published = yield ('publish_many', producer_id, product, remaining)
+                remaining -= published
+
+                # wait for the queue to free up or pace the production
+                yield republish_wait_time * published if published else wait_time
+
+
+def fill_cart(cart_id, cart, retry_wait_time):
+    """
+    Executes the operations of a cart, like Consumer.fill_cart().
+
+    :type cart_id: Int
+    :param cart_id: the id of the cart
+
+    :type cart: List
+    :param cart: the add and remove operations
+
+    :type retry_wait_time: Time
+    :param retry_wait_time: the number of seconds to wait for a product to be published
+
+    :returns False if the cart expired before all the operations were done
+    """
+    for action in cart:
+        if action['type'] == 'add':
+            remaining = action['quantity']
+            while remaining > 0:
+                added = yield ('add_many_to_cart', cart_id, action['product'], remaining)
+                if added is None:
+                    return False
+                remaining -= added
+                if added == 0:
+                    yield retry_wait_time
+        if action['type'] == 'remove':
+            removed = yield ('remove_many_from_cart', cart_id, action['product'],
+                             action['quantity'])
+            if removed is None:
+                return False
+
+    return True
+
+
+def consumer_script(carts, retry_wait_time, name):
+    """
+    Executes the operations of every cart and places the orders, like Consumer.run().
+
+    :type carts: List
+    :param carts: a list of add and remove operations
+
+    :type retry_wait_time: Time
+    :param retry_wait_time: the number of seconds to wait for a product to be published
+
+    :type name: String
+    :param name: the consumer's name
+    """
+    for cart in carts:
+        ordered = None
+        while ordered is None:
+            # a cart that expired is started over in a new one
+            cart_id = yield ('new_cart',)
+            if (yield from fill_cart(cart_id, cart, retry_wait_time)):
+                ordered = yield ('print_order', name, cart_id)
+
+
+def sample_market(producers=1, wait_time=0.01, republish_wait_time=0.001,
+                  retry_wait_time=0.01):
+    """
+    Returns the scenario run by the tests of the engines: 20 consumers that buy
+    3 units of a tea and 1 of another in their first cart and leave the second
+    one empty, i.e. 80 order lines in total.
+
+    :type producers: Int
+    :param producers: the number of producers, each one publishing both teas
+
+    :type wait_time: Time
+    :param wait_time: the producers' wait time after every product
+
+    :type republish_wait_time: Time
+    :param republish_wait_time: the producers' wait time after publishing a unit
+
+    :type retry_wait_time: Time
+    :param retry_wait_time: the consumers' wait time for a product out of stock
+    """
+    tea = Tea(name='Test', price=12, type='test type')
+    tea2 = Tea(name='Test 2', price=10, type='test type 2')
+
+    return {
+        'marketplace': {'queue_size_per_producer': 10},
+        'producers': [{'name': f'prod{i}',
+                       'products': [(tea, 3, wait_time), (tea2, 1, wait_time)],
+                       'republish_wait_time': republish_wait_time} for i in range(producers)],
+        'consumers': [{'name': f'cons{i}', 'retry_wait_time': retry_wait_time,
+                       'carts': [[{'type': 'add', 'product': tea, 'quantity': 3},
+                                  {'type': 'add', 'product': tea2, 'quantity': 1}],
+                                 [{'type': 'add', 'product': tea, 'quantity': 1},
+                                  {'type': 'remove', 'product': tea, 'quantity': 1}]]}
+                      for i in range(20)],
+    }
+
+
+def market_entities(market_config):
+    """
+    Returns the producers and then the consumers of a scenario as the
+    (key, configuration) pairs streamed by Scenario.stream().
+
+    :type market_config: Dict
+    :param market_config: the scenario, e.g. returned by sample_market()
+    """
+    return ([('producers', config) for config in market_config['producers']]
+            + [('consumers', config) for config in market_config['consumers']])
+
+
+def check_sample_orders(test, market_config, output):
+    """
+    Checks the orders printed by a run of sample_market().
+
+    :type test: TestCase
+    :param test: the test that makes the assertions
+
+    :type market_config: Dict
+    :param market_config: the scenario returned by sample_market()
+
+    :type output: String
+    :param output: what the run printed
+    """
+    (tea, _, _), (tea2, _, _) = market_config['producers'][0]['products']
+    lines = output.splitlines()
+
+    test.assertEqual(len(lines), 80)
+    test.assertEqual(lines.count(f'cons0 bought {tea}'), 3)
+    test.assertEqual(lines.count(f'cons19 bought {tea2}'), 1)
+
+
+class TestScripts(unittest.TestCase):
+    """
+    Class for testing the scripts
+    """
+
+    def test_scripts(self):
+        marketplace = Marketplace(2)
+        tea = Tea(name='Test', price=12, type='test type')
+        orders = []
+
+        def output(name, lines):
+            orders.append((name, lines))
+
+        producer = producer_script([(tea, 3, 0.5)], 0.1)
+        consumer = consumer_script([[{'type': 'add', 'product': tea, 'quantity': 3},
+                                     {'type': 'remove', 'product': tea, 'quantity': 1}]],
+                                   0.2, 'cons1')
+
+        # register the producer and publish the first two units
+        self.assertEqual(execute(marketplace, next(producer)), 0)
+        self.assertEqual(producer.send(0), ('publish_many', 0, tea, 3))
+        self.assertEqual(producer.send(execute(marketplace, ('publish_many', 0, tea, 3))),
+                         0.2)
+
+        # the consumer gets two units, then waits for the third one
+        call = consumer.send(None)
+        self.assertEqual(call, ('new_cart',))
+        call = consumer.send(execute(marketplace, call))
+        call = consumer.send(execute(marketplace, call))
+        self.assertEqual(call, ('add_many_to_cart', 0, tea, 1))
+        self.assertEqual(consumer.send(execute(marketplace, call)), 0.2)
+
+        self.assertEqual(producer.send(None), ('publish_many', 0, tea, 1))
+        execute(marketplace, ('publish_many', 0, tea, 1))
+        call = consumer.send(None)
+        call = consumer.send(execute(marketplace, call))
+        call = consumer.send(execute(marketplace, call))
+        self.assertEqual(call, ('print_order', 'cons1', 0))
+
+        self.assertEqual(execute(marketplace, call, output), 2)
+        self.assertEqual(orders, [('cons1', [(tea, 2)])])
+        self.assertRaises(StopIteration, consumer.send, 2)
+
+    def test_expired_cart(self):
+        marketplace = Marketplace(2)
+        tea = Tea(name='Test', price=12, type='test type')
+        consumer = consumer_script([[{'type': 'add', 'product': tea, 'quantity': 1}]],
+                                   0.2, 'cons1')
+
+        marketplace.register_producer()
+        marketplace.publish(0, tea)
+        cart_id = execute(marketplace, consumer.send(None))
+        call = consumer.send(cart_id)
+        self.assertEqual(call, ('add_many_to_cart', cart_id, tea, 1))
+        self.assertEqual(marketplace.expire_carts(0), 1)
+
+        # the call on the expired cart returns None and the cart starts over
+        self.assertIsNone(execute(marketplace, call))
+        call = consumer.send(None)
+        self.assertEqual(call, ('new_cart',))
+        call = consumer.send(execute(marketplace, call))
+        self.assertEqual(consumer.send(execute(marketplace, call)),
+                         ('print_order', 'cons1', call[1]))
+
+
+    def test_drive(self):
+        tea = Tea(name='Test', price=12, type='test type')
+
+        def call(step):
+            # the calls are passed through, with their results sent back
+            return (yield step)
+
+        steps = drive(producer_script([(tea, 1, 0.5)], 0.1), call)
+        self.assertEqual(next(steps), ('register_producer',))
+        self.assertEqual(steps.send(7), ('publish_many', 7, tea, 1))
+        self.assertEqual(steps.send(1), 0.1)
+        self.assertEqual(steps.send(None), ('publish_many', 7, tea, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
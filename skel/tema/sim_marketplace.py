@@ -0,0 +1,208 @@
+"""
+This module represents the simulation engine of the Marketplace.
+
+The producers and the consumers run as scripts against a virtual clock: the
+waits they yield are not slept, they only schedule the next step of the script
+in an event queue, and the Marketplace calls take no (virtual) time. The steps
+scheduled at the same time run in an order drawn from the seed, so a run is
+deterministic for a given seed.
+
+A run stalls when every script left keeps retrying a call that fails: since
+the calls take no time and change nothing when they fail, none of them can
+succeed anymore. The simulation detects it and raises Stalled instead of
+running forever.
+
+The Marketplace still logs its calls: at the INFO level, writing the records
+takes most of the wall-clock time of a run, so test.py only logs warnings for
+this engine unless --log-level is given.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import io
+import random
+import unittest
+from contextlib import redirect_stdout
+from itertools import count
+
+from tema.scripts import (check_sample_orders, consumer_script, execute, market_entities,
+                          print_order, producer_script, sample_market)
+from tema.timed_marketplace import create_marketplace
+
+# the calls that fail (return 0) when the product or a slot isn't available yet
+RETRIED_CALLS = {'publish_many', 'add_many_to_cart'}
+
+
+class Stalled(Exception):
+    """
+    Raised when no script can make progress anymore.
+    """
+
+    def __init__(self, time, consumers):
+        """
+        Constructor
+
+        :type time: Float
+        :param time: the simulated time of the stall, in seconds
+
+        :type consumers: Int
+        :param consumers: the number of consumers that are not done
+        """
+        super().__init__(f'the simulation stalled at {time:.3f}s with {consumers} '
+                         f'consumers not done')
+        self.time = time
+        self.consumers = consumers
+
+
+def run_market(marketplace_config, entities, seed=0, output=print_order, max_time=None, *,
+               make_producer=producer_script):
+    """
+    Simulates producers and consumers until all the consumers are done.
+
+    :type marketplace_config: Dict
+    :param marketplace_config: the arguments of the Marketplace
+
+    :type entities: Iterable
+    :param entities: ('producers', configuration) and ('consumers', configuration)
+    pairs, like the ones streamed by Scenario.stream(); every script starts at
+    time 0, in this order
+
+    :type seed: Int
+    :param seed: the seed that orders the steps scheduled at the same time
+
+    :type output: Function
+    :param output: the function that prints an order
+
+    :type max_time: Float
+    :param max_time: stop the simulation after this many (virtual) seconds,
+    even if some consumers are not done (None means never)
+
+    :type make_producer: Function
+    :param make_producer: makes the script of a producer from its configuration
+
+    :returns the simulated duration of the run, in seconds
+
+    :raises Stalled: if the consumers that are not done can't ever be done
+    """
+    marketplace = create_marketplace(**marketplace_config)
+    rng = random.Random(seed)
+    # (time, random tie breaker, sequence number, script, value sent to the script)
+    events = []
+    sequence = count()
+
+    def schedule(time, script):
+        heapq.heappush(events, (time, rng.random(), next(sequence), script))
+
+    consumers = set()
+    for key, config in entities:
+        if key == 'producers':
+            schedule(0, make_producer(**config))
+        else:
+            script = consumer_script(**config)
+            consumers.add(script)
+            schedule(0, script)
+
+    scripts = len(events)
+    # the scripts whose last call failed, since the last call that didn't
+    failing = set()
+    now = 0
+    while consumers and events:
+        now, _, _, script = heapq.heappop(events)
+        if max_time is not None and now > max_time:
+            now = max_time
+            break
+
+        # the calls take no time: run the script up to its next wait
+        try:
+            step = script.send(None)
+            while isinstance(step, tuple):
+                result = execute(marketplace, step, output)
+                if result or step[0] not in RETRIED_CALLS:
+                    failing.clear()
+                else:
+                    failing.add(script)
+                step = script.send(result)
+        except StopIteration:
+            consumers.discard(script)
+            scripts -= 1
+            continue
+
+        if len(failing) == scripts:
+            raise Stalled(now, len(consumers))
+
+        schedule(now + step, script)
+
+    return now
+
+
+class TestSimMarketplace(unittest.TestCase):
+    """
+    Class for testing the simulation engine
+    """
+
+    def setUp(self):
+        self.market_config = sample_market(producers=2, wait_time=0.5, republish_wait_time=0.1,
+                                           retry_wait_time=0.2)
+
+    def run_market(self, seed, **kwargs):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            duration = run_market(self.market_config['marketplace'],
+                                  market_entities(self.market_config), seed, **kwargs)
+        return duration, output.getvalue()
+
+    def test_run_market(self):
+        duration, output = self.run_market(1)
+
+        check_sample_orders(self, self.market_config, output)
+        # the 2 producers publish 20 units a second and 80 units are bought
+        self.assertGreater(duration, 4)
+
+    def test_deterministic(self):
+        self.assertEqual(self.run_market(1), self.run_market(1))
+        self.assertNotEqual(self.run_market(1)[1], self.run_market(2)[1])
+
+    def test_seeds(self):
+        # every seed gives the right orders, and always in the same order
+        outputs = set()
+        for seed in range(5):
+            duration, output = self.run_market(seed)
+            check_sample_orders(self, self.market_config, output)
+            self.assertEqual(self.run_market(seed), (duration, output))
+            outputs.add(output)
+        self.assertGreater(len(outputs), 1)
+
+    def test_make_producer(self):
+        names = []
+
+        def make_producer(**config):
+            names.append(config['name'])
+            return producer_script(**config)
+
+        self.assertEqual(self.run_market(1, make_producer=make_producer), self.run_market(1))
+        self.assertEqual(names, ['prod0', 'prod1'])
+
+    def test_max_time(self):
+        duration, output = self.run_market(1, max_time=1)
+
+        self.assertEqual(duration, 1)
+        self.assertLess(len(output.splitlines()), 80)
+
+    def test_stalled(self):
+        # the consumers only want the second tea, but the producers fill their
+        # queues with the first one before they get to it
+        tea2 = self.market_config['producers'][0]['products'][1][0]
+        self.market_config['marketplace']['queue_size_per_producer'] = 3
+        for c_config in self.market_config['consumers']:
+            c_config['carts'] = [[{'type': 'add', 'product': tea2, 'quantity': 1}]]
+
+        with self.assertRaises(Stalled) as stalled:
+            self.run_market(1)
+        self.assertEqual(stalled.exception.consumers, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,426 @@
+"""
+This module represents the versioned snapshots of the stock of the Marketplace.
+
+The Stripes record every change of the stock as a (product_id, producer_id,
+count) delta in a deque, which needs no lock. A reader asking for a snapshot
+applies the pending deltas to the previous snapshot and publishes the new one
+by replacing a reference. The counts are kept in ChunkedMaps, which split the
+ids into chunks of CHUNK_SIZE: a new snapshot copies the chunks of the products
+and the producers that changed and the list of the chunks, and shares the rest
+with the previous one. The published snapshots are never changed, so a reader
+never waits for a writer, and the writers never wait for the readers. A reader
+that comes while another thread is publishing gets the last snapshot instead
+of waiting for the new one. When nobody reads for a while, the deltas are
+folded by a background thread before too many of them pile up.
+
+Folding the deltas takes no lock of the Marketplace, but it is Python code that
+holds the GIL, so frequent reads take CPU time from the other threads: with
+interval 0, every read after a change folds the deltas (python3 -m bench.micro
+--readers measures it).
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import operator
+import time
+import unittest
+from collections import deque
+from collections.abc import Mapping
+from threading import Lock, Thread
+from types import MappingProxyType
+
+from tema.catalog import ProductCatalog
+from tema.product import Tea
+
+# the number of pending deltas after which they are folded into a snapshot in
+# the background, even if nobody reads it
+MAX_PENDING_DELTAS = 1 << 16
+EMPTY = MappingProxyType({})
+# the ChunkedMaps split the ids into chunks of 2 ** CHUNK_BITS consecutive ids
+CHUNK_BITS = 6
+CHUNK_SIZE = 1 << CHUNK_BITS
+
+
+class ChunkedMap(Mapping):
+    """
+    Class that represents an immutable map of integer ids, split into chunks of
+    CHUNK_SIZE consecutive ids. A map updated with some changes shares the
+    chunks of the ids that didn't change with the map it was made from.
+    """
+
+    def __init__(self, chunks=(), size=0):
+        """
+        Constructor
+
+        :type chunks: Tuple
+        :param chunks: the {id: value} dict of every chunk (None if empty)
+
+        :type size: Int
+        :param size: the number of ids in the map
+        """
+        self.chunks = chunks
+        self.size = size
+
+    def __getitem__(self, key):
+        index = key >> CHUNK_BITS
+        if 0 <= index < len(self.chunks):
+            chunk = self.chunks[index]
+            if chunk is not None and key in chunk:
+                return chunk[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if chunk is not None:
+                yield from chunk
+
+    def __len__(self):
+        return self.size
+
+    def updated(self, changes):
+        """
+        Returns a new map with the changes applied; this one isn't changed.
+
+        :type changes: Dict
+        :param changes: id -> the new value, or None to remove the id
+        """
+        chunks = list(self.chunks)
+        size = self.size
+        # the chunks copied so far, which can be changed in place
+        copied = set()
+
+        for key, value in changes.items():
+            index = key >> CHUNK_BITS
+            if index >= len(chunks):
+                chunks.extend([None] * (index + 1 - len(chunks)))
+            chunk = chunks[index]
+            if index not in copied:
+                chunk = chunks[index] = dict(chunk) if chunk is not None else {}
+                copied.add(index)
+
+            size -= key in chunk
+            if value is None:
+                chunk.pop(key, None)
+            else:
+                chunk[key] = value
+                size += 1
+
+        for index in copied:
+            if not chunks[index]:
+                chunks[index] = None
+        return ChunkedMap(tuple(chunks), size)
+
+
+class ProductMap(Mapping):
+    """
+    Class that represents a ChunkedMap of product ids as a map of the products.
+    """
+
+    def __init__(self, catalog, by_id):
+        """
+        Constructor
+
+        :type catalog: ProductCatalog
+        :param catalog: the catalog that gives the products their ids
+
+        :type by_id: ChunkedMap
+        :param by_id: product_id -> value
+        """
+        self.catalog = catalog
+        self.by_id = by_id
+
+    def __getitem__(self, product):
+        product_id = self.catalog.ids.get(product)
+        if product_id is None:
+            raise KeyError(product)
+        return self.by_id[product_id]
+
+    def __iter__(self):
+        return map(self.catalog.product, self.by_id)
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class InventorySnapshot:
+    """
+    Class that represents the stock of the Marketplace at some point in time.
+    It is immutable.
+    """
+
+    def __init__(self, version, stock, totals, producers):
+        """
+        Constructor
+
+        :type version: Int
+        :param version: the number of snapshots published before this one
+
+        :type stock: ProductMap
+        :param stock: product -> {producer_id: the number of units in stock}
+
+        :type totals: ProductMap
+        :param totals: product -> the number of units in stock
+
+        :type producers: ChunkedMap
+        :param producers: producer_id -> the number of units in stock
+        """
+        self.version = version
+        self.created = time.monotonic()
+        self.stock = stock
+        self.totals = totals
+        self.producers = producers
+
+    def count(self, product, producer_id=None):
+        """
+        Returns the number of units of a product in stock, from all the
+        producers or from the given one.
+        """
+        if producer_id is None:
+            return self.totals.get(product, 0)
+        return self.stock.get(product, EMPTY).get(producer_id, 0)
+
+
+class SnapshotPublisher:
+    """
+    Class that collects the changes of the stock and publishes them as
+    InventorySnapshots, at most once every interval seconds.
+    """
+
+    def __init__(self, catalog, interval=0):
+        """
+        Constructor
+
+        :type catalog: ProductCatalog
+        :param catalog: the catalog that gives the products their ids
+
+        :type interval: Float
+        :param interval: the minimum number of seconds between two snapshots; the
+        readers get the last snapshot in the meanwhile (0: a read sees all the
+        changes made before it, unless another thread is publishing a snapshot
+        at the time, in which case it gets the last one instead of waiting)
+        """
+        self.catalog = catalog
+        self.interval = interval
+        self.deltas = deque()
+        # only taken by the threads that build a snapshot, without waiting
+        self.lock = Lock()
+        self.publishing = False
+        self.snapshot = InventorySnapshot(0, ProductMap(catalog, ChunkedMap()),
+                                          ProductMap(catalog, ChunkedMap()), ChunkedMap())
+
+    def record(self, product_id, producer_id, count):
+        """
+        Records a change of the stock; it can be called from any thread.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type producer_id: Int
+        :param producer_id: the producer
+
+        :type count: Int
+        :param count: the number of units added (or removed, if negative)
+        """
+        self.deltas.append((product_id, producer_id, count))
+        if len(self.deltas) >= MAX_PENDING_DELTAS:
+            self.publish_later()
+
+    def publish_later(self):
+        """
+        Publishes the pending deltas in a new thread, so that the writer that
+        found too many of them doesn't fold them while it holds its locks.
+        """
+        if not self.publishing:
+            self.publishing = True
+            Thread(target=self.publish, daemon=True).start()
+
+    def publish(self):
+        """
+        Applies the pending deltas to a copy of the last snapshot and publishes
+        it, unless another thread is doing it already.
+        """
+        # a with statement can't give up on a busy lock
+        if not self.lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return
+
+        try:
+            self.publishing = False
+            # only this thread takes deltas out, so all the counted ones are there
+            popleft = self.deltas.popleft
+            deltas = [popleft() for _ in range(len(self.deltas))]
+            if deltas:
+                self.snapshot = self.fold(self.snapshot, deltas)
+        finally:
+            self.lock.release()
+
+    def fold(self, snapshot, deltas):
+        """
+        Returns the snapshot that follows the given one, with the deltas applied.
+
+        :type snapshot: InventorySnapshot
+        :param snapshot: the last snapshot (it isn't changed)
+
+        :type deltas: List
+        :param deltas: the (product_id, producer_id, count) changes since snapshot
+        """
+        # product_id -> {producer_id: the change of its units}
+        changes = {}
+        for product_id, producer_id, count in deltas:
+            changed = changes.get(product_id)
+            if changed is None:
+                changes[product_id] = {producer_id: count}
+            else:
+                changed[producer_id] = changed.get(producer_id, 0) + count
+
+        stock = snapshot.stock.by_id
+        totals = snapshot.totals.by_id
+        producers = snapshot.producers
+        # id -> the new value (None if it is gone) of the entries that changed
+        stock_changes = {}
+        total_changes = {}
+        producer_changes = {}
+
+        for product_id, changed in changes.items():
+            counts = dict(stock.get(product_id, EMPTY))
+            total = totals.get(product_id, 0)
+
+            for producer_id, count in changed.items():
+                if not count:
+                    continue
+                total += count
+                producer_count = producer_changes.get(producer_id)
+                if producer_count is None:
+                    producer_count = producers.get(producer_id, 0)
+                producer_changes[producer_id] = producer_count + count
+                count += counts.get(producer_id, 0)
+                if count:
+                    counts[producer_id] = count
+                else:
+                    del counts[producer_id]
+
+            stock_changes[product_id] = MappingProxyType(counts) if counts else None
+            total_changes[product_id] = total if counts else None
+
+        for producer_id, count in producer_changes.items():
+            if not count:
+                producer_changes[producer_id] = None
+        return InventorySnapshot(snapshot.version + 1,
+                                 ProductMap(self.catalog, stock.updated(stock_changes)),
+                                 ProductMap(self.catalog, totals.updated(total_changes)),
+                                 producers.updated(producer_changes))
+
+    def get(self):
+        """
+        Returns the latest snapshot, publishing a new one first if there are
+        changes and the interval has passed. It never waits: while another
+        thread publishes a snapshot, the last one is returned, which may lag
+        behind the changes made before the call.
+        """
+        snapshot = self.snapshot
+        if self.deltas and time.monotonic() - snapshot.created >= self.interval:
+            self.publish()
+        return self.snapshot
+
+
+class TestSnapshotPublisher(unittest.TestCase):
+    """
+    Class for testing the inventory snapshots
+    """
+
+    def setUp(self):
+        self.catalog = ProductCatalog()
+        self.tea = Tea(name='Test', price=12, type='test type')
+        self.tea2 = Tea(name='Test 2', price=10, type='test type 2')
+        self.catalog.intern(self.tea)
+        self.catalog.intern(self.tea2)
+
+    def test_publish(self):
+        publisher = SnapshotPublisher(self.catalog)
+        empty = publisher.get()
+        publisher.record(0, 0, 3)
+        publisher.record(0, 1, 2)
+        publisher.record(1, 1, 1)
+
+        first = publisher.get()
+        self.assertEqual(first.version, 1)
+        self.assertEqual(first.count(self.tea), 5)
+        self.assertEqual(first.count(self.tea, 1), 2)
+        self.assertEqual(dict(first.producers), {0: 3, 1: 3})
+        self.assertIs(publisher.get(), first)
+
+        publisher.record(0, 0, -3)
+        publisher.record(1, 1, -1)
+        second = publisher.get()
+        self.assertEqual(dict(second.totals), {self.tea: 2})
+        self.assertEqual(dict(second.stock[self.tea]), {1: 2})
+        self.assertEqual(second.count(self.tea2), 0)
+        self.assertEqual(dict(second.producers), {1: 2})
+
+        # the older snapshots didn't change
+        self.assertEqual(empty.count(self.tea), 0)
+        self.assertEqual(first.count(self.tea, 0), 3)
+        self.assertRaises(TypeError, operator.setitem, first.totals, self.tea, 1)
+
+    def test_chunked_map(self):
+        first = ChunkedMap().updated({1: 'a', CHUNK_SIZE: 'b', 3 * CHUNK_SIZE: 'c'})
+        second = first.updated({1: None, 3 * CHUNK_SIZE + 1: 'd'})
+
+        self.assertEqual(dict(first), {1: 'a', CHUNK_SIZE: 'b', 3 * CHUNK_SIZE: 'c'})
+        self.assertEqual(dict(second), {CHUNK_SIZE: 'b', 3 * CHUNK_SIZE: 'c',
+                                        3 * CHUNK_SIZE + 1: 'd'})
+        self.assertEqual(len(second), 3)
+        self.assertNotIn(1, second)
+        self.assertNotIn(5 * CHUNK_SIZE, second)
+        # the chunk that didn't change is shared, the emptied one is dropped
+        self.assertIs(second.chunks[1], first.chunks[1])
+        self.assertIsNone(second.chunks[0])
+
+    def test_shared_products(self):
+        publisher = SnapshotPublisher(self.catalog)
+        publisher.record(0, 0, 1)
+        publisher.record(CHUNK_SIZE, 0, 1)
+        first = publisher.get()
+        publisher.record(CHUNK_SIZE, 1, 1)
+        second = publisher.get()
+
+        # only the chunk of the product that changed was copied
+        self.assertIs(second.stock.by_id.chunks[0], first.stock.by_id.chunks[0])
+        self.assertIsNot(second.totals.by_id.chunks[1], first.totals.by_id.chunks[1])
+        self.assertEqual(second.totals.by_id[CHUNK_SIZE], 2)
+        self.assertEqual(dict(second.producers), {0: 2, 1: 1})
+
+    def test_interval(self):
+        publisher = SnapshotPublisher(self.catalog, interval=60)
+        publisher.record(0, 0, 1)
+        # the first snapshot was created with the publisher
+        self.assertEqual(publisher.get().version, 0)
+        publisher.publish()
+        publisher.record(0, 0, 1)
+        self.assertEqual(publisher.get().count(self.tea), 1)
+
+    def test_publish_later(self):
+        publisher = SnapshotPublisher(self.catalog)
+        for _ in range(MAX_PENDING_DELTAS):
+            publisher.record(0, 0, 1)
+
+        # nobody reads, but the deltas don't pile up
+        deadline = time.monotonic() + 5
+        while publisher.snapshot.version == 0 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertLess(len(publisher.deltas), MAX_PENDING_DELTAS)
+        self.assertEqual(publisher.get().count(self.tea), MAX_PENDING_DELTAS)
+
+    def test_no_wait(self):
+        publisher = SnapshotPublisher(self.catalog)
+        publisher.record(0, 0, 1)
+
+        # while another thread builds a snapshot, the readers get the last one
+        with publisher.lock:
+            self.assertEqual(publisher.get().version, 0)
+        self.assertEqual(publisher.get().version, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+This module represents the Marketplace that collects metrics: the latency of
+its methods and the wait and hold times of its locks.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import unittest
+
+from tema.marketplace import Marketplace
+from tema.metrics import Metrics, timed_methods
+from tema.product import Tea
+
+# the methods timed when the Marketplace collects metrics
+TIMED_METHODS = ['register_producer', 'publish', 'publish_many', 'new_cart', 'add_to_cart',
+                 'add_many_to_cart', 'remove_from_cart', 'remove_many_from_cart',
+                 'place_order', 'place_order_lines', 'get_print_lock', 'expire_carts',
+                 'find_products', 'add_matching_to_cart', 'inventory_snapshot']
+# the methods whose failed calls (False or 0 units) are counted
+FAILING_METHODS = {'publish', 'publish_many', 'add_to_cart', 'add_many_to_cart'}
+
+
+@timed_methods(TIMED_METHODS, FAILING_METHODS)
+class TimedMarketplace(Marketplace):
+    """
+    Class that represents a Marketplace that records the latency of its methods
+    and the wait and hold times of its locks.
+    """
+    def __init__(self, queue_size_per_producer, lock_stripes=16, *, metrics, **kwargs):
+        """
+        Constructor
+
+        :type metrics: Metrics
+        :param metrics: where the latencies and the lock times are recorded
+
+        :type kwargs:
+        :param kwargs: the other arguments of the Marketplace
+        """
+        # the locks are made by the Marketplace's constructor
+        self.metrics = metrics
+        super().__init__(queue_size_per_producer, lock_stripes, **kwargs)
+
+    def lock_factory(self, name):
+        return self.metrics.lock_factory(name)
+
+
+def create_marketplace(queue_size_per_producer, lock_stripes=16, *, metrics=None, **kwargs):
+    """
+    Returns a new Marketplace, a TimedMarketplace if metrics is given.
+
+    :type metrics: Metrics
+    :param metrics: if given, the latency of every method and the wait and hold
+    times of the locks are recorded in it (nothing is recorded by default)
+
+    :type kwargs:
+    :param kwargs: the other arguments of the Marketplace
+    """
+    if metrics is None:
+        return Marketplace(queue_size_per_producer, lock_stripes, **kwargs)
+    return TimedMarketplace(queue_size_per_producer, lock_stripes, metrics=metrics, **kwargs)
+
+
+class TestTimedMarketplace(unittest.TestCase):
+    """
+    Class for testing the timed Marketplace
+    """
+
+    def test_metrics(self):
+        metrics = Metrics()
+        marketplace = create_marketplace(1, metrics=metrics)
+        tea = Tea(name='Test', price=12, type='test type')
+
+        marketplace.new_cart()
+        marketplace.register_producer()
+        self.assertTrue(marketplace.publish(0, tea))
+        self.assertFalse(marketplace.publish(0, tea))
+        self.assertTrue(marketplace.add_to_cart(0, tea))
+        self.assertFalse(marketplace.add_to_cart(0, tea))
+        with marketplace.get_print_lock():
+            pass
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['publish.failed'], 1)
+        self.assertEqual(snapshot['counters']['add_to_cart.failed'], 1)
+        # the calls add_to_cart and publish make are not counted again
+        self.assertNotIn('add_many_to_cart.failed', snapshot['counters'])
+        self.assertNotIn('publish_many.failed', snapshot['counters'])
+        self.assertEqual(snapshot['latency_ns']['publish']['count'], 2)
+        self.assertEqual(snapshot['latency_ns']['add_many_to_cart']['count'], 2)
+        self.assertEqual(snapshot['latency_ns']['lock.queue_lock.hold']['count'], 3)
+        self.assertEqual(snapshot['latency_ns']['lock.print_lock.wait']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
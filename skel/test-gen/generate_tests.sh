@@ -11,3 +11,7 @@ python3 test_generator.py 08 10 50 5 40 1 5
 python3 test_generator.py 09 20 5 2 25 1 2
 python3 test_generator.py 10 50 200 10 40 1 5
 
+
+# large scenarios (synthetic products, aggregated reference), written in a single streaming pass
+# usage: stream_generator.py [-h] [--seed SEED] [--products-per-producer N] [--tests-dir DIR] test_name [producers] [consumers] [products] ...
+# python3 stream_generator.py big 5000 1000000 5000 100 1 3 False
@@ -0,0 +1,359 @@
+"""
+Generates large test scenarios in a single streaming pass.
+
+Unlike test_generator.py, which builds the whole scenario in memory and can't
+have more than 8 coffees and 15 teas, this script makes up the product names
+(e.g. 'Arabica 17'), writes every producer and consumer to the input file as
+soon as it is generated and writes the reference output in the aggregated
+format of check_test.py ('consumer, product, count'), one consumer at a time.
+No .json file is written. The memory used depends only on the number of
+products, and the same seed always gives the same files.
+
+Script input
+    - test file name
+    - number of producers
+    - number of consumers
+    - number of products
+    - marketplace queue
+    - min number of carts per consumer
+    - max number of carts per consumer
+    - is basic test
+    - should have removal operations
+    - the seed (--seed) and the maximum number of products of a producer
+      (--products-per-producer)
+
+e.g. python3 stream_generator.py big 5000 1000000 5000 100 1 3 False
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import unittest
+from collections import Counter
+
+from tema.product import create_product
+from tema.scenario import Scenario
+
+# the scripts next to this one; pylint takes them for third party modules
+# when it isn't run from this directory
+# pylint: disable=wrong-import-order
+from test_generator import compute_expected_cart
+from test_utils import *  # pylint: disable=wildcard-import, unused-wildcard-import
+# pylint: enable=wrong-import-order
+
+DEFAULT_SEED = 0
+# a producer keeps publishing its products after nobody wants one of them any
+# more, so its queue can fill up with that product and starve the consumers of
+# the others (see generate_producers in test_generator.py); the producers of
+# several products only make products that some producer makes alone, whose
+# units always come back while they are wanted, so every test can finish
+DEFAULT_PRODUCTS_PER_PRODUCER = 3
+
+
+def parse_bool(value):
+    """
+    Parses a 'True'/'False' command line argument.
+    """
+    return value.lower() in ('true', '1', 'yes')
+
+
+def parse_input():
+    """
+    Parses command line input and returns a dictionary with all parameters.
+    Default values are used when there is no argument.
+    :return: a dict with all the arguments of the script
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(ARG_TEST_NAME, type=str, help="Test file name (no extension)")
+    parser.add_argument(ARG_PRODUCERS, type=int, nargs='?',
+                        default=DEFAULT_NUM_PRODUCERS, help="number of producers")
+    parser.add_argument(ARG_CONSUMERS, type=int, nargs='?',
+                        default=DEFAULT_NUM_CONSUMERS, help="number of consumers")
+    parser.add_argument(ARG_PRODUCTS, type=int, nargs='?',
+                        default=DEFAULT_NUM_PRODUCTS, help="number of products")
+    parser.add_argument(ARG_MARKETPLACE_Q, type=int, nargs='?',
+                        default=DEFAULT_MARKETPLACE_QUEUE_SIZE,
+                        help="queue size in the marketplace for each producer")
+    parser.add_argument(ARG_MIN_CARTS, type=int, nargs='?',
+                        default=DEFAULT_MIN_NUMBER_CARTS_PER_CONSUMER,
+                        help="minimum number of carts per consumer")
+    parser.add_argument(ARG_MAX_CARTS, type=int, nargs='?',
+                        default=DEFAULT_MAX_NUMBER_CARTS_PER_CONSUMER,
+                        help="maximum number of carts per consumer")
+    parser.add_argument(ARG_IS_BASIC, type=parse_bool, nargs='?', default=True,
+                        help="True if it is a simple test, False otherwise")
+    parser.add_argument(ARG_SUPPORTS_REMOVAL, type=parse_bool, nargs='?', default=True,
+                        help="True if the consumer can remove products from cart, False otherwise")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help="the seed of the generator; the same seed gives the same files")
+    parser.add_argument('--products-per-producer', type=int,
+                        default=DEFAULT_PRODUCTS_PER_PRODUCER,
+                        help="the maximum number of products a producer makes")
+    parser.add_argument('--tests-dir', default=TESTS_DIR,
+                        help="the directory the files are written to")
+
+    return parser.parse_args().__dict__
+
+
+def generate_products(rng, count):
+    """
+    Returns a dict of product id -> product description, half coffees and
+    half teas, with names made of the known names and the product number.
+
+    :type rng: Random
+    :param rng: the random number generator
+
+    :type count: Int
+    :param count: the number of products to generate
+    """
+    tea_names = list(TEA_NAMES_TYPES)
+    products = {}
+
+    for i in range(count):
+        if i < count / 2:
+            product = {"product_type": "Coffee",
+                       "name": f'{rng.choice(COFFEE_NAMES)} {i + 1}',
+                       "acidity": round(rng.uniform(MIN_ACIDITY, MAX_ACIDITY), 2),
+                       "roast_level": rng.choice(ROAST_LEVEL)}
+        else:
+            tea = rng.choice(tea_names)
+            product = {"product_type": "Tea", "name": f'{tea} {i + 1}',
+                       "type": TEA_NAMES_TYPES[tea]}
+
+        product["price"] = rng.randint(1, 10)
+        products[PRODUCT_PREFIX + str(i + 1)] = product
+
+    return products
+
+
+def generate_producer(rng, index, product_ids, produced, *, products_per_producer, basic_test):
+    """
+    Returns the description of a producer, in the format of test_generator.py.
+    A producer makes either a single product, any of them, or several of the
+    products that are made alone by the producers before it.
+
+    :type rng: Random
+    :param rng: the random number generator
+
+    :type index: Int
+    :param index: the number of the producer, from 0
+
+    :type product_ids: List
+    :param product_ids: the ids of all the products
+
+    :type produced: List
+    :param produced: the ids of the products made alone by the producers before it
+
+    :type products_per_producer: Int
+    :param products_per_producer: the maximum number of products the producer makes
+
+    :type basic_test: Bool
+    :param basic_test: True if it's a simple test, False otherwise
+    """
+    # see generate_producers in test_generator.py
+    max_quantity = 3 if basic_test else 5
+    count = min(rng.randint(1, products_per_producer), len(produced))
+    made = rng.sample(produced, count) if count > 1 else [rng.choice(product_ids)]
+
+    return {"name": PRODUCER_NAME_PREFIX + str(index + 1),
+            ARG_PRODUCTS: [[product_id, rng.randint(1, max_quantity),
+                            round(rng.uniform(0.05, 0.4), 2)]
+                           for product_id in made],
+            "republish_wait_time": round(rng.uniform(0.05, 0.4), 2)}
+
+
+def generate_consumer(rng, index, product_ids, min_cart, max_cart, *, basic_test=True,
+                      has_remove_operation=True):
+    """
+    Returns the description of a consumer, in the format of the input file,
+    and a Counter with the units it buys of every product.
+
+    :type rng: Random
+    :param rng: the random number generator
+
+    :type index: Int
+    :param index: the number of the consumer, from 0
+
+    :type product_ids: List
+    :param product_ids: the ids of the products that are made by some producer
+    """
+    max_operations_per_cart = 3 if basic_test else 10
+    max_quantity = 5 if basic_test else 10
+    consumer = {"name": CONSUMER_NAME_PREFIX + str(index + 1),
+                "retry_wait_time": round(rng.uniform(0.05, 0.4), 2),
+                "carts": []}
+    bought = Counter()
+
+    for _ in range(rng.randint(min_cart, max_cart)):
+        num_operations = min(rng.randint(1, max_operations_per_cart), len(product_ids))
+        operations = [{"type": ADD_TO_CART_OP, "product": product_id,
+                       "quantity": rng.randint(1, max_quantity)}
+                      for product_id in rng.sample(product_ids, num_operations)]
+
+        # 0 or 1 removal operations, like in test_generator.py
+        if has_remove_operation and rng.randint(0, 1) > 0:
+            removed = operations[rng.randint(0, len(operations)) - 1]
+            operations.append({"type": REMOVE_FROM_CART_OP, "product": removed["product"],
+                               "quantity": rng.randint(1, removed["quantity"])})
+
+        consumer["carts"].append(operations)
+        bought.update(compute_expected_cart(operations))
+
+    return consumer, bought
+
+
+def write_elements(file, key, elements, last=False):
+    """
+    Writes the "key": [...] member of the input file, one element per line.
+
+    :type elements: Iterable
+    :param elements: the elements of the list, written as they are generated
+    """
+    file.write(f'    "{key}": [\n')
+    separator = ''
+    for element in elements:
+        file.write(separator + '        ' + json.dumps(element))
+        separator = ',\n'
+    file.write('\n    ]' + ('\n' if last else ',\n'))
+
+
+def generate_test(arguments):
+    """
+    Generates the test and writes the input and the reference output files.
+
+    :type arguments: Dict
+    :param arguments: the arguments of the script, as returned by parse_input
+    """
+    rng = random.Random(arguments['seed'])
+    test_path = os.path.join(arguments['tests_dir'], arguments[ARG_TEST_NAME])
+
+    products = generate_products(rng, arguments[ARG_PRODUCTS])
+    product_ids = list(products)
+    names = {product_id: str(create_product(description))
+             for product_id, description in products.items()}
+    # the ids of the products made by some producer (alone, by the first one
+    # that makes them), in the order they were picked
+    produced = {}
+
+    def producers():
+        for i in range(arguments[ARG_PRODUCERS]):
+            producer = generate_producer(
+                rng, i, product_ids, list(produced),
+                products_per_producer=arguments['products_per_producer'],
+                basic_test=arguments[ARG_IS_BASIC])
+            produced.update((product_id, None) for product_id, _, _ in producer[ARG_PRODUCTS])
+            yield producer
+
+    def consumers(ref_file):
+        produced_ids = list(produced)
+        for i in range(arguments[ARG_CONSUMERS]):
+            consumer, bought = generate_consumer(rng, i, produced_ids,
+                                                 arguments[ARG_MIN_CARTS],
+                                                 arguments[ARG_MAX_CARTS],
+                                                 basic_test=arguments[ARG_IS_BASIC],
+                                                 has_remove_operation=arguments[
+                                                     ARG_SUPPORTS_REMOVAL])
+            for product_id, count in bought.items():
+                ref_file.write(f'{consumer["name"]}, {names[product_id]}, {count}\n')
+            yield consumer
+
+    with open(f'{test_path}.in', 'w', encoding='utf-8') as input_file, \
+            open(f'{test_path}.ref.out', 'w', encoding='utf-8') as ref_file:
+        input_file.write('{\n    "products": ')
+        input_file.write(json.dumps(products, indent=4).replace('\n', '\n    ') + ',\n')
+        # before the lists, so that Scenario doesn't have to parse them to find it
+        input_file.write('    "marketplace": ')
+        input_file.write(json.dumps({"queue_size_per_producer": arguments[ARG_MARKETPLACE_Q]}))
+        input_file.write(',\n')
+        write_elements(input_file, ARG_PRODUCERS, producers())
+        write_elements(input_file, ARG_CONSUMERS, consumers(ref_file), last=True)
+        input_file.write('}\n')
+
+
+def main():
+    """
+    Checks the arguments and generates the test.
+    """
+    arguments = parse_input()
+    if arguments[ARG_PRODUCERS] <= 0 or arguments[ARG_CONSUMERS] <= 0 \
+            or arguments[ARG_PRODUCTS] <= 0 or arguments[ARG_MARKETPLACE_Q] <= 0 \
+            or arguments[ARG_MIN_CARTS] <= 0 \
+            or arguments[ARG_MAX_CARTS] < arguments[ARG_MIN_CARTS] \
+            or arguments['products_per_producer'] <= 0:
+        print("Invalid arguments")
+        return
+
+    generate_test(arguments)
+
+
+class TestStreamGenerator(unittest.TestCase):
+    """
+    Class for testing the streaming test generator
+    """
+
+    def generate(self, tests_dir, name, seed):
+        """
+        Generates a small test and returns the contents of its files.
+        """
+        arguments = {ARG_TEST_NAME: name, ARG_PRODUCERS: 4, ARG_CONSUMERS: 50,
+                     ARG_PRODUCTS: 40, ARG_MARKETPLACE_Q: 10, ARG_MIN_CARTS: 1,
+                     ARG_MAX_CARTS: 3, ARG_IS_BASIC: False, ARG_SUPPORTS_REMOVAL: True,
+                     'seed': seed, 'products_per_producer': 10, 'tests_dir': tests_dir}
+        generate_test(arguments)
+        path = os.path.join(tests_dir, name)
+        with open(f'{path}.in', encoding='utf-8') as input_file, \
+                open(f'{path}.ref.out', encoding='utf-8') as ref_file:
+            return input_file.read(), ref_file.read()
+
+    def test_deterministic(self):
+        """
+        The same seed gives the same files, another seed different ones.
+        """
+        with tempfile.TemporaryDirectory() as tests_dir:
+            first = self.generate(tests_dir, 'a', 1)
+            self.assertEqual(self.generate(tests_dir, 'b', 1), first)
+            self.assertNotEqual(self.generate(tests_dir, 'c', 2), first)
+
+    def test_reference(self):
+        """
+        The reference is what the consumers of the input buy.
+        """
+        with tempfile.TemporaryDirectory() as tests_dir:
+            _, reference = self.generate(tests_dir, 'test', 3)
+            scenario = Scenario(os.path.join(tests_dir, 'test.in'), chunk_size=64)
+            market_config = scenario.load()
+
+        self.assertEqual(len(scenario.products), 40)
+        self.assertEqual(len(set(map(str, scenario.products.values()))), 40)
+        self.assertEqual(scenario.marketplace, {"queue_size_per_producer": 10})
+        self.assertEqual(len(market_config[ARG_CONSUMERS]), 50)
+
+        # the consumers only buy what the producers make, and every product
+        # has a producer that makes nothing else
+        produced = {product for producer in market_config[ARG_PRODUCERS]
+                    for product, _, _ in producer[ARG_PRODUCTS]}
+        made_alone = {producer[ARG_PRODUCTS][0][0] for producer in market_config[ARG_PRODUCERS]
+                      if len(producer[ARG_PRODUCTS]) == 1}
+        self.assertEqual(made_alone, produced)
+        self.assertTrue(any(len(producer[ARG_PRODUCTS]) > 1
+                            for producer in market_config[ARG_PRODUCERS]))
+        expected = Counter()
+        for consumer in market_config[ARG_CONSUMERS]:
+            for cart in consumer['carts']:
+                for operation in cart:
+                    self.assertIn(operation['product'], produced)
+                    sign = 1 if operation['type'] == ADD_TO_CART_OP else -1
+                    expected[consumer['name'], str(operation['product'])] += \
+                        sign * operation['quantity']
+
+        lines = [line.split(', ', 1) for line in reference.splitlines()]
+        counts = Counter()
+        for consumer, rest in lines:
+            product, count = rest.rsplit(', ', 1)
+            counts[consumer, product] += int(count)
+        self.assertEqual(counts, +expected)
+
+
+if __name__ == "__main__":
+    main()
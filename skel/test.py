@@ -6,69 +6,202 @@ Assignment 1
 March 2020
 """
 
+import argparse
+import asyncio
+import logging
 import sys
-from json import loads
+from json import dump
 
 from tema.producer import Producer
 from tema.consumer import Consumer
-from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.journal import Journal
+from tema.timed_marketplace import create_marketplace
+from tema.marketplace_log import DEFAULT_LOG_PATH, setup_logging
+from tema.metrics import Metrics
+from tema.output import OrderWriter
+from tema.policy import DEFAULT_POLICY, POLICIES
+from tema import async_marketplace, mp_marketplace, pool_marketplace, sim_marketplace
+from tema.scenario import Scenario
 
+ENGINES = ['threads', 'asyncio', 'processes', 'sim', 'pool']
+# how often (in consumers started) the finished consumers are dropped
+CONSUMERS_PRUNE_INTERVAL = 1000
 
-def main():
+
+def method_level(value):
     """
-        Convert the market_configuration input file into specific models:
-        Producer, Consumer, Marketplace
+    Parses a METHOD=LEVEL --log-method argument into a (method, level) pair.
     """
-    try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
-
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
-
-    # turn product definitions into actual products
-    products = {}
-
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
-
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
-
-    # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
+    method, sep, level = value.partition('=')
+    if not sep or not method or not level:
+        raise argparse.ArgumentTypeError(f"expected METHOD=LEVEL, got '{value}'")
+    return method, level
 
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
-                 for p_market_config in market_config['producers']]
 
-    for producer in producers:
-        producer.start()
+def parse_input():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help="the input file of the test")
+    parser.add_argument('--engine', choices=ENGINES, default='threads',
+                        help="run the producers and consumers as threads, as asyncio tasks, "
+                             "in worker processes, on a pool of worker threads or simulate "
+                             "them with a virtual clock")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="the number of worker processes (processes engine) or "
+                             "threads (pool engine)")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="the number of processes the stock is split across "
+                             "(processes engine only, as many as the workers by default)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the seed of the simulation (sim engine only)")
+    parser.add_argument('--max-time', type=float, default=None, metavar='SECONDS',
+                        help="fail if the simulation hasn't ended after SECONDS simulated "
+                             "seconds (sim engine only)")
+    parser.add_argument('--output', default=None, metavar='FILE',
+                        help="write the orders to FILE instead of the standard output")
+    parser.add_argument('--log-file', default=DEFAULT_LOG_PATH,
+                        help="the file the marketplace logs are written to")
+    parser.add_argument('--log-level', default=None,
+                        help="the level of the marketplace logs (e.g. INFO, WARNING; INFO "
+                             "by default, WARNING for the sim engine)")
+    parser.add_argument('--log-method', type=method_level, action='append', default=[],
+                        metavar='METHOD=LEVEL',
+                        help="the level of the logs of a single marketplace method")
+    parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                        help="write only one log record out of every N")
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help="collect the marketplace metrics and write them to FILE as JSON")
+    parser.add_argument('--journal', default=None, metavar='DIR',
+                        help="record the marketplace changes in a journal in DIR, after "
+                             "restoring the state recorded there by earlier runs")
+    parser.add_argument('--policy', choices=list(POLICIES), default=DEFAULT_POLICY,
+                        help="how add_to_cart chooses the producer to take a product from "
+                             "when several have it (python3 -m bench.policies compares "
+                             "all the policies)")
+
+    return parser.parse_args()
+
+
+def run_threads(scenario, output=None, metrics=None):
+    """
+        Convert the scenario into specific models: Producer, Consumer,
+        Marketplace and run them as threads. The producers and the consumers
+        are built and started as they are read from the input file.
+    """
+    # build the marketplace
+    marketplace = create_marketplace(**scenario.marketplace)
+    consumers = []
 
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
+    for key, config in scenario.stream():
+        if key == 'producers':
+            Producer(**config, marketplace=marketplace, metrics=metrics, daemon=True).start()
+            continue
 
-    for consumer in consumers:
+        consumer = Consumer(**config, marketplace=marketplace, output=output, metrics=metrics)
         consumer.start()
+        consumers.append(consumer)
+
+        # forget the consumers that are done, and their carts
+        if len(consumers) % CONSUMERS_PRUNE_INTERVAL == 0:
+            consumers = [consumer for consumer in consumers if consumer.is_alive()]
 
     for consumer in consumers:
         consumer.join()
 
 
+def run_processes(market_config, workers, shards, output):
+    """
+        Run the market in worker processes, with the stock split across shard
+        processes, and return None, or the error if a process died. Takes the
+        whole scenario (Scenario.load()) rather than its stream: every worker
+        gets its share of the producers and the consumers when it starts.
+    """
+    try:
+        mp_marketplace.run_market(market_config, workers, output, shards)
+    except mp_marketplace.ProcessDied as died:
+        return str(died)
+    return None
+
+
+def run_pool(scenario, workers, output):
+    """
+        Run the market on a pool of worker threads and return None, or the
+        error if a producer or consumer failed.
+    """
+    try:
+        pool_marketplace.run_market(scenario.marketplace, scenario.stream(),
+                                    workers or pool_marketplace.DEFAULT_WORKERS, output)
+    except pool_marketplace.ScriptFailed as failed:
+        return str(failed)
+    return None
+
+
+def run_sim(scenario, seed, max_time, output):
+    """
+        Simulate the market and return None, or the error if the simulation
+        stalled or didn't end within max_time (simulated) seconds.
+    """
+    try:
+        duration = sim_marketplace.run_market(scenario.marketplace, scenario.stream(), seed,
+                                              output, max_time)
+    except sim_marketplace.Stalled as stalled:
+        return str(stalled)
+
+    print(f'simulated time: {duration:.3f}s', file=sys.stderr)
+    if max_time is not None and duration >= max_time:
+        return f'the simulation did not end within {max_time}s'
+    return None
+
+
+def main():
+    """
+        Run the test file with the selected engine
+    """
+    args = parse_input()
+    if args.engine == 'processes' and (args.metrics or args.journal):
+        # the Marketplaces of the shards live in other processes
+        sys.exit('error: --metrics and --journal are not supported by the processes engine')
+    # a simulated call takes a few microseconds, its INFO records (stamped
+    # with the wall clock, not the virtual one) most of the run's time
+    log_level = args.log_level or ('WARNING' if args.engine == 'sim' else 'INFO')
+    setup_logging(args.log_file, logging.getLevelName(log_level.upper()),
+                  dict(args.log_method), args.log_sample)
+
+    scenario = Scenario(args.filename)
+    scenario.marketplace['selection_policy'] = args.policy
+    metrics = None
+    if args.metrics:
+        metrics = scenario.marketplace['metrics'] = Metrics()
+    journal = None
+    if args.journal:
+        journal = scenario.marketplace['journal'] = Journal(args.journal)
+    writer = OrderWriter.open(args.output) if args.output else OrderWriter()
+    error = None
+
+    if args.engine == 'asyncio':
+        asyncio.run(async_marketplace.run_market(scenario.marketplace, scenario.stream(),
+                                                 writer.write_order))
+    elif args.engine == 'processes':
+        error = run_processes(scenario.load(), args.workers, args.shards, writer.write_order)
+    elif args.engine == 'sim':
+        error = run_sim(scenario, args.seed, args.max_time, writer.write_order)
+    elif args.engine == 'pool':
+        error = run_pool(scenario, args.workers, writer.write_order)
+    else:
+        run_threads(scenario, writer.write_order, metrics)
+    writer.close()
+    if journal is not None:
+        journal.close()
+
+    if metrics is not None:
+        with open(args.metrics, 'w', encoding='utf-8') as metrics_file:
+            dump(metrics.snapshot(), metrics_file, indent=4)
+
+    if error is not None:
+        sys.exit(f'error: {error}')
+
+
 if __name__ == '__main__':
     main()